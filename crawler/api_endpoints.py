@@ -1,9 +1,16 @@
 import configparser
+import queue
+import time
+from contextlib import contextmanager
 from distutils.util import strtobool
 
 import requests
-import os
+from requests.adapters import HTTPAdapter
 import re
+import concurrency
+from crawl_context import fair_share
+from credentials import pool, usage_cap_exceeded
+from rate_limit import endpoint_family
 from utils import logger
 
 config = configparser.ConfigParser()
@@ -15,10 +22,55 @@ logger.info("-------------------")
 
 API_BASE_URL = "https://api.twitter.com/2/"
 
-if "TWITTER_BEARER_TOKEN" in os.environ:
-    BEARER_TOKEN = os.environ.get("TWITTER_BEARER_TOKEN")
-else:
-    BEARER_TOKEN = config["twitter"]["BearerToken"]
+http_config = config["http"]
+
+
+class SessionPool:
+    def __init__(self, pool_size, max_connections_per_host, block=True):
+        """
+        Thread-safe pool of keep-alive sessions shared by all crawler threads. All sessions mount the same adapter, thus
+        TCP/TLS connections to the api are reused between requests instead of being opened for every page
+        @param pool_size: maximum number of sessions that can be used concurrently
+        @param max_connections_per_host: maximum number of open connections per host (shared by all sessions)
+        @param block: if true, a request waits for a free connection instead of opening a throwaway one
+        """
+        self.pool_size = pool_size
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections_per_host, pool_block=block)
+        self._sessions = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._sessions.put(None)
+
+    def _new_session(self):
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        return session
+
+    @contextmanager
+    def session(self):
+        """
+        Borrows a session from the pool and returns it after usage. Blocks if all sessions are in use
+        @return: requests session
+        """
+        session = self._sessions.get()
+        if session is None:
+            session = self._new_session()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def close(self):
+        """
+        Closes all sessions that have been opened so far
+        """
+        while not self._sessions.empty():
+            session = self._sessions.get_nowait()
+            if session is not None:
+                # releases the keep-alive connections of the session
+                session.close()
+        for _ in range(self.pool_size):
+            self._sessions.put(None)
+        self.adapter.close()
 
 
 class ApiEndpoints:
@@ -29,13 +81,21 @@ class ApiEndpoints:
         self.USER_FIELDS = ["created_at", "description", "entities", "id", "location", "name", "pinned_tweet_id",
                             "profile_image_url", "protected", "public_metrics", "url", "username", "verified",
                             "withheld"]
-        self.HEADER = {"Authorization": "Bearer {}".format(BEARER_TOKEN)}
         self.START_DATE = "2010-01-20T23:59:59.000Z"
 
         self.NER = config["twitter"]["NamedEntityRecognition"]
         if bool(strtobool(self.NER)):
             self.TWEET_FIELDS.append("context_annotations")
 
+        self.EXPAND_AUTHORS = bool(strtobool(config["twitter"]["ExpandAuthors"]))
+        # Twitter restricts the results per page if context annotations are requested
+        self.SEARCH_PAGE_SIZE = 100 if bool(strtobool(self.NER)) else 500
+
+        self.TIMEOUT = float(http_config["RequestTimeout"])
+        self.sessions = SessionPool(pool_size=int(http_config["SessionPoolSize"]),
+                                    max_connections_per_host=int(http_config["MaxConnectionsPerHost"]),
+                                    block=bool(strtobool(http_config["PoolBlock"])))
+
     @staticmethod
     def except_fields(field_name, base_fields, params, except_fields=None):
         """
@@ -59,6 +119,18 @@ class ApiEndpoints:
             params[field_name] = wanted_fields
         return params
 
+    def author_expansions(self, params):
+        """
+        Requests the author and referenced tweet objects inline with the tweets, authors are returned in the
+        includes.users block of the response
+        @param params: parameter dictionary of a tweet request
+        @return: params dictionary
+        """
+        if self.EXPAND_AUTHORS:
+            params["expansions"] = "author_id,referenced_tweets.id"
+            params["user.fields"] = ",".join(self.USER_FIELDS)
+        return params
+
     def get_tweets_by_id(self, ids, except_fields=None):
         """
         Retrieves tweet objects
@@ -69,13 +141,21 @@ class ApiEndpoints:
         if len(ids) > 100:
             logger.error("get_tweets_by_id called with more than 100 users")
             return
-        params = {"ids": ",".join(ids)}
+        params = self.author_expansions({"ids": ",".join(ids)})
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets?", params=params, headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("tweets", params)
+
+    @staticmethod
+    def hashtag_query(hashtags_or_mentions):
+        """
+        Builds the search query of a hashtag or mention search, retweets are excluded
+        @param hashtags_or_mentions: set of hashtags in the following format hashtags: #myhashtag mentions: @myuser
+        @return: query string
+        """
+        return " OR ".join(f"{h_or_m} -is:retweet" for h_or_m in sorted(hashtags_or_mentions))
 
     def get_tweets_by_hashtag_or_mention(self, hashtags_or_mentions, start_date, end_date, except_fields=None,
-                                         next_token=None):
+                                         next_token=None, since_id=None):
         """
         Retrieves all tweets containing certain hashtags or user mentions
         @param hashtags_or_mentions: set of hashtags in the following format hashtags: #myhashtag mentions: @myuser
@@ -83,20 +163,39 @@ class ApiEndpoints:
         @param end_date: end date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
         @param except_fields: optional param for fields which should be excluded. 'default' --> id, text
         @param next_token: token used to retrieve results using pagination
+        @param since_id: optional id, only newer tweets are returned e.g. on a re-crawl
         @return: json object containing requested fields of the tweet
         """
-        q_string = ""
-        for h_or_m in hashtags_or_mentions:
-            q_string += f'{h_or_m} -is:retweet OR '
-        q_string = q_string.strip(" OR ")
         params = {
-            'query': f"{q_string}",
+            'query': self.hashtag_query(hashtags_or_mentions),
             'start_time': start_date,
             'end_time': end_date,
             'max_results': 500
         }
-        response = self.full_archive_search(next_token, params, except_fields)
-        return self.exception_handler(response)
+        if since_id is not None:
+            params['since_id'] = since_id
+        return self.full_archive_search(next_token, params, except_fields)
+
+    def get_tweet_counts(self, query, start_date, end_date, granularity="day", next_token=None):
+        """
+        Retrieves the number of tweets matching a full-archive query per time bucket without retrieving the tweets.
+        Counts do not count against the monthly usage cap
+        @param query: full-archive search query
+        @param start_date: start date from which tweets are counted in the format yyyy-mm-ddT23:59:59.000Z
+        @param end_date: end date until which tweets are counted in the format yyyy-mm-ddT23:59:59.000Z
+        @param granularity: size of the buckets - minute, hour or day
+        @param next_token: token used to retrieve results using pagination (one page covers up to 31 days)
+        @return: json object containing the tweet count of every bucket and the total count
+        """
+        params = {
+            'query': query,
+            'start_time': start_date,
+            'end_time': end_date,
+            'granularity': granularity
+        }
+        if next_token is not None:
+            params["next_token"] = next_token
+        return self.request("tweets/counts/all", params)
 
     def get_users_by_id(self, ids, except_fields=None):
         """
@@ -110,8 +209,7 @@ class ApiEndpoints:
             return
         params = {"ids": ",".join(ids)}
         params = self.except_fields("user.fields", self.USER_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "users?", params=params, headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("users", params)
 
     def get_timeline(self, user_id, except_fields=None, next_token=None):
         """
@@ -129,39 +227,53 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "users/" + user_id + "/tweets?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("users/" + user_id + "/tweets", params)
 
-    def get_timeline_archive_search(self, user_id, except_fields=None, next_token=None):
+    def get_timeline_archive_search(self, user_id, except_fields=None, next_token=None,
+                                    start_date="2017-01-01T00:00:00.000Z", end_date="2023-04-08T00:00:00.000Z"):
+        """
+        Retrieves the tweets a user published within a time window using the full archive search
+        @param user_id: id of user to be crawled
+        @param except_fields: optional param for fields which should be excluded. 'default' --> id, text
+        @param next_token: token used to retrieve results using pagination
+        @param start_date: start date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+        @param end_date: end date until which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+        @return: json object containing requested fields of the tweets
+        """
         max_results = "500"
         params = {
             'query': f"from:{user_id}",
             'max_results': max_results,
-            'start_time': "2017-01-01T00:00:00.000Z",
-            'end_time': "2023-04-08T00:00:00.000Z"
+            'start_time': start_date,
+            'end_time': end_date
         }
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets/search/all?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("tweets/search/all", params)
 
-    def get_keyword_archive_search(self, keyword, except_fields=None, next_token=None):
+    def get_keyword_archive_search(self, keyword, except_fields=None, next_token=None,
+                                   start_date="2017-01-01T00:00:00.000Z", end_date="2023-04-07T00:00:00.000Z"):
+        """
+        Retrieves all tweets containing a keyword within a time window using the full archive search
+        @param keyword: exact phrase to be searched
+        @param except_fields: optional param for fields which should be excluded. 'default' --> id, text
+        @param next_token: token used to retrieve results using pagination
+        @param start_date: start date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+        @param end_date: end date until which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+        @return: json object containing requested fields of the tweets
+        """
         max_results = "500"
         params = {
             'query': f'"{keyword}"',
             'max_results': max_results,
-            'start_time': "2017-01-01T00:00:00.000Z",
-            'end_time': "2023-04-07T00:00:00.000Z"
+            'start_time': start_date,
+            'end_time': end_date
         }
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets/search/all?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("tweets/search/all", params)
 
     def get_followers(self, user_id, except_fields=None, next_token=None):
         """
@@ -179,8 +291,7 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("user.fields", self.USER_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "users/" + user_id + "/followers?", params=params, headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("users/" + user_id + "/followers", params)
 
     def get_following(self, user_id, except_fields=None, next_token=None):
         """
@@ -198,8 +309,7 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("user.fields", self.USER_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "users/" + user_id + "/following?", params=params, headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("users/" + user_id + "/following", params)
 
     def get_liking_users(self, tweet_id, except_fields=None, next_token=None):
         """
@@ -216,9 +326,7 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("user.fields", self.USER_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets/" + tweet_id + "/liking_users?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("tweets/" + tweet_id + "/liking_users", params)
 
     def get_liked_tweets(self, user_id, except_fields=None, next_token=None):
         """
@@ -236,9 +344,7 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "users/" + user_id + "/liked_tweets?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("users/" + user_id + "/liked_tweets", params)
 
     def get_retweeting_users(self, tweet_id, except_fields=None, next_token=None):
         """
@@ -255,9 +361,7 @@ class ApiEndpoints:
         if next_token is not None:
             params["pagination_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets/" + tweet_id + "/retweeted_by?", params=params,
-                                headers=self.HEADER)
-        return self.exception_handler(response)
+        return self.request("tweets/" + tweet_id + "/retweeted_by", params)
 
     def get_replies(self, tweet_id, except_fields=None, next_token=None):
         """
@@ -268,14 +372,51 @@ class ApiEndpoints:
         @return: json object containing id and text of tweets (and next_token if results > max_results)
         """
         max_results = "100" if self.NER else "500",
-        params = {
+        params = self.author_expansions({
             'query': "conversation_id:" + tweet_id,
             'start_time': self.START_DATE,
             'max_results': max_results,
-            # 'expansions': 'referenced_tweets.id.author_id',
+        })
+        return self.full_archive_search(next_token, params, except_fields)
+
+    def get_packed_replies(self, query, except_fields=None, next_token=None, since_id=None, until_id=None):
+        """
+        Retrieves the replies of several conversations with one OR'ed query of conversation_id clauses
+        @param query: packed query see query_packer.build_query
+        @param except_fields: optional param for fields which should be excluded. 'default' --> id, text
+        @param next_token: token used to retrieve results using pagination
+        @param since_id: optional id, only newer replies are returned e.g. on a re-crawl
+        @param until_id: optional id, only older replies are returned e.g. after a query was split
+        @return: json object containing id and text of tweets (and next_token if results > max_results)
+        """
+        return self.full_archive_search(next_token, self.packed_params(query, since_id, until_id), except_fields)
+
+    def get_packed_quotes(self, query, except_fields=None, next_token=None, since_id=None, until_id=None):
+        """
+        Retrieves the quotes of several tweets with one OR'ed query of url clauses
+        @param query: packed query see query_packer.build_query
+        @param except_fields: optional param for fields which should be excluded. 'default' --> id, text
+        @param next_token: token used to retrieve results using pagination
+        @param since_id: optional id, only newer quotes are returned e.g. on a re-crawl
+        @param until_id: optional id, only older quotes are returned e.g. after a query was split
+        @return: json object containing id and text of tweets (and next_token if results > max_results)
+        """
+        return self.full_archive_search(next_token, self.packed_params(query, since_id, until_id), except_fields)
+
+    def packed_params(self, query, since_id=None, until_id=None):
+        params = {
+            'query': query,
+            'max_results': self.SEARCH_PAGE_SIZE,
         }
-        response = self.full_archive_search(next_token, params, except_fields)
-        return self.exception_handler(response)
+        if since_id is not None:
+            # the window starts after the newest tweet of the last crawl instead of START_DATE
+            params['since_id'] = since_id
+        else:
+            params['start_time'] = self.START_DATE
+        if until_id is not None:
+            # the newer tweets were crawled by the query the clauses were split off
+            params['until_id'] = until_id
+        return self.author_expansions(params)
 
     def get_quotes(self, username, tweet_id, except_fields=None, next_token=None):
         """
@@ -288,14 +429,12 @@ class ApiEndpoints:
         """
         max_results = "100" if self.NER else "500",
         url = "https://twitter.com/" + username + "/status/" + tweet_id
-        params = {
+        params = self.author_expansions({
             'query': 'url:' + '"' + url + '" is:quote -is:retweet',
-            # 'expansions': 'author_id',
             'start_time': self.START_DATE,
             'max_results': max_results,
-        }
-        response = self.full_archive_search(next_token, params, except_fields)
-        return self.exception_handler(response)
+        })
+        return self.full_archive_search(next_token, params, except_fields)
 
     def get_retweets_archive_search(self, username, tweet_text, except_fields=None, next_token=None):
         """
@@ -314,8 +453,7 @@ class ApiEndpoints:
             'start_time': self.START_DATE,
             'max_results': max_results,
         }
-        response = self.full_archive_search(next_token, params, except_fields)
-        return self.exception_handler(response)
+        return self.full_archive_search(next_token, params, except_fields)
 
     def full_archive_search(self, next_token, params, except_fields):
         """
@@ -328,8 +466,37 @@ class ApiEndpoints:
         if next_token is not None:
             params["next_token"] = next_token
         params = self.except_fields("tweet.fields", self.TWEET_FIELDS, params, except_fields)
-        response = requests.get(API_BASE_URL + "tweets/search/all?", params=params, headers=self.HEADER)
-        return response
+        return self.request("tweets/search/all", params)
+
+    def request(self, endpoint, params):
+        """
+        Issues a GET request to the given api endpoint using a pooled keep-alive session. Waits for a credential with
+        a permit of the endpoint's rate limit family before the request is sent, events that are crawled concurrently
+        take turns by weight. Credentials that exceeded their usage cap are retired and the request is repeated with
+        the next one
+        @param endpoint: path of the endpoint relative to the api base url e.g. tweets/search/all
+        @param params: parameter dictionary for the request
+        @return: response object, the usage cap response if all credentials are retired
+        """
+        family = endpoint_family(endpoint)
+        while True:
+            credential = fair_share.acquire(family, pool.reserve)
+            if credential is None:
+                return pool.cap_response
+            started = time.time()
+            try:
+                with self.sessions.session() as session:
+                    response = session.get(API_BASE_URL + endpoint, params=params, headers=credential.header,
+                                           timeout=self.TIMEOUT)
+            except Exception:
+                credential.scheduler.release(family)
+                concurrency.observe(family, started, None)
+                raise
+            concurrency.observe(family, started, response.status_code)
+            credential.scheduler.update(family, response.headers)
+            if not usage_cap_exceeded(response):
+                return self.exception_handler(response)
+            pool.retire(credential, response)
 
     @staticmethod
     def exception_handler(response):
@@ -0,0 +1,254 @@
+import asyncio
+import contextvars
+import time
+from collections import Counter
+from datetime import timedelta
+from functools import partial
+
+import aiohttp
+import checkpoints
+import crawl_routines as bot
+from api_endpoints import ApiEndpoints, API_BASE_URL, http_config
+from crawl_context import context
+from credentials import pool, usage_cap_exceeded
+from rate_limit import endpoint_family
+from utils import logger, send_warn_mail, decode_json
+
+CONCURRENCY = int(bot.config["crawler"]["AsyncConcurrency"])
+
+
+class AsyncResponse:
+    def __init__(self, status_code, headers, content):
+        """
+        Fully read response of an aiohttp request offering the parts of the requests.Response interface the crawl
+        routines rely on
+        @param status_code: http status code
+        @param headers: case-insensitive response headers
+        @param content: raw response body
+        """
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return decode_json(self.content)
+
+    def __repr__(self):
+        return f"<AsyncResponse [{self.status_code}]>"
+
+
+class AsyncApiEndpoints(ApiEndpoints):
+    """
+    Asyncio variant of the api endpoints. Exposes the same get_* methods, which return awaitables instead of responses
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.session = None
+
+    @staticmethod
+    def encode_params(params):
+        """
+        Converts a parameter dictionary the way requests does it: None values are dropped and sequences are expanded
+        @param params: parameter dictionary for the request
+        @return: list of key value pairs
+        """
+        encoded = []
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                encoded.extend((key, str(v)) for v in value)
+            else:
+                encoded.append((key, str(value)))
+        return encoded
+
+    async def request(self, endpoint, params):
+        """
+        Issues a GET request to the given api endpoint using the shared aiohttp session. Suspends until a credential
+        with a permit of the endpoint's rate limit family is available
+        @param endpoint: path of the endpoint relative to the api base url e.g. tweets/search/all
+        @param params: parameter dictionary for the request
+        @return: AsyncResponse object, the usage cap response if all credentials are retired
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=int(http_config["MaxConnectionsPerHost"]))
+            timeout = aiohttp.ClientTimeout(total=self.TIMEOUT)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        family = endpoint_family(endpoint)
+        while True:
+            credential = await pool.acquire_async(family)
+            if credential is None:
+                return pool.cap_response
+            try:
+                async with self.session.get(API_BASE_URL + endpoint, params=self.encode_params(params),
+                                            headers=credential.header) as response:
+                    content = await response.read()
+                    result = AsyncResponse(response.status, response.headers, content)
+            except Exception:
+                credential.scheduler.release(family)
+                raise
+            credential.scheduler.update(family, result.headers)
+            if not usage_cap_exceeded(result):
+                return self.exception_handler(result)
+            pool.retire(credential, result)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+async def iterative_crawl(crawl_function, params, max_pages=None, cursor=None, progress=None):
+    """
+    Coroutine equivalent of crawl_routines.iterative_crawl. Waiting on the api suspends the coroutine, processing of
+    the results runs in the default executor to keep the event loop responsive while writing to the db
+    @param crawl_function: coroutine function to make the request
+    @param params: parameters for the api request
+    @param max_pages: optional maximum number of pages, TOO_DEEP is returned if more pages are available
+    @param cursor: optional checkpoint Cursor that is saved after every page
+    @param progress: optional Counter of the crawl, its pages are counted across the calls after rate limit waits
+    @return: either none if crawl finished successful or the time to wait until next request can be issued
+    """
+    loop = asyncio.get_running_loop()
+    status = bot.NEXT_PAGE
+    progress = Counter() if progress is None else progress
+    while status == bot.NEXT_PAGE:
+        if max_pages is not None and progress["pages"] >= max_pages:
+            return bot.TOO_DEEP
+        try:
+            response = await crawl_function(**params)
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            # a stalled or dropped request is repeated like a response without rate limit headers
+            logger.exception(f"Request of {crawl_function.__name__} failed --> retry")
+            return bot.RETRY
+        # executor threads do not inherit the crawl context of the coroutine
+        status = await loop.run_in_executor(None, contextvars.copy_context().run, bot.handle_page,
+                                            crawl_function.__name__, params, response, cursor)
+        if status in {bot.NEXT_PAGE, None}:
+            # like the checkpoint, only processed pages count, not rate limited or repeated requests
+            progress["pages"] += 1
+    return status
+
+
+async def crawl(crawl_function, params, max_pages=None, completion=None):
+    """
+    Coroutine equivalent of crawl_routines.crawl. Rate limit waits suspend the coroutine instead of parking a thread
+    @param crawl_function: coroutine function to make the request
+    @param params: parameters for the api request
+    @param max_pages: optional maximum number of pages of the crawl including those crawled before a rate limit wait
+    or a checkpointed restart, TOO_DEEP is returned if more pages are available
+    @param completion: optional tuple (collection, document id, field name) of the flag that is set together with the
+    final page
+    """
+    loop = asyncio.get_running_loop()
+    cursor = checkpoints.open_cursor(crawl_function, params, context().event_id, completion)
+    pages = await loop.run_in_executor(None, contextvars.copy_context().run, bot.resume, cursor, params, completion)
+    if pages is None:
+        return None
+    progress = Counter(pages=pages)
+    next_crawl_time = time.time()
+    retries = 0
+    retry_token = None
+    while next_crawl_time is not None:
+        next_crawl_time = await iterative_crawl(crawl_function, params, max_pages, cursor, progress)
+        logger.info(f"Next Crawl Time {next_crawl_time}")
+        if next_crawl_time in {"USAGE_CAP", bot.TOO_DEEP}:
+            return next_crawl_time
+        if next_crawl_time is None:
+            # Crawl done without exceeding any limits
+            break
+        if next_crawl_time == bot.RETRY:
+            # retries are counted per page
+            retries = retries + 1 if params.get("next_token") == retry_token else 1
+            retry_token = params.get("next_token")
+            next_crawl_time = bot.retry_time(crawl_function.__name__, retries)
+        logger.info(
+            f"Wait until limit reset in {timedelta(seconds=next_crawl_time - int(time.time()))} h/m/s")
+        await asyncio.sleep(max(next_crawl_time - time.time(), 0))
+    if cursor is None:
+        await loop.run_in_executor(None, checkpoints.set_flag, completion)
+
+
+async def execute_and_modify(crawl_function, db_response, field_name):
+    """
+    Coroutine equivalent of crawl_routines.execute_and_modify. Full-archive searches are sharded by
+    crawl_routines.sharded_crawl in the default executor, they page through many slices with blocking requests anyway
+    @param crawl_function: coroutine function to be executed - namely retweet, like or timeline crawl
+    @param db_response: which returned ids to be crawled with @crawl_function
+    @param field_name: of document in db which has to be set to true after successful crawl
+    """
+    loop = asyncio.get_running_loop()
+    params, collection = bot.job_params(db_response, field_name)
+    f_name = crawl_function.__name__
+    if f_name == "get_keyword_archive_search":
+        status = await loop.run_in_executor(None, contextvars.copy_context().run, bot.sharded_crawl,
+                                            getattr(bot.api, f_name), params)
+    elif f_name == "get_timeline_archive_search":
+        status = await loop.run_in_executor(None, contextvars.copy_context().run, partial(
+            bot.sharded_crawl, getattr(bot.api, f_name), params, slices=db_response.get("planned_slices"),
+            num_slices=bot.TIMELINE_SLICES))
+    elif collection is not None:
+        # the flag is set together with the final page
+        status = await crawl(crawl_function, params, max_pages=db_response.get("max_pages"),
+                             completion=(collection, db_response["id"], field_name))
+        if status != bot.TOO_DEEP:
+            return status
+        # the follower planner capped the crawl of the user
+        logger.info(f"{field_name} of {db_response['id']} capped after {db_response['max_pages']} pages")
+    else:
+        status = await crawl(crawl_function, params)
+    if status == "USAGE_CAP":
+        return "USAGE_CAP"
+    elif collection is not None:
+        await loop.run_in_executor(None, bot.db.modify, {"id": db_response["id"]}, {"$set": {field_name: True}},
+                                   collection)
+
+
+async def threaded_crawl(f_name, search_results, target_field_name, concurrency=CONCURRENCY):
+    """
+    Asyncio equivalent of crawl_routines.threaded_crawl. Runs up to concurrency jobs on one event loop
+    @param f_name: name of the api function which should be crawled
+    @param search_results: results of db search for elements which need to be crawled
+    @param target_field_name: name of field which should be changed after successful crawl
+    @param concurrency: number of jobs that are in flight at the same time
+    """
+    api = AsyncApiEndpoints()
+    crawl_function = getattr(api, f_name)
+    job_queue = asyncio.Queue(maxsize=2 * concurrency)
+    usage_cap = asyncio.Event()
+
+    async def worker():
+        while True:
+            new_job = await job_queue.get()
+            try:
+                if not usage_cap.is_set():
+                    status = await execute_and_modify(crawl_function, new_job, target_field_name)
+                    if status == "USAGE_CAP" and not usage_cap.is_set():
+                        # Sends warn mail only for the first job encountering the usage cap
+                        usage_cap.set()
+                        await asyncio.get_running_loop().run_in_executor(None, send_warn_mail)
+            except Exception:
+                logger.exception(f"Error in async crawl of {f_name} for {new_job}")
+            finally:
+                job_queue.task_done()
+
+    logger.info(f"Main: start {concurrency} coroutines for {f_name}")
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    loop = asyncio.get_running_loop()
+    results = iter(search_results)
+    while not usage_cap.is_set():
+        # db cursors block while fetching the next batch --> iterate them in the executor
+        elem = await loop.run_in_executor(None, next, results, None)
+        if elem is None:
+            break
+        await job_queue.put(elem)
+    await job_queue.join()
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await api.close()
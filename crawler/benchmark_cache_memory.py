@@ -0,0 +1,123 @@
+"""
+Memory benchmark of the author cache on a large synthetic hashtag event (no api or db access).
+Compares the former dict based Tweet and User objects with string ids to the slotted AuthorCache with integer ids,
+with and without a bound. Spilled tweets are discarded instead of being written to the database.
+
+    $ cd crawler
+    $ python benchmark_cache_memory.py [number of tweets, default 500000]
+"""
+import logging
+import random
+import sys
+import time
+import tracemalloc
+
+from caches import AuthorCache, cache_tweets
+from utils import logger
+
+PAGE_SIZE = 500
+
+
+class LegacyTweet:
+    def __init__(self, tweet_id, public_metrics, author_id=None):
+        self.id = tweet_id
+        self.author_id = author_id
+        self.reply_count = public_metrics["reply_count"]
+        self.retweet_count = public_metrics["retweet_count"]
+        self.like_count = public_metrics["like_count"]
+        self.quote_count = public_metrics["quote_count"]
+        self.quotes_retrieved = False
+        self.likes_retrieved = False
+        self.retweets_retrieved = False
+
+
+class LegacyUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = str
+        self.tweets = []
+        self.followers_count = 0
+        self.user_retrieved = False
+
+
+def legacy_cache(tweets, author_cache, tweet_cache, quotes=False):
+    """
+    Author cache as it was before: one dict based User per author with a list of dict based Tweets and a linear scan
+    over the authors tweets to detect self-quotes
+    """
+    for res in tweets:
+        tweet = LegacyTweet(res["id"], res["public_metrics"], res["author_id"])
+        if quotes:
+            tweet_cache.append(tweet)
+        author = author_cache.get(res["author_id"])
+        if author is None:
+            author = LegacyUser(res["author_id"])
+            author_cache[res["author_id"]] = author
+        if all(existing.id != res["id"] for existing in author.tweets):
+            author.tweets.append(tweet)
+
+
+class DiscardSpill:
+    def __init__(self):
+        self.spilled = 0
+
+    def dump(self, tweets):
+        self.spilled += len(tweets)
+
+    def load(self, n):
+        return []
+
+    def clear(self):
+        pass
+
+
+def synthetic_pages(num_tweets, num_authors=50000):
+    """
+    Pages of a hashtag event in which a few accounts write a large share of the tweets, a fifth of the tweets is quoted
+    """
+    rnd = random.Random(42)
+    tweet_id = 10 ** 18
+    for _ in range(0, num_tweets, PAGE_SIZE):
+        page = []
+        for _ in range(PAGE_SIZE):
+            tweet_id += 1
+            page.append({
+                "id": str(tweet_id),
+                "author_id": str(10 ** 9 + (rnd.randrange(100) if rnd.random() < 0.3 else rnd.randrange(num_authors))),
+                "public_metrics": {"reply_count": rnd.randint(0, 3), "retweet_count": rnd.randint(0, 10),
+                                   "like_count": rnd.randint(0, 500), "quote_count": rnd.randint(1, 3)
+                                   if rnd.random() < 0.2 else 0},
+            })
+        yield page
+
+
+def measure(cache, author_cache, num_tweets):
+    """
+    @return: tuple (retained bytes, peak bytes, seconds) after caching all tweets of the event
+    """
+    tweet_cache = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for page in synthetic_pages(num_tweets):
+        cache(page, author_cache, tweet_cache)
+    seconds = time.perf_counter() - start
+    del page
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak, seconds
+
+
+if __name__ == "__main__":
+    num_tweets = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    logger.setLevel(logging.WARNING)
+    bound = num_tweets // 10
+    spill = DiscardSpill()
+    runs = [("before (dict objects, str ids)", legacy_cache, {}),
+            ("slotted, int ids", cache_tweets, AuthorCache()),
+            (f"slotted, bound {bound}", cache_tweets, AuthorCache(bound, spill))]
+    print(f"{num_tweets} synthetic tweets")
+    for name, cache, author_cache in runs:
+        current, peak, seconds = measure(cache, author_cache, num_tweets)
+        print(f"{name:<32} retained {current / 2 ** 20:8.1f} MiB ({current / num_tweets:6.1f} B/tweet), "
+              f"peak {peak / 2 ** 20:8.1f} MiB, {seconds:6.2f} s")
+    print(f"{spill.spilled} tweets spilled by the bounded cache")
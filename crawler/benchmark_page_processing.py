@@ -0,0 +1,137 @@
+"""
+Micro-benchmark of the in-memory part of page processing (decoding and cache bookkeeping, no db access).
+Uses the pages recorded in the response lake if there are any, otherwise synthetic full-archive pages.
+
+    $ cd crawler
+    $ python benchmark_page_processing.py [number of synthetic pages, default 40]
+"""
+import json
+import random
+import sys
+import time
+from datetime import datetime
+
+from caches import AuthorCache, cache_tweets
+from response_lake import lake
+from utils import decode_json
+
+TWEET_FUNCTIONS = {"get_seed", "get_replies", "get_quotes"}
+
+
+class LegacyTweet:
+    # Tweet of the crawl routines before the fast path, a plain object with an instance dict
+    def __init__(self, tweet_id, public_metrics):
+        self.id = tweet_id
+        self.reply_count = public_metrics["reply_count"]
+        self.retweet_count = public_metrics["retweet_count"]
+        self.like_count = public_metrics["like_count"]
+        self.quote_count = public_metrics["quote_count"]
+        self.quotes_retrieved = False
+        self.likes_retrieved = False
+        self.retweets_retrieved = False
+
+
+class LegacyUser:
+    # User of the crawl routines before the fast path, the tweets of an author are kept in a list
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = str
+        self.tweets = []
+        self.user_retrieved = False
+
+    def add_tweet(self, tweet):
+        self.tweets.append(tweet)
+
+
+def legacy_process(raw_page, author_cache, tweet_cache, quotes):
+    """
+    Page processing as it was done before: standard json decoder, one timestamp per record, the baseline Tweet and
+    User objects and a linear scan over the authors tweets to detect self-quotes
+    """
+    response = json.loads(raw_page)["data"]
+    for res in response:
+        res["crawl_timestamp"] = datetime.now()
+        res["event_id"] = ["benchmark"]
+        res["likes_crawled"] = False
+        res["retweets_crawled"] = False
+        if quotes:
+            tweet_cache.append(LegacyTweet(res["id"], res["public_metrics"]))
+        if res["author_id"] not in author_cache:
+            new_user = LegacyUser(res["author_id"])
+            new_user.add_tweet(LegacyTweet(res["id"], res["public_metrics"]))
+            author_cache[res["author_id"]] = new_user
+        else:
+            existing_user = author_cache[res["author_id"]]
+            self_quoting = False
+            for existing_tweet in existing_user.tweets:
+                if existing_tweet.id == res["id"]:
+                    self_quoting = True
+            if not self_quoting:
+                existing_user.add_tweet(LegacyTweet(res["id"], res["public_metrics"]))
+
+
+def fast_process(raw_page, author_cache, tweet_cache, quotes):
+    """
+    Current page processing: fast decoder, one timestamp per page and hash based self-quote detection
+    """
+    response = decode_json(raw_page)["data"]
+    crawl_timestamp = datetime.now()
+    for res in response:
+        res["crawl_timestamp"] = crawl_timestamp
+        res["event_id"] = ["benchmark"]
+        res["likes_crawled"] = False
+        res["retweets_crawled"] = False
+    cache_tweets(response, author_cache, tweet_cache, quotes=quotes)
+
+
+def recorded_pages():
+    return [(json.dumps(record["page"]).encode("utf-8"), record["endpoint"] == "get_quotes")
+            for record in lake.read(endpoints=TWEET_FUNCTIONS)]
+
+
+def synthetic_pages(num_pages, page_size=500, num_authors=2000):
+    """
+    Full-archive pages of a conversation with a few very active authors, which is where the linear scan hurts most
+    """
+    rnd = random.Random(42)
+    pages = []
+    tweet_id = 10 ** 18
+    for _ in range(num_pages):
+        data = []
+        for _ in range(page_size):
+            tweet_id += 1
+            data.append({
+                "id": str(tweet_id),
+                # a third of the tweets are written by ten very active authors
+                "author_id": str(rnd.randrange(10) if rnd.random() < 0.3 else rnd.randrange(num_authors)),
+                "conversation_id": "1",
+                "created_at": "2021-02-28T01:00:00.000Z",
+                "lang": "en",
+                "text": "x" * rnd.randint(20, 280),
+                "public_metrics": {"reply_count": rnd.randint(0, 3), "retweet_count": rnd.randint(0, 10),
+                                   "like_count": rnd.randint(0, 50), "quote_count": rnd.randint(0, 2)},
+                "referenced_tweets": [{"type": "replied_to", "id": str(tweet_id - 1)}],
+            })
+        pages.append((json.dumps({"data": data, "meta": {"result_count": page_size}}).encode("utf-8"), False))
+    return pages
+
+
+def run(process, pages, author_cache):
+    tweet_cache = []
+    start = time.perf_counter()
+    for raw_page, quotes in pages:
+        process(raw_page, author_cache, tweet_cache, quotes)
+    return (time.perf_counter() - start) / len(pages)
+
+
+if __name__ == "__main__":
+    pages = recorded_pages()
+    source = "recorded"
+    if len(pages) == 0:
+        pages = synthetic_pages(int(sys.argv[1]) if len(sys.argv) > 1 else 40)
+        source = "synthetic"
+    legacy = run(legacy_process, pages, {})
+    fast = run(fast_process, pages, AuthorCache())
+    print(f"{len(pages)} {source} pages")
+    print(f"before: {legacy * 1000:8.2f} ms/page")
+    print(f"after:  {fast * 1000:8.2f} ms/page ({legacy / fast:.1f}x)")
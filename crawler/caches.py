@@ -0,0 +1,258 @@
+import threading
+import uuid
+
+from utils import logger
+
+# guards the author and tweet caches, pipeline workers and packed queries update them concurrently
+cache_lock = threading.RLock()
+
+QUOTES_RETRIEVED = 1
+LIKES_RETRIEVED = 2
+RETWEETS_RETRIEVED = 4
+
+
+class Tweet:
+    # no per-instance __dict__, ids are stored as integers and the retrieval flags as bits of one integer
+    __slots__ = ("_id", "_author_id", "reply_count", "retweet_count", "like_count", "quote_count", "flags")
+
+    def __init__(self, tweet_id, public_metrics, author_id=None):
+        self._id = int(tweet_id)
+        self._author_id = None if author_id is None else int(author_id)
+        self.reply_count = public_metrics["reply_count"]
+        self.retweet_count = public_metrics["retweet_count"]
+        self.like_count = public_metrics["like_count"]
+        self.quote_count = public_metrics["quote_count"]
+        self.flags = 0
+
+    def __repr__(self):
+        return f"Tweet-ID {self.id} has {self.reply_count} replies, {self.retweet_count} retweet(s), " \
+               f"{self.quote_count} quote(s) and {self.like_count} like(s)"
+
+    @property
+    def id(self):
+        return str(self._id)
+
+    @property
+    def author_id(self):
+        return None if self._author_id is None else str(self._author_id)
+
+    def get_flag(self, flag):
+        return self.flags & flag != 0
+
+    def set_flag(self, flag, value):
+        self.flags = self.flags | flag if value else self.flags & ~flag
+
+    quotes_retrieved = property(lambda self: self.get_flag(QUOTES_RETRIEVED),
+                                lambda self, value: self.set_flag(QUOTES_RETRIEVED, value))
+    likes_retrieved = property(lambda self: self.get_flag(LIKES_RETRIEVED),
+                               lambda self, value: self.set_flag(LIKES_RETRIEVED, value))
+    retweets_retrieved = property(lambda self: self.get_flag(RETWEETS_RETRIEVED),
+                                  lambda self, value: self.set_flag(RETWEETS_RETRIEVED, value))
+
+    def sum_metric_count(self):
+        return self.reply_count + self.quote_count
+
+    def finished(self):
+        """
+        @return: true if no further crawl depends on the cached tweet, it is stored in the tweet collection already
+        """
+        return self.quote_count == 0 or self.quotes_retrieved
+
+
+class User:
+    __slots__ = ("_id", "username", "tweets", "followers_count", "user_retrieved")
+
+    def __init__(self, user_id):
+        self._id = int(user_id)
+        self.username = None
+        self.tweets = []
+        self.followers_count = 0
+        self.user_retrieved = False
+
+    def __repr__(self):
+        return f"User {self.username} with id {self.id} published the following tweets {self.tweets}"
+
+    @property
+    def id(self):
+        return str(self._id)
+
+    def add_tweet(self, tweet):
+        self.tweets.append(tweet)
+
+    def set_username(self, username):
+        self.username = username
+
+
+class MongoSpill:
+    def __init__(self, collection):
+        """
+        Store of the cached tweets that did not fit into an AuthorCache. Every process keeps its own records
+        @param collection: pymongo collection the records are written to
+        """
+        self.collection = collection
+        self.owner = uuid.uuid4().hex
+
+    def dump(self, tweets):
+        """
+        @param tweets: list of Tweets to move to the database
+        """
+        self.collection.insert_many([{
+            "id": f"{self.owner}:{tweet.id}", "owner": self.owner, "tweet_id": tweet.id, "author_id": tweet.author_id,
+            "public_metrics": {"reply_count": tweet.reply_count, "retweet_count": tweet.retweet_count,
+                               "like_count": tweet.like_count, "quote_count": tweet.quote_count},
+            "flags": tweet.flags
+        } for tweet in tweets], ordered=False)
+
+    def load(self, n):
+        """
+        Removes up to n records from the database
+        @param n: maximum number of tweets
+        @return: list of Tweets
+        """
+        records = list(self.collection.find({"owner": self.owner}).limit(n))
+        self.collection.delete_many({"id": {"$in": [record["id"] for record in records]}})
+        tweets = []
+        for record in records:
+            tweet = Tweet(record["tweet_id"], record["public_metrics"], record["author_id"])
+            tweet.flags = record["flags"]
+            tweets.append(tweet)
+        return tweets
+
+    def clear(self):
+        self.collection.delete_many({"owner": self.owner})
+
+
+class AuthorCache:
+    def __init__(self, max_tweets=0, spill=None):
+        """
+        Authors and their tweets of the current event indexed by integer id. Once more than max_tweets tweets are cached
+        the finished ones are evicted, they are stored in the tweet collection already. If that is not enough the
+        oldest tweets whose quotes are still to be crawled are moved to the spill store until half of the bound is
+        used, they are loaded again by restore() once there is room. Authors stay in memory. A tweet that is returned
+        again after it was evicted is cached like a new one
+        @param max_tweets: maximum number of cached tweets, 0 for no bound
+        @param spill: optional MongoSpill, without one only finished tweets are evicted
+        """
+        self.max_tweets = max_tweets
+        self.spill = spill
+        self.authors = {}
+        # tweet id --> Tweet, detects self-quoting tweets that are returned twice
+        self.tweets = {}
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self.authors)
+
+    def __contains__(self, author_id):
+        return int(author_id) in self.authors
+
+    def get(self, author_id, default=None):
+        if author_id is None:
+            return default
+        return self.authors.get(int(author_id), default)
+
+    def values(self):
+        return self.authors.values()
+
+    def author(self, author_id):
+        """
+        @param author_id: id of the author
+        @return: cached User, a new one if the author is not cached yet
+        """
+        author = self.authors.get(int(author_id))
+        if author is None:
+            author = User(author_id)
+            self.authors[author._id] = author
+        return author
+
+    def add(self, tweet):
+        """
+        @param tweet: Tweet to cache
+        @return: true if the tweet was not cached yet
+        """
+        if tweet._id in self.tweets:
+            return False
+        self.tweets[tweet._id] = tweet
+        author = self.author(tweet._author_id)
+        # all tweets of an author share one id object
+        tweet._author_id = author._id
+        author.add_tweet(tweet)
+        if 0 < self.max_tweets < len(self.tweets):
+            self.shrink()
+        return True
+
+    def remove(self, tweet_ids):
+        """
+        @param tweet_ids: set of integer ids of the tweets to drop from memory
+        """
+        authors = {self.tweets.pop(tweet_id)._author_id for tweet_id in tweet_ids}
+        for author_id in authors:
+            author = self.authors[author_id]
+            author.tweets = [tweet for tweet in author.tweets if tweet._id not in tweet_ids]
+
+    def shrink(self):
+        """
+        Evicts finished tweets and spills pending ones until at most half of the bound is used
+        """
+        self.remove({tweet_id for tweet_id, tweet in self.tweets.items() if tweet.finished()})
+        excess = len(self.tweets) - self.max_tweets // 2
+        if excess <= 0:
+            return
+        if self.spill is None:
+            self.max_tweets *= 2
+            logger.warning(f"{len(self.tweets)} tweets with pending quotes cached and no spill store --> raise the "
+                           f"bound to {self.max_tweets}")
+            return
+        spilled = [tweet for _, tweet in zip(range(excess), self.tweets.values())]
+        self.spill.dump(spilled)
+        self.spilled += len(spilled)
+        self.remove({tweet._id for tweet in spilled})
+        logger.info(f"Spilled {len(spilled)} cached tweets to the database ({self.spilled} spilled in total)")
+
+    def restore(self):
+        """
+        Loads spilled tweets into the free part of the cache after the finished ones were evicted
+        @return: number of tweets loaded
+        """
+        if self.spilled == 0:
+            return 0
+        self.remove({tweet_id for tweet_id, tweet in self.tweets.items() if tweet.finished()})
+        free = self.max_tweets - len(self.tweets)
+        if free <= 0:
+            return 0
+        tweets = self.spill.load(min(free, self.spilled))
+        self.spilled -= len(tweets)
+        for tweet in tweets:
+            if tweet._id not in self.tweets:
+                self.tweets[tweet._id] = tweet
+                self.author(tweet._author_id).add_tweet(tweet)
+        return len(tweets)
+
+    def clear(self):
+        self.authors.clear()
+        self.tweets.clear()
+        if self.spilled > 0:
+            self.spill.clear()
+            self.spilled = 0
+
+
+def cache_tweets(tweets, author_cache, tweet_cache, quotes=False):
+    """
+    Adds the tweets of a page to the local author cache
+    @param tweets: tweet objects of the page
+    @param author_cache: AuthorCache of the current event
+    @param tweet_cache: list of quote tweets whose subtrees still have to be crawled
+    @param quotes: true if the tweets are quotes and have to be added to the tweet cache as well
+    """
+    with cache_lock:
+        add_to_cache(tweets, author_cache, tweet_cache, quotes)
+
+
+def add_to_cache(tweets, author_cache, tweet_cache, quotes):
+    for res in tweets:
+        tweet = Tweet(res["id"], res["public_metrics"], res["author_id"])
+        if quotes:
+            tweet_cache.append(tweet)
+        # Tweet already in cache, don't add self-quoting tweet again see
+        # https://twittercommunity.com/t/self-quoting-tweet-bug/168436
+        author_cache.add(tweet)
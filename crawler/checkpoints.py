@@ -0,0 +1,121 @@
+import configparser
+import hashlib
+import inspect
+from datetime import datetime
+from distutils.util import strtobool
+
+import mongo_db as db
+from response_lake import canonical
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+
+USE_CHECKPOINTS = bool(strtobool(config["checkpoints"]["UseCheckpoints"])) and \
+                  bool(strtobool(config["mongoDB"]["UseMongo"]))
+CHECKPOINT_COLLECTION = config["mongoDB"]["CheckpointCollection"]
+
+if USE_CHECKPOINTS:
+    db.create_collection(CHECKPOINT_COLLECTION)
+
+# crawl function name --> true if the function paginates with a next_token
+paginated = {}
+
+
+def cursor_key(f_name, params, event_id):
+    """
+    @param f_name: name of the crawl function
+    @param params: parameters of the crawl, next_token is ignored
+    @param event_id: event the crawl belongs to, a crawl done for one event is repeated for another one
+    @return: hex digest identifying the crawl
+    """
+    params = {k: v for k, v in params.items() if k != "next_token"}
+    return hashlib.sha1(f"{f_name}|{canonical(params)}|{event_id}".encode("utf-8")).hexdigest()
+
+
+class Cursor:
+    def __init__(self, f_name, params, event_id, completion=None):
+        """
+        Pagination cursor of one crawl that is saved to the checkpoint collection after every processed page
+        @param f_name: name of the crawl function
+        @param params: parameters of the crawl
+        @param event_id: event the crawl belongs to
+        @param completion: optional tuple (collection, document id, field name) of the flag that is set once the final
+        page is processed
+        """
+        self.f_name = f_name
+        self.event_id = event_id
+        self.key = cursor_key(f_name, params, event_id)
+        self.completion = completion
+
+    def load(self):
+        """
+        @return: checkpoint document of the crawl, none if the crawl has not processed a page yet
+        """
+        return db.db[CHECKPOINT_COLLECTION].find_one({"id": self.key})
+
+    def save(self, next_token):
+        """
+        Saves the token of the next page after a page was processed
+        @param next_token: pagination token of the next page
+        """
+        db.db[CHECKPOINT_COLLECTION].update_one({"id": self.key}, {
+            "$set": {"function": self.f_name, "event_id": self.event_id, "next_token": next_token, "done": False,
+                     "updated_at": datetime.utcnow()},
+            "$inc": {"pages": 1}
+        }, upsert=True)
+
+    def complete(self):
+        """
+        Marks the crawl as done after its final page was processed and sets the completion flag of the crawled document
+        """
+        db.db[CHECKPOINT_COLLECTION].update_one({"id": self.key}, {
+            "$set": {"function": self.f_name, "event_id": self.event_id, "next_token": None, "done": True,
+                     "updated_at": datetime.utcnow()},
+            "$inc": {"pages": 1}
+        }, upsert=True)
+        set_flag(self.completion)
+
+
+def set_flag(completion):
+    """
+    Sets the completion flag of a crawled document e.g. timeline_crawled
+    @param completion: tuple (collection, document id, field name), none if there is no flag
+    """
+    if completion is not None:
+        collection, document_id, field_name = completion
+        db.modify({"id": document_id}, {"$set": {field_name: True}}, collection)
+
+
+def open_cursor(crawl_function, params, event_id, completion=None):
+    """
+    @param crawl_function: function to make the request
+    @param params: parameters of the crawl
+    @param event_id: event the crawl belongs to
+    @param completion: optional tuple (collection, document id, field name) of the flag that is set once the final page
+    is processed
+    @return: Cursor of the crawl, none if checkpoints are disabled or the function returns a single page
+    """
+    if not USE_CHECKPOINTS:
+        return None
+    f_name = crawl_function.__name__
+    if f_name not in paginated:
+        paginated[f_name] = "next_token" in inspect.signature(crawl_function).parameters
+    if not paginated[f_name]:
+        return None
+    return Cursor(f_name, params, event_id, completion)
+
+
+def clear(f_name=None, event_id=None):
+    """
+    Deletes checkpoints, e.g. to crawl conversations again that were completed before
+    @param f_name: optional name of the crawl function whose checkpoints are deleted, all otherwise
+    @param event_id: optional event whose checkpoints are deleted, those of all events otherwise
+    """
+    if not USE_CHECKPOINTS:
+        return
+    query = {}
+    if f_name is not None:
+        query["function"] = f_name
+    if event_id is not None:
+        query["event_id"] = event_id
+    db.db[CHECKPOINT_COLLECTION].delete_many(query)
@@ -0,0 +1,195 @@
+import configparser
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from credentials import pool
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+concurrency_config = config["concurrency"]
+
+MIN_THREADS = int(concurrency_config["MinThreads"])
+MAX_SEARCH_THREADS = int(concurrency_config["MaxSearchThreads"])
+CONTROL_SECONDS = float(concurrency_config["ControlSeconds"])
+ERROR_THRESHOLD = float(concurrency_config["ErrorThreshold"])
+DECREASE_FACTOR = float(concurrency_config["DecreaseFactor"])
+LATENCY_FACTOR = float(concurrency_config["LatencyFactor"])
+HEADROOM_THRESHOLD = float(concurrency_config["HeadroomThreshold"])
+STATUS_SECONDS = float(concurrency_config["StatusSeconds"])
+
+
+class RequestStats:
+    def __init__(self):
+        """
+        Running totals of the requests sent per endpoint family. Controllers keep their own snapshot and compare it with
+        the totals, thus several stages can watch the same family
+        """
+        self.totals = defaultdict(lambda: {"requests": 0, "errors": 0, "throttled": 0, "latency": 0.0})
+        self.lock = threading.Lock()
+
+    def record(self, family, latency, status_code):
+        """
+        @param family: endpoint family of the request
+        @param latency: seconds from sending the request to receiving the response
+        @param status_code: status code of the response, none if the request timed out or failed
+        """
+        with self.lock:
+            totals = self.totals[family]
+            totals["requests"] += 1
+            totals["latency"] += latency
+            if status_code == 429:
+                totals["throttled"] += 1
+            elif status_code is None or status_code >= 500:
+                totals["errors"] += 1
+
+    def snapshot(self, family):
+        with self.lock:
+            return dict(self.totals[family])
+
+
+stats = RequestStats()
+
+
+def observe(family, started, status_code):
+    """
+    Records a request for the concurrency controllers
+    @param family: endpoint family of the request
+    @param started: timestamp the request was sent at
+    @param status_code: status code of the response, none if the request timed out or failed
+    """
+    stats.record(family, time.time() - started, status_code)
+
+
+class StageController:
+    def __init__(self, name, family, max_threads):
+        """
+        Sizes the worker pool of a threaded crawl stage at runtime (additive increase, multiplicative decrease). The
+        stage starts with MIN_THREADS workers and gains one every CONTROL_SECONDS while its workers are busy and the
+        rate limit of its endpoint family has headroom left. 429s, timeouts and server errors halve the pool, a rising
+        latency shrinks it by one
+        @param name: name of the stage e.g. the crawl function
+        @param family: endpoint family the stage requests
+        @param max_threads: upper bound of the pool, the number of started worker threads
+        """
+        self.name = name
+        self.family = family
+        self.max_threads = max(max_threads, 1)
+        self.limit = min(MIN_THREADS, self.max_threads)
+        self.active = 0
+        self.jobs_done = 0
+        self.baseline = None
+        self.window = {}
+        self.condition = threading.Condition()
+        self.started = self.last_control = self.last_status = time.time()
+        self.last_totals = stats.snapshot(family)
+        self.last_jobs = 0
+        self.stop_event = threading.Event()
+
+    @contextmanager
+    def slot(self):
+        """
+        Blocks the calling worker until the pool of the stage has a free slot
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.jobs_done += 1
+                self.condition.notify()
+
+    def adjust(self):
+        """
+        Resizes the pool according to the requests of the stage's family since the last call
+        @return: new pool size
+        """
+        now = time.time()
+        totals = stats.snapshot(self.family)
+        requests = totals["requests"] - self.last_totals["requests"]
+        errors = totals["errors"] - self.last_totals["errors"]
+        throttled = totals["throttled"] - self.last_totals["throttled"]
+        latency = (totals["latency"] - self.last_totals["latency"]) / requests if requests > 0 else None
+        elapsed = max(now - self.last_control, 1e-9)
+        headroom = pool.headroom(self.family) / max(len(pool.active()), 1)
+        self.window = {
+            "requests_per_second": requests / elapsed,
+            "jobs_per_second": (self.jobs_done - self.last_jobs) / elapsed,
+            "error_rate": (errors + throttled) / requests if requests > 0 else 0,
+            "latency_ms": None if latency is None else latency * 1000,
+            "headroom": headroom
+        }
+        self.last_totals = totals
+        self.last_jobs = self.jobs_done
+        self.last_control = now
+
+        with self.condition:
+            limit = self.limit
+            if throttled > 0 or self.window["error_rate"] > ERROR_THRESHOLD:
+                limit = max(int(limit * DECREASE_FACTOR), MIN_THREADS, 1)
+            elif latency is not None and self.baseline is not None and latency > self.baseline * LATENCY_FACTOR:
+                limit = max(limit - 1, MIN_THREADS, 1)
+            elif headroom > HEADROOM_THRESHOLD and self.active >= self.limit:
+                # threads only help while requests are not queued behind the rate limit
+                limit += 1
+            limit = min(limit, self.max_threads)
+            if limit != self.limit:
+                logger.debug(f"{self.name}: {self.limit} --> {limit} threads ({self.status_line()})")
+                self.limit = limit
+                self.condition.notify_all()
+        if latency is not None:
+            self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+        return self.limit
+
+    def status(self):
+        """
+        @return: dictionary with the pool size and throughput of the stage
+        """
+        return {"stage": self.name, "family": self.family, "threads": self.limit, "active": self.active,
+                "max_threads": self.max_threads, "jobs_done": self.jobs_done,
+                "jobs_per_second_total": self.jobs_done / max(time.time() - self.started, 1e-9), **self.window}
+
+    def status_line(self):
+        status = self.status()
+        latency = "?" if status.get("latency_ms") is None else f"{status['latency_ms']:.0f} ms"
+        return f"{status['threads']}/{status['max_threads']} threads, {status['active']} active, " \
+               f"{status['jobs_done']} jobs, {status.get('jobs_per_second', 0):.2f} jobs/s, " \
+               f"{status.get('requests_per_second', 0):.2f} req/s, {status.get('error_rate', 0):.1%} errors, " \
+               f"{latency}, {status.get('headroom', 0):.0%} headroom"
+
+    def control(self):
+        while not self.stop_event.wait(CONTROL_SECONDS):
+            try:
+                self.adjust()
+                if time.time() - self.last_status >= STATUS_SECONDS:
+                    self.last_status = time.time()
+                    logger.info(f"Stage {self.name}: {self.status_line()}")
+            except Exception:
+                logger.exception(f"Could not resize the pool of {self.name}")
+
+    def start(self):
+        threading.Thread(target=self.control, daemon=True).start()
+        controllers[self.name] = self
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        controllers.pop(self.name, None)
+        logger.info(f"Stage {self.name} finished: {self.status_line()}")
+
+
+# name --> controller of the stages that are running
+controllers = {}
+
+
+def stage_status():
+    """
+    @return: list of status dictionaries of the running stages
+    """
+    return [controller.status() for controller in list(controllers.values())]
@@ -0,0 +1,142 @@
+import configparser
+from datetime import datetime
+from distutils.util import strtobool
+
+from pymongo import UpdateOne
+
+import mongo_db as db
+from utils import logger, batch
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+
+INCREMENTAL = bool(strtobool(config["recrawl"]["Incremental"])) and bool(strtobool(config["mongoDB"]["UseMongo"]))
+SKIP_UNCHANGED = bool(strtobool(config["recrawl"]["SkipUnchanged"]))
+CONVERSATION_COLLECTION = config["mongoDB"]["ConversationCollection"]
+
+# packed search function --> kind of the summaries it maintains
+SUMMARY_KINDS = {"get_packed_replies": "replies", "get_packed_quotes": "quotes"}
+
+if INCREMENTAL:
+    db.create_collection(CONVERSATION_COLLECTION)
+
+
+def summary_id(kind, key):
+    return f"{kind}:{key}"
+
+
+def record(f_name, tweets, key_function):
+    """
+    Updates the summaries of the conversations or quoted tweets the tweets of a packed search page belong to
+    @param f_name: name of the packed search function
+    @param tweets: tweet objects of the page
+    @param key_function: returns the conversation id or quoted tweet id of a tweet
+    """
+    kind = SUMMARY_KINDS.get(f_name)
+    if not INCREMENTAL or kind is None:
+        return
+    summaries = {}
+    for res in tweets:
+        key = key_function(res)
+        if key is None:
+            continue
+        newest_id, newest_created_at, count = summaries.get(key, (0, "", 0))
+        summaries[key] = (max(newest_id, int(res["id"])), max(newest_created_at, res.get("created_at", "")), count + 1)
+    requests = [UpdateOne({"id": summary_id(kind, key)}, {
+        "$setOnInsert": {"kind": kind, "key": key},
+        "$max": {"newest_id": newest_id, "newest_created_at": newest_created_at},
+        "$inc": {"count": count}
+    }, upsert=True) for key, (newest_id, newest_created_at, count) in summaries.items()]
+    if len(requests) > 0:
+        db.db[CONVERSATION_COLLECTION].bulk_write(requests, ordered=False)
+
+
+def mark_crawled(f_name, items):
+    """
+    Stores the time of the crawl and the reply or quote count the crawl was based on once all pages of a packed query
+    have been processed
+    @param f_name: name of the packed search function
+    @param items: PackItems of the query
+    """
+    kind = SUMMARY_KINDS.get(f_name)
+    if not INCREMENTAL or kind is None:
+        return
+    now = datetime.utcnow()
+    # replies and quotes are always newer than the tweet they belong to, thus the key is the lower bound of since_id
+    db.db[CONVERSATION_COLLECTION].bulk_write([UpdateOne({"id": summary_id(kind, item.key)}, {
+        "$setOnInsert": {"kind": kind, "key": item.key, "count": 0, "newest_created_at": ""},
+        "$set": {"crawled_at": now, "metric": item.metric},
+        "$max": {"newest_id": int(item.key)}
+    }, upsert=True) for item in items], ordered=False)
+
+
+def search_id(event_id, terms, start, end):
+    """
+    @return: id of the summary of the hashtag and mention search of an event
+    """
+    return summary_id("search", f"{event_id}|{','.join(sorted(term.lower() for term in terms))}|{start}|{end}")
+
+
+def newest_searched(key):
+    """
+    @param key: id of the summary of a search, see search_id
+    @return: id of the newest tweet a complete run of the search found, none if it was not searched completely before
+    """
+    if not INCREMENTAL:
+        return None
+    summary = db.db[CONVERSATION_COLLECTION].find_one({"id": key}, {"newest_id": 1})
+    return None if summary is None else summary.get("newest_id")
+
+
+def mark_searched(key, newest_id):
+    """
+    Stores the newest tweet of a search once all its pages have been processed, a later crawl of the event only
+    searches the tweets that are newer
+    @param key: id of the summary of the search, see search_id
+    @param newest_id: id of the newest tweet the search found
+    """
+    if not INCREMENTAL or not newest_id:
+        return
+    db.db[CONVERSATION_COLLECTION].update_one({"id": key}, {
+        "$setOnInsert": {"kind": "search"},
+        "$set": {"crawled_at": datetime.utcnow()},
+        "$max": {"newest_id": int(newest_id)}
+    }, upsert=True)
+
+
+def refresh(f_name, items):
+    """
+    Turns searches of conversations or quotes that were crawled before into searches of the new tweets only. Searches
+    whose reply or quote count did not change since the last crawl are left out if SkipUnchanged = true
+    @param f_name: name of the packed search function
+    @param items: PackItems whose weight is the current reply or quote count
+    @return: list of PackItems to crawl, refreshed ones have a since_id
+    """
+    kind = SUMMARY_KINDS.get(f_name)
+    if not INCREMENTAL or kind is None or len(items) == 0:
+        return items
+    summaries = {}
+    for id_batch in batch([summary_id(kind, item.key) for item in items], 1000):
+        for summary in db.read({"id": {"$in": id_batch}, "crawled_at": {"$exists": True}}, CONVERSATION_COLLECTION,
+                               {"key": 1, "newest_id": 1, "metric": 1}):
+            summaries[summary["key"]] = summary
+    remaining = []
+    unchanged = 0
+    for item in items:
+        summary = summaries.get(item.key)
+        if summary is None:
+            remaining.append(item)
+            continue
+        last_metric = summary.get("metric")
+        if SKIP_UNCHANGED and item.weight is not None and item.weight == last_metric:
+            unchanged += 1
+            continue
+        item.since_id = str(summary["newest_id"])
+        if item.weight is not None and last_metric is not None:
+            # only the new replies or quotes are expected
+            item.weight = max(item.weight - last_metric, 1)
+        remaining.append(item)
+    if len(summaries) > 0:
+        logger.info(f"{len(summaries)} of {len(items)} {kind} searches were crawled before --> {unchanged} unchanged "
+                    f"skipped, {len(summaries) - unchanged} crawled since their newest tweet")
+    return remaining
@@ -0,0 +1,187 @@
+import contextvars
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from caches import AuthorCache
+
+
+class CrawlContext:
+    def __init__(self, event_id="", author_cache=None, weight=1.0):
+        """
+        State of the crawl of one event. Every thread works on the context of the event it crawls, thus several events
+        can be crawled in one process without mixing their caches
+        @param event_id: uid of the event, stored with every crawled document
+        @param author_cache: AuthorCache of the event, an unbounded one if none is given
+        @param weight: share of the rate limits and of the request budget the event gets relative to the other events
+        """
+        self.event_id = event_id
+        self.weight = weight
+        self.author_cache = AuthorCache() if author_cache is None else author_cache
+        # quote tweets whose subtrees still have to be crawled
+        self.tweet_cache = []
+        self.hashtag_cache = set()
+        # id of the newest tweet the hashtag search of the context found
+        self.hashtag_newest = 0
+        # CompiledSearch the hashtag search of the context serves, see plan_compiler
+        self.search = None
+        # conversation id --> uids of the events of the compiled search that matched it
+        self.search_events = {}
+        # ids of authors whose profiles have been requested by a pipeline worker
+        self.requested_users = set()
+        # seed tweet id --> reply count of seeds hydrated in batches
+        self.seed_cache = {}
+        # packed query --> number of results routed to each of its clauses
+        self.query_routes = {}
+        # packed query --> id of the oldest result it returned
+        self.query_oldest = {}
+        self.stage = "waiting"
+        self.progress = Counter()
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CrawlContext {self.event_id} ({self.stage})"
+
+    def count(self, key, n=1):
+        """
+        @param key: name of the progress counter e.g. requests
+        @param n: increment
+        """
+        with self.lock:
+            self.progress[key] += n
+
+    def reset(self):
+        """
+        Clears the caches after the crawl of the event
+        """
+        self.author_cache.clear()
+        self.tweet_cache.clear()
+        self.hashtag_cache.clear()
+        self.hashtag_newest = 0
+        self.search_events.clear()
+        self.requested_users.clear()
+        self.seed_cache.clear()
+        self.query_routes.clear()
+        self.query_oldest.clear()
+
+    def status_line(self):
+        elapsed = 0 if self.started is None else (self.finished or time.time()) - self.started
+        m, s = divmod(int(elapsed), 60)
+        return f"{self.event_id:<6} {self.stage:<24} {self.progress['requests']:>7} requests " \
+               f"{self.progress['tweets']:>9} tweets {self.progress['users']:>8} users {m:4d}:{s:02d} m/s"
+
+
+# context of threads that do not crawl a specific event, e.g. the reaction and follower stages
+default_context = CrawlContext()
+current = contextvars.ContextVar("crawl_context", default=default_context)
+
+
+def context():
+    """
+    @return: CrawlContext of the event the calling thread crawls
+    """
+    return current.get()
+
+
+@contextmanager
+def activate(crawl_context):
+    """
+    Makes the calling thread work on the given context
+    @param crawl_context: CrawlContext
+    """
+    token = current.set(crawl_context)
+    try:
+        yield crawl_context
+    finally:
+        current.reset(token)
+
+
+def submit(executor, fn, *args):
+    """
+    Submits a function to a thread pool, it runs in the context of the submitting thread
+    @return: future
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def thread(target, args=(), **kwargs):
+    """
+    @return: thread that runs the target in the context of the creating thread
+    """
+    return threading.Thread(target=contextvars.copy_context().run, args=(target, *args), **kwargs)
+
+
+class FairShare:
+    def __init__(self):
+        """
+        Weighted fair queueing of the requests of concurrently crawled events per endpoint family. Of the events that
+        wait for a permit of a family, the one that used the fewest permits relative to its weight goes first, thus a
+        large event does not starve small ones and idle quota is used by whichever event has work
+        """
+        self.condition = threading.Condition()
+        # family --> event id --> permits used
+        self.used = defaultdict(Counter)
+        # family --> event id --> number of waiting requests
+        self.waiting = defaultdict(Counter)
+        self.weights = {}
+
+    def virtual_time(self, family, event_id):
+        return self.used[family][event_id] / self.weights.get(event_id, 1.0)
+
+    def next_in_line(self, family, event_id):
+        own = self.virtual_time(family, event_id)
+        return all(own <= self.virtual_time(family, other) for other in self.waiting[family])
+
+    def acquire(self, family, reserve):
+        """
+        Takes a permit for the event of the calling thread once it is next in line for the family. The turn is only
+        held while a permit is tried without blocking, the wait for the rate limit happens outside of it. The event
+        keeps its place in line meanwhile, thus it goes first once a permit is available again
+        @param family: endpoint family
+        @param reserve: function family --> tuple (permit or none, seconds to wait or none if no permit will become
+        available) e.g. CredentialPool.reserve
+        @return: permit, none if no permit will become available
+        """
+        crawl_context = context()
+        event_id = crawl_context.event_id
+        with self.condition:
+            self.weights[event_id] = crawl_context.weight
+            if event_id not in self.used[family]:
+                # an event that starts late begins at the level of the slowest event instead of taking over the family
+                known = [self.virtual_time(family, other) for other in self.used[family]]
+                self.used[family][event_id] = min(known, default=0) * crawl_context.weight
+            self.waiting[family][event_id] += 1
+            try:
+                while True:
+                    wait = None
+                    if self.next_in_line(family, event_id):
+                        permit, wait = reserve(family)
+                        if permit is not None:
+                            self.used[family][event_id] += 1
+                            return permit
+                        if wait is None:
+                            return None
+                    # releases the turn while waiting, a taken permit or a finished event wakes the waiting threads
+                    self.condition.wait(wait)
+            finally:
+                self.waiting[family][event_id] -= 1
+                if self.waiting[family][event_id] <= 0:
+                    del self.waiting[family][event_id]
+                self.condition.notify_all()
+
+    def forget(self, event_id):
+        """
+        Removes a finished event, it no longer holds back the others
+        @param event_id: uid of the event
+        """
+        with self.condition:
+            for used in self.used.values():
+                used.pop(event_id, None)
+            self.weights.pop(event_id, None)
+            self.condition.notify_all()
+
+
+fair_share = FairShare()
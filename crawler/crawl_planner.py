@@ -0,0 +1,239 @@
+import configparser
+import inspect
+import math
+from distutils.util import strtobool
+
+from api_endpoints import ApiEndpoints
+from search_shards import parse_time, format_time, SEARCH_SLICES, MAX_SLICE_PAGES
+from utils import logger, decode_json
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+planner_config = config["planner"]
+
+MONTHLY_TWEET_CAP = int(planner_config["MonthlyTweetCap"])
+DRY_RUN = bool(strtobool(planner_config["DryRun"]))
+PLAN_TIMELINES = bool(strtobool(planner_config["PlanTimelines"]))
+ORDER = planner_config["Order"]
+
+# full-archive searches of hashtags, keywords and timelines return up to 500 tweets per page
+SEARCH_PAGE_SIZE = 500
+
+api = ApiEndpoints()
+
+
+class QueryPlan:
+    def __init__(self, name, query, start, end, buckets, job=None):
+        """
+        Volume estimate of one full-archive search
+        @param name: name of the search in the report e.g. the event uid
+        @param query: full-archive search query
+        @param start: start of the time window in api format
+        @param end: end of the time window in api format
+        @param buckets: list of tuples (start, end, tweet count) in api format, oldest first. None if the counts could
+        not be retrieved
+        @param job: object the search is crawled for e.g. an EventSearch or a user document
+        """
+        self.name = name
+        self.query = query
+        self.start = start
+        self.end = end
+        self.buckets = buckets
+        self.job = job
+        self.total = None if buckets is None else sum(count for _, _, count in buckets)
+        self.slices = None if buckets is None else slice_boundaries(buckets)
+
+    def __repr__(self):
+        return f"Plan {self.name}: ~{self.total} tweets in {self.pages()} pages"
+
+    def pages(self):
+        """
+        @return: estimated number of search requests, none if unknown
+        """
+        if self.total is None:
+            return None
+        return sum(max(math.ceil(count / SEARCH_PAGE_SIZE), 1) for count in self.slice_counts())
+
+    def slice_counts(self):
+        """
+        @return: estimated number of tweets of every slice
+        """
+        return [sum(count for b_start, b_end, count in self.buckets if b_start >= s_start and b_end <= s_end)
+                for s_start, s_end in self.slices]
+
+    def quota_share(self):
+        """
+        @return: share of the monthly usage cap the search will use, none if unknown
+        """
+        if self.total is None:
+            return None
+        return self.total / MONTHLY_TWEET_CAP
+
+
+def count_buckets(query, start, end):
+    """
+    Retrieves the daily tweet counts of a full-archive query. Counts do not use the monthly usage cap
+    @param query: full-archive search query
+    @param start: start of the time window in api format
+    @param end: end of the time window in api format
+    @return: list of tuples (start, end, tweet count) oldest first, none if the counts could not be retrieved
+    """
+    buckets = []
+    next_token = None
+    while True:
+        response = api.get_tweet_counts(query, start, end, next_token=next_token)
+        if response.status_code != 200:
+            logger.warning(f"Could not count tweets of query {query} --> no estimate")
+            return None
+        page = decode_json(response.content)
+        for bucket in page.get("data", []):
+            buckets.append((format_time(parse_time(bucket["start"])), format_time(parse_time(bucket["end"])),
+                            bucket["tweet_count"]))
+        next_token = page.get("meta", {}).get("next_token")
+        if next_token is None:
+            break
+    buckets.sort()
+    return buckets
+
+
+def slice_boundaries(buckets, num_slices=SEARCH_SLICES, max_pages=MAX_SLICE_PAGES):
+    """
+    Chooses time slices of roughly equal volume from the daily counts. A slice holds at most max_pages pages, thus it is
+    not re-split during the crawl, and leading or trailing days without tweets are left out, thus no request is spent on
+    them. A single day that exceeds max_pages becomes a slice of its own and is split at crawl time
+    @param buckets: list of tuples (start, end, tweet count) oldest first
+    @param num_slices: number of slices a search should be divided into at least if its volume allows
+    @param max_pages: maximum number of pages of a slice
+    @return: list of tuples (start, end) in api format, most recent slice first like search_shards.time_slices
+    """
+    total = sum(count for _, _, count in buckets)
+    target = min(max(math.ceil(total / max(num_slices, 1)), SEARCH_PAGE_SIZE), max_pages * SEARCH_PAGE_SIZE)
+    slices = []
+    slice_start = slice_end = None
+    slice_count = 0
+    for b_start, b_end, count in buckets:
+        if count == 0 and slice_start is None:
+            continue
+        if slice_start is not None and slice_count + count > target:
+            slices.append((slice_start, slice_end))
+            slice_start = None
+            slice_count = 0
+            if count == 0:
+                continue
+        if slice_start is None:
+            slice_start = b_start
+        if count > 0:
+            slice_end = b_end
+        slice_count += count
+    if slice_start is not None and slice_count > 0:
+        slices.append((slice_start, slice_end))
+    return slices[::-1]
+
+
+def default_window(crawl_function):
+    """
+    @param crawl_function: full-archive search function with start_date and end_date parameters
+    @return: tuple (start, end) of the default time window of the crawl function
+    """
+    defaults = inspect.signature(crawl_function).parameters
+    return defaults["start_date"].default, defaults["end_date"].default
+
+
+def plan_events(events):
+    """
+    Estimates the hashtag and mention searches of events. Events without hashtags or mentions only crawl the
+    conversation of their seed tweet and are not estimated
+    @param events: list of EventSearch objects
+    @return: list of QueryPlans in processing order
+    """
+    plans = []
+    for event in events:
+        if event.tag_and_mention is None:
+            plans.append(QueryPlan(event.uid, None, event.start_date, None, None, job=event))
+            continue
+        start, end = event.window()
+        query = ApiEndpoints.hashtag_query(event.tag_and_mention)
+        plans.append(QueryPlan(event.uid, query, start, end, count_buckets(query, start, end), job=event))
+    return order(plans)
+
+
+def plan_searches(searches):
+    """
+    Estimates the searches compiled from the hashtags and mentions of several events
+    @param searches: list of plan_compiler.CompiledSearches
+    @return: list of QueryPlans in processing order
+    """
+    plans = []
+    for search in searches:
+        query = search.query()
+        plans.append(QueryPlan(search.name(), query, search.start, search.end,
+                               count_buckets(query, search.start, search.end), job=search))
+    return order(plans)
+
+
+def plan_keywords(keywords):
+    """
+    Estimates keyword searches within the default window of the keyword search
+    @param keywords: list of exact phrases
+    @return: list of QueryPlans in processing order
+    """
+    start, end = default_window(api.get_keyword_archive_search)
+    return order([QueryPlan(keyword, f'"{keyword}"', start, end, count_buckets(f'"{keyword}"', start, end),
+                            job=keyword) for keyword in keywords])
+
+
+def plan_timelines(users):
+    """
+    Estimates timeline searches within the default window of the timeline search. A page of daily counts covers 31
+    days, thus a long window costs several requests per user. They use the counts rate limit, which is independent of
+    the rate limit of the search
+    @param users: user documents with an id
+    @return: list of QueryPlans in processing order
+    """
+    start, end = default_window(api.get_timeline_archive_search)
+    return order([QueryPlan(user["id"], f"from:{user['id']}", start, end,
+                            count_buckets(f"from:{user['id']}", start, end), job=user) for user in users])
+
+
+def order(plans):
+    """
+    Sorts plans by their estimated volume. Order = cheapest crawls as many searches as possible before the usage cap is
+    reached, Order = largest starts with the most expensive ones. Searches without an estimate are crawled first
+    @param plans: list of QueryPlans
+    @return: sorted list of QueryPlans
+    """
+    def key(plan):
+        if plan.total is None:
+            return False, 0
+        return True, -plan.total if ORDER == "largest" else plan.total
+
+    return sorted(plans, key=key)
+
+
+def report(plans):
+    """
+    Logs the estimated volume of each search in processing order and warns about searches that would exceed the
+    monthly usage cap
+    @param plans: list of QueryPlans in processing order
+    @return: report as string
+    """
+    lines = [f"{'search':<24} {'window':<43} {'tweets':>10} {'pages':>7} {'slices':>6} {'cap %':>7} {'total %':>7}"]
+    cumulative = 0
+    exceeds = []
+    for plan in plans:
+        window = f"{plan.start} - {plan.end}" if plan.end is not None else "seed conversation"
+        if plan.total is None:
+            lines.append(f"{plan.name:<24} {window:<43} {'?':>10} {'?':>7} {'?':>6} {'?':>7} {'?':>7}")
+            continue
+        cumulative += plan.quota_share()
+        lines.append(f"{plan.name:<24} {window:<43} {plan.total:>10} {plan.pages():>7} {len(plan.slices):>6} "
+                     f"{plan.quota_share() * 100:>7.2f} {cumulative * 100:>7.2f}")
+        if cumulative > 1:
+            exceeds.append(plan.name)
+    lines.append(f"Estimates cover the searches only, replies and quotes of the found conversations come on top. "
+                 f"Monthly cap: {MONTHLY_TWEET_CAP} tweets")
+    text = "\n".join(lines)
+    logger.info(f"Crawl plan:\n{text}")
+    if len(exceeds) > 0:
+        logger.warning(f"Monthly usage cap is reached before the searches {exceeds} are crawled")
+    return text
@@ -1,74 +1,114 @@
+import asyncio
+import contextvars
+import inspect
 import json
 import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from distutils.util import strtobool
 
+import requests
 import simplejson.errors
+import checkpoints
+import concurrency
+import conversations
+import crawl_planner
+import follower_planner
+import plan_compiler
 import mongo_db as db
+import seen_filter
+from frontier import frontier, worker_name, USE_FRONTIER, POLL_SECONDS
+from ingestion import ingestion, WRITE_BEHIND
 from api_endpoints import ApiEndpoints
+from caches import AuthorCache, MongoSpill, cache_tweets, cache_lock
+from crawl_context import CrawlContext, context, activate, submit, thread, default_context, fair_share
+from priority import ExpansionQueue, budget, rank_tweets, tweet_score, BATCH_SIZE
+from query_packer import conversation_item, quote_item, conversation_key, quoted_key, pack, split, by_score, \
+    build_query, since_id, until_id, MAX_PACKED_PAGES
+from response_lake import lake, STORE_RESPONSES
+from search_shards import time_slices, remaining_window, parse_time, format_time, SEARCH_SLICES, TIMELINE_SLICES, \
+    SHARD_WORKERS, MAX_SLICE_PAGES
 from utils import *
-from threading import Thread
 
 api = ApiEndpoints()
 
 config = configparser.ConfigParser()
 config.read("../config.ini")
 mongo_config = config["mongoDB"]
-
-tweet_func = {"get_seed", "get_replies", "get_quotes", "get_timeline_archive_search", "get_keyword_archive_search"}
+CRAWL_ENGINE = config["crawler"]["Engine"]
+COMPLETE_TREE = bool(strtobool(config["twitter"]["CompleteTree"]))
+PIPELINE_WORKERS = int(config["pipeline"]["Workers"])
+PACKED_WORKERS = int(config["pipeline"]["PackedWorkers"])
+MAX_CACHED_TWEETS = int(config["caches"]["MaxCachedTweets"])
+CRAWL_EVENTS = bool(strtobool(config["events"]["CrawlEvents"]))
+COMPILE_EVENTS = bool(strtobool(config["events"]["CompileEvents"]))
+EVENT_WORKERS = int(config["events"]["Workers"])
+EVENTS_BUDGET = int(config["events"]["Budget"])
+PROGRESS_SECONDS = float(config["events"]["ProgressSeconds"])
+RETRIES = int(config["http"]["Retries"])
+RETRY_SECONDS = float(config["http"]["RetrySeconds"])
+
+tweet_func = {"get_seed", "get_tweets_by_id", "get_replies", "get_quotes", "get_packed_replies", "get_packed_quotes",
+              "get_timeline_archive_search", "get_keyword_archive_search"}
+seed_func = {"get_seed", "get_tweets_by_id"}
+quote_func = {"get_quotes", "get_packed_quotes"}
+# packed searches and the function that routes a result back to the clause it matched
+packed_func = {"get_packed_replies": conversation_key, "get_packed_quotes": quoted_key}
 user_func = {"get_users_by_id"}
 timeline_func = {"get_timeline_archive_search", "get_timeline", "get_keyword_archive_search"}
 hashtag_func = "get_tweets_by_hashtag_or_mention"
 follow_func = {"get_followers", "get_following"}
 reaction_func = {"get_liking_users", "get_retweeting_users"}
+# frontier job type of a threaded stage --> crawl function and the field that is set after a successful crawl
+STAGES = {"likes": ("get_liking_users", "likes_crawled"), "retweets": ("get_retweeting_users", "retweets_crawled"),
+          "timeline": ("get_timeline_archive_search", "timeline_crawled"),
+          "keyword": ("get_keyword_archive_search", "keyword"), "follows": ("get_followers", "followers_crawled"),
+          "following": ("get_following", "following_crawled")}
+STAGE_JOBS = {f_name: job_type for job_type, (f_name, _) in STAGES.items()}
+# crawl function of a threaded stage --> endpoint family whose rate limit and errors size the stage's pool
+STAGE_FAMILIES = {"get_liking_users": "liking_users", "get_retweeting_users": "retweeted_by",
+                  "get_timeline_archive_search": "search_all", "get_keyword_archive_search": "search_all",
+                  "get_followers": "followers", "get_following": "following"}
+# status returned by handle_response if the next page of a paginated request should be crawled
+NEXT_PAGE = "NEXT_PAGE"
+# status returned by iterative_crawl if a crawl reached its maximum number of pages
+TOO_DEEP = "TOO_DEEP"
+# status returned by handle_response if the request failed without rate limit information and should be repeated
+RETRY = "RETRY"
 
 TIMELINE_COLLECTION = mongo_config["TimelineCollection"]
 USER_COLLECTION = mongo_config["UserCollection"]
 TWEET_COLLECTION = mongo_config["TweetCollection"]
 FOLLOWER_COLLECTION = mongo_config["FollowerCollection"]
+SPILL_COLLECTION = mongo_config["SpillCollection"]
 
-if not bool(strtobool(mongo_config["UseMongo"])):
+USE_MONGO = bool(strtobool(mongo_config["UseMongo"]))
+if not USE_MONGO:
     out_file = open("../output/example.json", "w")
-author_cache = {}
-tweet_cache = []
-hashtag_cache = set()
-event_id = ""
-
-
-class Tweet:
-    def __init__(self, tweet_id, public_metrics):
-        self.id = tweet_id
-        self.reply_count = public_metrics["reply_count"]
-        self.retweet_count = public_metrics["retweet_count"]
-        self.like_count = public_metrics["like_count"]
-        self.quote_count = public_metrics["quote_count"]
-        self.quotes_retrieved = False
-        self.likes_retrieved = False
-        self.retweets_retrieved = False
-
-    def __repr__(self):
-        return f"Tweet-ID {self.id} has {self.reply_count} replies, {self.retweet_count} retweet(s), " \
-               f"{self.quote_count} quote(s) and {self.like_count} like(s)"
-
-    def sum_metric_count(self):
-        return self.reply_count + self.quote_count
-
+else:
+    db.create_collection(SPILL_COLLECTION)
+if WRITE_BEHIND:
+    # replays the pages a crashed process did not write before anything is crawled
+    ingestion.start()
+# state of the time slice the calling thread crawls, see sharded_crawl
+current_slice = contextvars.ContextVar("current_slice", default=None)
 
-class User:
-    def __init__(self, user_id):
-        self.id = user_id
-        self.username = str
-        self.tweets = []
-        self.user_retrieved = False
 
-    def __repr__(self):
-        return f"User {self.username} with id {self.id} published the following tweets {self.tweets}"
+def new_context(event_id, weight=1.0, max_tweets=MAX_CACHED_TWEETS):
+    """
+    @param event_id: uid of the event
+    @param weight: share of the rate limits and of the request budget relative to other concurrently crawled events
+    @param max_tweets: bound of the author cache of the event
+    @return: CrawlContext with a bounded author cache that spills to the db
+    """
+    spill = MongoSpill(db.db[SPILL_COLLECTION]) if USE_MONGO else None
+    return CrawlContext(event_id, AuthorCache(max_tweets, spill), weight)
 
-    def add_tweet(self, tweet):
-        self.tweets.append(tweet)
 
-    def set_username(self, username):
-        self.username = username
+# the reaction and follower stages and single events crawled without the event runner share the default context
+default_context.author_cache = new_context("").author_cache
 
 
 def write_file(response, output_file):
@@ -87,98 +127,81 @@ def write_file(response, output_file):
 def process_result(response, f_name, params=None):
     """
     Processes the results of a request to the twitter api. Differentiates between methods that made requests and handles
-    them accordingly
+    them accordingly. Bookkeeping is done per page: one crawl timestamp for all records of the page, which are written
+    with upserts in one bulk write
     @param response: to the request made to the api
     @param f_name: function name that made the request and specifies further processing steps
     @param params: parameters of the request that has been made
     """
+    ctx = context()
     logger.info(f'Processing results of {f_name}...')
     if "data" not in response:
         logger.warning(f"Empty response returned from {f_name} --> skip")
         logger.warning(response)
         return
+    includes = response.get("includes", {})
     response = response["data"]
+    crawl_timestamp = datetime.now()
+    slice_state = current_slice.get()
+    if slice_state is not None:
+        track_slice(response, slice_state)
     if f_name == hashtag_func:
-        if bool(strtobool(config["twitter"]["CompleteTree"])):
-            for res in response:
-                hashtag_cache.add(res["conversation_id"])
-                logger.info(f"Added new conversation_id {res['conversation_id']} to local cache for complete "
-                            f"conversation tree crawl")
+        key_field = "conversation_id" if COMPLETE_TREE else "id"
+        for res in response:
+            ctx.hashtag_cache.add(res[key_field])
+        with ctx.lock:
+            ctx.hashtag_newest = max([ctx.hashtag_newest] + [int(res["id"]) for res in response])
+        if COMPLETE_TREE:
+            logger.info(f"Added {len(response)} conversation_ids to local cache for complete conversation tree crawl")
         else:
-            for res in response:
-                hashtag_cache.add(res["id"])
-                logger.info(f"Added new id {res['id']} to local cache for crawling all children of this tweet")
+            logger.info(f"Added {len(response)} ids to local cache for crawling all children of these tweets")
+        if ctx.search is not None:
+            with ctx.lock:
+                for res in response:
+                    ctx.search_events.setdefault(res[key_field], set()).update(ctx.search.match(res))
         return
     if f_name in timeline_func:
         logger.info(f"Inserting timeline tweets to db {TIMELINE_COLLECTION}")
-        db.insert(response, TIMELINE_COLLECTION)
+        write_page(response, TIMELINE_COLLECTION, {})
         return
     if f_name in reaction_func:
         logger.info(f"Inserting reaction to tweets ino db")
         update_field = "liked" if f_name == "get_liking_users" else "retweeted"
         for res in response:
-            found_user = db.read({"id": res["id"]}, USER_COLLECTION, {"id": 1, "event_id": 1})
-            found = add_event_id(TWEET_COLLECTION, res, found_user)
-            if found:
-                # logger.info("Found user in DB, also update tweet ids to liked/retweet fields")
-                db.push_to_array(res["id"], update_field, params["tweet_id"], USER_COLLECTION)
-            else:
-                # logger.info(f"New user {res['id']}--> Create and update")
-                res["event_id"] = [event_id]
-                res["liked"] = []
-                res["retweeted"] = []
-                db.insert([res], USER_COLLECTION)
-                db.push_to_array(res["id"], update_field, params["tweet_id"], USER_COLLECTION)
+            res["liked"] = []
+            res["retweeted"] = []
+        write_page(response, USER_COLLECTION, {"event_id": ctx.event_id, update_field: params["tweet_id"]})
         return
     if f_name in follow_func:
         logger.info(f"Inserting followers/following of users into db")
         update_field = "following" if f_name == "get_followers" else "followed_by"
         for res in response:
-            # res["seed"] = SEED_TWEET_ID
-            res["crawl_timestamp"] = datetime.now()
-            found_user = db.read({"id": res["id"]}, FOLLOWER_COLLECTION)
-            if len(list(found_user)) > 0:
-                # logger.info("Found user in DB")
-                db.push_to_array(res["id"], update_field, params["user_id"], FOLLOWER_COLLECTION)
-            else:
-                # logger.info(f"New user {res['id']}--> Create and update")
-                res["following"] = []
-                res["followed_by"] = []
-                db.insert([res], FOLLOWER_COLLECTION)
-                db.push_to_array(res["id"], update_field, params["user_id"], FOLLOWER_COLLECTION)
+            res["crawl_timestamp"] = crawl_timestamp
+            res["following"] = []
+            res["followed_by"] = []
+        write_page(response, FOLLOWER_COLLECTION, {update_field: params["user_id"]})
         return
-    for res in response:
-        res["crawl_timestamp"] = datetime.now()
-        if f_name in tweet_func:
+    if f_name in tweet_func:
+        collection = TWEET_COLLECTION
+        for res in response:
             # tweet object
-            res["event_id"] = [event_id]
+            res["crawl_timestamp"] = crawl_timestamp
             res["likes_crawled"] = False
             res["retweets_crawled"] = False
-
-            if f_name == "get_quotes":
-                tweet_cache.append(Tweet(res["id"], res["public_metrics"]))
-            if res["author_id"] not in author_cache:
-                # new user --> add to cache
-                new_user = User(res["author_id"])
-                new_user.add_tweet(Tweet(res["id"], res["public_metrics"]))
-                author_cache[res["author_id"]] = new_user
-            else:
-                # user existing in cache
-                existing_user = author_cache[res["author_id"]]
-                self_quoting = False
-                for existing_tweet in existing_user.tweets:
-                    if existing_tweet.id == res["id"]:
-                        # Tweet already in cache, don't add self-quoting tweet again see
-                        # https://twittercommunity.com/t/self-quoting-tweet-bug/168436
-                        self_quoting = True
-                if not self_quoting:
-                    existing_user.add_tweet(Tweet(res["id"], res["public_metrics"]))
-            # Check if tweet is already in db and if yes, add current event id
-            found_tweet = db.read({"id": res["id"]}, TWEET_COLLECTION, {"id": 1, "event_id": 1})
-            add_event_id(TWEET_COLLECTION, res, found_tweet)
-        if f_name in user_func:
+        cache_tweets(response, ctx.author_cache, ctx.tweet_cache, quotes=f_name in quote_func)
+        if f_name in seed_func:
+            for res in response:
+                ctx.seed_cache[res["id"]] = res["public_metrics"]["reply_count"]
+        if f_name in packed_func:
+            route_results(response, packed_func[f_name], params["query"])
+            conversations.record(f_name, response, packed_func[f_name])
+        if "users" in includes:
+            ingest_authors(response, includes["users"])
+    elif f_name in user_func:
+        collection = USER_COLLECTION
+        for res in response:
             # user object
-            res["event_id"] = [event_id]
+            res["crawl_timestamp"] = crawl_timestamp
             res["followers_crawled"] = False
             res["following_crawled"] = False
             res["timeline_crawled"] = False
@@ -186,152 +209,313 @@ def process_result(response, f_name, params=None):
             res["retweeted"] = []
 
             # regular user response
-            # author_cache[res["id"]].set_username(res["username"])
-            # author_cache[res["id"]].user_retrieved = True
-
-            # Check if user is already in db and if yes, add current event id
-            found_user = db.read({"id": res["id"]}, USER_COLLECTION, {"id": 1, "event_id": 1})
-            add_event_id(USER_COLLECTION, res, found_user)
-
-    if f_name in tweet_func:
-        collection = TWEET_COLLECTION
-    elif f_name in user_func:
-        collection = USER_COLLECTION
+            with cache_lock:
+                author = ctx.author_cache.get(res["id"])
+                if author is not None:
+                    author.set_username(res["username"])
+                    author.followers_count = res.get("public_metrics", {}).get("followers_count", 0)
+                    author.user_retrieved = True
     else:
         logger.warning(f"No suitable collection in db found for {f_name}")
         collection = "default"
-    # insert to db
-    db.insert(response, collection)
+    # new tweets/users are inserted, the current event id is added to stored ones
+    write_page(response, collection, {"event_id": ctx.event_id})
+    if collection in (TWEET_COLLECTION, USER_COLLECTION):
+        ctx.count("tweets" if collection == TWEET_COLLECTION else "users", len(response))
+
+
+def ingest_authors(tweets, users):
+    """
+    Stores the authors returned inline (includes.users) with a page of tweets, thus they don't have to be retrieved in a
+    separate user request. Users that are only referenced by the tweets are not part of the conversation and skipped
+    @param tweets: tweet objects of a page
+    @param users: user objects of the includes block
+    """
+    author_ids = {res["author_id"] for res in tweets}
+    authors = [res for res in users if res["id"] in author_ids]
+    if len(authors) > 0:
+        process_result({"data": authors}, "get_users_by_id")
 
 
-def add_event_id(collection, response, found_elem):
+def track_slice(tweets, slice_state):
     """
-    Check if user is already in db and if yes, add current event id (if non-existent in array)
+    Remembers the oldest tweet crawled in a time slice, it marks where a slice has to be re-split
+    @param tweets: tweet objects of a page
+    @param slice_state: dictionary of the time slice with the creation date of its oldest tweet
+    """
+    created = [res["created_at"] for res in tweets if "created_at" in res]
+    if len(created) > 0:
+        oldest = slice_state["oldest"]
+        slice_state["oldest"] = min(created) if oldest is None else min(oldest, min(created))
+
+
+def route_results(tweets, key_function, query):
+    """
+    Counts the results of a packed query per clause they belong to
+    @param tweets: tweet objects of a page
+    @param key_function: returns the key of the clause a tweet matched
+    @param query: packed query that returned the tweets
+    """
+    ctx = context()
+    hits = ctx.query_routes.setdefault(query, {})
+    for res in tweets:
+        key = key_function(res)
+        hits[key] = hits.get(key, 0) + 1
+    if len(tweets) > 0:
+        oldest = min((res["id"] for res in tweets), key=int)
+        ctx.query_oldest[query] = min(ctx.query_oldest.get(query, oldest), oldest, key=int)
+
+
+def find_existing(records, collection, return_attr=None):
+    """
+    Looks up which records of a page are already stored in the db using a single query. Records that are certainly new
+    according to the seen filter of the collection are not looked up. If one of the others is still queued for the
+    writers, the queue is drained first
+    @param records: tweet or user objects of a page
+    @param collection: db collection to search in
+    @param return_attr: optional dictionary of return attributes that should be present in result
+    @return: dictionary of id --> stored document
+    """
+    ids = seen_filter.maybe_stored([res["id"] for res in records], collection)
+    if len(ids) == 0:
+        return {}
+    if ingestion.is_queued(ids, collection):
+        ingestion.drain()
+    return {elem["id"]: elem for elem in db.read({"id": {"$in": ids}}, collection, return_attr)}
+
+
+def write_page(records, collection, sets):
+    """
+    Upserts the records of a page with one bulk write and adds them to the seen filter of the collection. Records that
+    are stored already keep their fields, the values of sets are added to their arrays. With WriteBehind the page is
+    handed to the writers of the ingestion and written while the crawl continues, see ingestion
+    @param records: tweet or user objects
+    @param collection: db collection to write to
+    @param sets: dictionary field --> value to add to the array of the field e.g. the current event id
+    """
+    ingestion.submit(records, collection, sets)
+
+
+def add_event_ids(collection, found_elems):
+    """
+    Adds current event id to all documents found in db (if non-existent in their array)
     @param collection: db collection to which the event id should be added
-    @param response: object returned from request with user
-    @param found_elem: user that was found in database matching id
-    @return True if a user was actually found, false if no user found in db
-    """
-    if found_elem.count() > 0:
-        for elem in found_elem:
-            events_stored = (elem["event_id"])
-            if event_id not in events_stored:
-                logger.info(
-                    f"{collection} with id {response['id']} already in DB. Add current event id {event_id} to user/tweet")
-                db.push_to_array(response["id"], field="event_id", value=event_id, collection_name=collection)
-                break
-        return True
-    return False
+    @param found_elems: documents that were found in database
+    """
+    ctx = context()
+    missing = [elem["id"] for elem in found_elems if ctx.event_id not in elem.get("event_id", [])]
+    if len(missing) > 0:
+        logger.info(f"{len(missing)} {collection} document(s) already in DB. Add current event id {ctx.event_id}")
+        db.push_to_arrays(missing, field="event_id", value=ctx.event_id, collection_name=collection)
 
 
-def iterative_crawl(crawl_function, params):
+def handle_response(f_name, params, response):
+    """
+    Evaluates the response of a single request. Processes its data, prepares the next page if a next token is present
+    and handles rate limit restrictions as well as certain errors
+    @param f_name: name of the crawl function that made the request
+    @param params: parameters for the api request, next_token is updated in place
+    @param response: response of the request
+    @return: NEXT_PAGE if the next page should be requested, none if crawl finished successful, USAGE_CAP, RETRY if
+    the request failed and should be repeated or the time to wait until next request can be issued
+    """
+    if "x-rate-limit-remaining" not in response.headers:
+        # e.g. a 5xx of a proxy, the page is requested again instead of ending the crawl
+        logger.warning(f"Response of {f_name} without rate limit headers (status {response.status_code}) --> retry")
+        return RETRY
+    try:
+        remaining = int(response.headers["x-rate-limit-remaining"])
+        max_remaining = int(response.headers["x-rate-limit-limit"])
+        limit_reset_time = int(response.headers["x-rate-limit-reset"])
+        logger.info(f"CURRENT EVENT: {context().event_id} - Remaining: {remaining} - Max requests {max_remaining}")
+        response_json = decode_json(response.content)
+        # DEBUG logger.info(response_json)
+        if "data" in response_json:
+            if STORE_RESPONSES:
+                # store raw page before process_result modifies it
+                lake.append(f_name, params, response_json, context().event_id)
+            process_result(response_json, f_name, params=params)
+        else:
+            logger.info(f"No data --> response: {response_json}")
+            if "meta" in response_json:
+                if "result_count" in response_json["meta"]:
+                    logger.info("No data in response --> result-count = 0")
+                    return None
+            elif "errors" in response_json:
+                if "title" in response_json["errors"][0]:
+                    if "Not Found Error" == response_json["errors"][0]["title"]:
+                        logger.warning("Tweet or User not found --> Skip")
+                        return None
+                    if "Authorization Error" == response_json["errors"][0]["title"]:
+                        logger.warning("Authorization error --> Skip")
+                        return None
+                    if "Forbidden" == response_json["errors"][0]["title"]:
+                        logger.warning("Suspended account --> Skip")
+                        return None
+            elif "title" in response_json and response_json["title"] == "UsageCapExceeded":
+                logger.warning("Monthly Usage Cap Exceeded")
+                return "USAGE_CAP"
+            else:
+                logger.info("Rate Limit Error on first request --> wait on limit reset")
+            return limit_reset_time
+        if "meta" in response_json:
+            if "next_token" not in response_json["meta"]:
+                logger.info("Successfully crawled tweet")
+                return None
+            else:
+                # More results available --> use next_token, waiting on the rate limit is done by the scheduler
+                if f_name in follow_func:
+                    # Follower crawl --> Don't use next_token due to rate-limits --> crawling max 1000 followers
+                    if not bool(strtobool(config["twitter"]["AllFollowers"])):
+                        return None
+                if f_name == "get_liking_users":
+                    if not bool(strtobool(config["twitter"]["AllLikers"])):
+                        return None
+                if f_name == "get_retweeting_users":
+                    if not bool(strtobool(config["twitter"]["AllRetweeters"])):
+                        return None
+                next_token = response_json["meta"]["next_token"]
+                logger.info(f"Next crawl --> Next token {next_token} Params: {params}")
+                params["next_token"] = next_token
+                return NEXT_PAGE
+        else:
+            # user crawl and no limit reached --> continue
+            logger.info("Successfully crawled user")
+            return None
+    except KeyError:
+        logger.exception("Error in recursive crawl")
+        logger.error(f'{response}')
+        logger.error(f'{params}')
+        # a page that could not be evaluated must not complete the crawl
+        return RETRY
+
+
+def handle_page(f_name, params, response, cursor=None):
+    """
+    Evaluates the response of a single request and saves the pagination cursor once the page is processed
+    @param f_name: name of the crawl function that made the request
+    @param params: parameters for the api request, next_token is updated in place
+    @param response: response of the request
+    @param cursor: optional checkpoint Cursor of the crawl
+    @return: status of handle_response
+    """
+    ctx = context()
+    budget.charge(ctx.event_id)
+    ctx.count("requests")
+    status = handle_response(f_name, params, response)
+    if cursor is not None:
+        if status == NEXT_PAGE:
+            cursor.save(params["next_token"])
+        elif status is None:
+            # final page --> checkpoint and completion flag are written before the crawl returns
+            cursor.complete()
+    return status
+
+
+def resume(cursor, params, completion=None):
+    """
+    Continues a crawl from its last checkpoint
+    @param cursor: checkpoint Cursor of the crawl, none if the crawl is not checkpointed
+    @param params: parameters for the api request, next_token is set in place
+    @param completion: optional completion flag of the crawl
+    @return: number of pages crawled before, none if the crawl was completed before and can be skipped
+    """
+    if cursor is None or params.get("next_token") is not None:
+        return 0
+    checkpoint = cursor.load()
+    if checkpoint is None:
+        return 0
+    if checkpoint["done"]:
+        logger.info(f"{cursor.f_name} was completed before --> Skip")
+        checkpoints.set_flag(completion)
+        return None
+    logger.info(f"Resume {cursor.f_name} after {checkpoint['pages']} pages")
+    params["next_token"] = checkpoint["next_token"]
+    return checkpoint["pages"]
+
+
+def iterative_crawl(crawl_function, params, max_pages=None, cursor=None, progress=None):
     """
     Method that iteratively crawls data based on the crawl function and its response. E.g. when next token is present
     it continues crawling. Furthermore handles rate limit restrictions as well as certain errors
     @param crawl_function: function to make the request
     @param params: parameters for the api request
+    @param max_pages: optional maximum number of pages, TOO_DEEP is returned if more pages are available
+    @param cursor: optional checkpoint Cursor that is saved after every page
+    @param progress: optional Counter of the crawl, its pages are counted across the calls after rate limit waits
     @return: either none if crawl finished successful or the time to wait until next request can be issued
     """
     # DEBUG logger.info(f"Crawling function {crawl_function.__name__} params: {params}")
-    stack = [(crawl_function, params)]
-    while len(stack) > 0:
-        func = stack.pop(0)
-        response = func[0](**func[1])
+    status = NEXT_PAGE
+    progress = Counter() if progress is None else progress
+    while status == NEXT_PAGE:
+        if max_pages is not None and progress["pages"] >= max_pages:
+            return TOO_DEEP
         try:
-            remaining = int(response.headers["x-rate-limit-remaining"])
-            max_remaining = int(response.headers["x-rate-limit-limit"])
-            limit_reset_time = int(response.headers["x-rate-limit-reset"])
-            logger.info(f"CURRENT EVENT: {event_id} - Remaining: {remaining} - Max requests {max_remaining}")
-            response_time = float(response.headers["x-response-time"]) * 0.001
-            if crawl_function.__name__ in tweet_func:  # according to doc sleep only needed for full archive search
-                # only 1 request per second allowed (response time + sleep > 1)
-                time.sleep(1 - response_time if response_time < 1 else 0.8)
-            response_json = response.json()
-            # DEBUG logger.info(response_json)
-            if "data" in response_json:
-                process_result(response_json, crawl_function.__name__, params=params)
-            else:
-                logger.info(f"No data --> response: {response_json}")
-                if "meta" in response_json:
-                    if "result_count" in response_json["meta"]:
-                        logger.info("No data in response --> result-count = 0")
-                        return None
-                elif "errors" in response_json:
-                    if "title" in response_json["errors"][0]:
-                        if "Not Found Error" == response_json["errors"][0]["title"]:
-                            logger.warning("Tweet or User not found --> Skip")
-                            return None
-                        if "Authorization Error" == response_json["errors"][0]["title"]:
-                            logger.warning("Authorization error --> Skip")
-                            return None
-                        if "Forbidden" == response_json["errors"][0]["title"]:
-                            logger.warning("Suspended account --> Skip")
-                            return None
-                elif "title" in response_json and response_json["title"] == "UsageCapExceeded":
-                    logger.warning("Monthly Usage Cap Exceeded")
-                    return "USAGE_CAP"
-                else:
-                    logger.info("Rate Limit Error on first request --> wait on limit reset")
-                return limit_reset_time
-            if "meta" in response_json:
-                if "next_token" not in response_json["meta"]:
-                    logger.info("Successfully crawled tweet")
-                    return None
-                elif remaining == 0 or remaining == 2700:  # TODO RATE-LIMIT-BUG BY TWITTER API
-                    # Next_token available but crawl limit reached
-                    logger.info(
-                        "Crawl Limit reached max crawls: {} next reset time: {}".format(max_remaining,
-                                                                                        limit_reset_time))
-                    return limit_reset_time
-                else:
-                    # More results available --> use next_token
-                    if "meta" in response_json:
-                        if crawl_function.__name__ in follow_func:
-                            # Follower crawl --> Don't use next_token due to rate-limits --> crawling max 1000 followers
-                            if not bool(strtobool(config["twitter"]["AllFollowers"])):
-                                return None
-                        if crawl_function.__name__ == "get_liking_users":
-                            if not bool(strtobool(config["twitter"]["AllLikers"])):
-                                return None
-                        if crawl_function.__name__ == "get_retweeting_users":
-                            if not bool(strtobool(config["twitter"]["AllRetweeters"])):
-                                return None
-                        next_token = response_json["meta"]["next_token"]
-                        logger.info(f"Next crawl --> Next token {next_token} Params: {params}")
-                        params["next_token"] = next_token
-                        stack.append((crawl_function, params))
-            else:
-                # user crawl and no limit reached --> continue
-                logger.info("Successfully crawled user")
-                return None
-        except KeyError:
-            logger.exception("Error in recursive crawl")
-            logger.error(f'{response}')
-            logger.error(f'{params}')
-
-
-def crawl(crawl_function, params):
+            response = crawl_function(**params)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            # a stalled or dropped request is repeated like a response without rate limit headers
+            logger.exception(f"Request of {crawl_function.__name__} failed --> retry")
+            return RETRY
+        status = handle_page(crawl_function.__name__, params, response, cursor)
+        if status in {NEXT_PAGE, None}:
+            # like the checkpoint, only processed pages count, not rate limited or repeated requests
+            progress["pages"] += 1
+    return status
+
+
+def crawl(crawl_function, params, max_pages=None, completion=None):
     """
     Crawl wrapper function that initializes the iterative crawl functionality and handles the waiting until potential
-    time rate limits are reached
+    time rate limits are reached. Paginated crawls resume from their last checkpoint
     @param crawl_function: function to make the request
     @param params: parameters for the api request
+    @param max_pages: optional maximum number of pages of the crawl including those crawled before a rate limit wait
+    or a checkpointed restart, TOO_DEEP is returned if more pages are available
+    @param completion: optional tuple (collection, document id, field name) of the flag that is set together with the
+    final page
     """
+    cursor = checkpoints.open_cursor(crawl_function, params, context().event_id, completion)
+    pages = resume(cursor, params, completion)
+    if pages is None:
+        return None
+    progress = Counter(pages=pages)
     next_crawl_time = time.time()
+    retries = 0
+    retry_token = None
     while next_crawl_time is not None:
-        next_crawl_time = iterative_crawl(crawl_function, params)
+        next_crawl_time = iterative_crawl(crawl_function, params, max_pages, cursor, progress)
         logger.info(f"Next Crawl Time {next_crawl_time}")
-        if next_crawl_time == "USAGE_CAP":
-            return "USAGE_CAP"
+        if next_crawl_time in {"USAGE_CAP", TOO_DEEP}:
+            return next_crawl_time
         if next_crawl_time is None:
             # Crawl done without exceeding any limits
             break
+        if next_crawl_time == RETRY:
+            # retries are counted per page
+            retries = retries + 1 if params.get("next_token") == retry_token else 1
+            retry_token = params.get("next_token")
+            next_crawl_time = retry_time(crawl_function.__name__, retries)
         logger.info(
             f"Wait until limit reset in {timedelta(seconds=next_crawl_time - int(time.time()))} h/m/s")
         try:
             time.sleep(next_crawl_time - time.time())
         except ValueError():
             logger.info("Limit reset done")
+    if cursor is None:
+        checkpoints.set_flag(completion)
+
+
+def retry_time(f_name, retries):
+    """
+    @param f_name: name of the crawl function whose request failed
+    @param retries: number of consecutive failed requests of the crawl
+    @return: time at which the request is repeated
+    """
+    if retries > RETRIES:
+        # the crawl fails, its checkpoint and completion flag stay unfinished
+        raise Exception(f"{f_name} failed {retries} times without a valid response")
+    return time.time() + retries * RETRY_SECONDS
 
 
 @timeit
@@ -360,14 +544,127 @@ def reply_tree(tweet_id):
     crawl(crawl_function=api.get_replies, params=reply_params)
 
 
+def packed_crawl(crawl_function, items, suffix=""):
+    """
+    Crawls many small searches with as few OR'ed queries as possible. Up to PACKED_WORKERS queries are crawled at the
+    same time under the shared rate limit, queries that page too deep are split again. Queries holding the tweets with
+    the highest engagement are started first, no query is started once the request budget of the event is exhausted
+    @param crawl_function: packed search function of the api
+    @param items: list of PackItems to be searched
+    @param suffix: operators that apply to all clauses e.g. is:quote
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    page_size = api.SEARCH_PAGE_SIZE
+    f_name = crawl_function.__name__
+    items = conversations.refresh(f_name, items)
+    # clauses crawled before are only packed with each other, they share the since_id of their query
+    groups = by_score(pack([item for item in items if item.since_id is None], suffix,
+                           max_weight=page_size * MAX_PACKED_PAGES) +
+                      pack([item for item in items if item.since_id is not None], suffix,
+                           max_weight=page_size * MAX_PACKED_PAGES))
+    logger.info(f"Packed {len(items)} searches into {len(groups)} queries")
+    usage_cap = False
+    with ThreadPoolExecutor(max_workers=PACKED_WORKERS) as executor:
+        running = {}
+        while len(groups) > 0 or len(running) > 0:
+            while len(groups) > 0 and len(running) < PACKED_WORKERS and not usage_cap:
+                if budget.exhausted(context().event_id):
+                    groups = []
+                    break
+                group = groups.pop(0)
+                params = {
+                    "query": build_query(group, suffix),
+                    "except_fields": None,
+                    "next_token": None
+                }
+                if since_id(group) is not None:
+                    params["since_id"] = since_id(group)
+                if until_id(group) is not None:
+                    params["until_id"] = until_id(group)
+                # a single clause is crawled completely, packed ones only up to MAX_PACKED_PAGES
+                max_pages = None if len(group) == 1 else MAX_PACKED_PAGES
+                running[submit(executor, crawl, crawl_function, params, max_pages)] = (group, params)
+            if len(running) == 0:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                group, params = running.pop(future)
+                hits = context().query_routes.pop(params["query"], {})
+                oldest = context().query_oldest.pop(params["query"], None)
+                try:
+                    status = future.result()
+                except Exception:
+                    logger.exception(f"Packed query of {len(group)} searches failed --> Skip")
+                    continue
+                if status == "USAGE_CAP":
+                    usage_cap = True
+                    groups = []
+                if status == TOO_DEEP and not usage_cap:
+                    new_groups = split(group, hits, page_size)
+                    if oldest is not None:
+                        # results are returned newest first, the pages crawled so far hold everything newer
+                        for item in group:
+                            item.until_id = oldest
+                    logger.info(f"Packed query of {len(group)} searches paged too deep --> split into "
+                                f"{len(new_groups)}")
+                    groups = by_score(groups + new_groups)
+                elif status is None:
+                    conversations.mark_crawled(f_name, group)
+    return "USAGE_CAP" if usage_cap else None
+
+
 @timeit
-def hashtag_or_mention(hashtags_or_mentions, start, end):
+def reply_trees(tweets):
+    """
+    Wrapper function to retrieve all replies to several tweets with packed queries
+    @param tweets: list of tuples (tweet id, expected number of replies or none if unknown) and optionally the
+    engagement score of the tweet as third element
+    """
+    logger.info(f"Retrieving replies to {len(tweets)} tweets")
+    items = [conversation_item(*tweet) for tweet in tweets]
+    return packed_crawl(api.get_packed_replies, items)
+
+
+@timeit
+def hashtag_or_mention(hashtags_or_mentions, start, end, slices=None):
     """
     Wrapper function to retrieve tweets containing one or more of the hashtags specified
     @param hashtags_or_mentions: set of hashtag strings
     @param start: start date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
     @param end: end date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+    @param slices: optional time slices chosen by the crawl planner, equally long slices otherwise
+    """
+    conversation_ids, _ = hashtag_conversations(hashtags_or_mentions, start, end, slices)
+    crawl_conversations(conversation_ids)
+
+
+def crawl_conversations(conversation_ids):
+    """
+    Crawls the conversations found by a hashtag search in batches of 100 seeds
+    @param conversation_ids: ids of the conversations, or of the tweets whose children are crawled
+    """
+    ctx = context()
+    num_batches = (len(conversation_ids) + 99) // 100
+    for i, id_batch in enumerate(batch(conversation_ids, 100)):
+        ctx.stage = f"conversations {i + 1}/{num_batches}"
+        try:
+            seeds = hydrate_seeds(id_batch)
+            pipeline_batch(seeds)
+        except Exception:
+            logger.exception(f"Could not retrieve conversation trees of tweets with ids {id_batch} --> Skip")
+
+
+def hashtag_conversations(hashtags_or_mentions, start, end, slices=None):
+    """
+    Searches the tweets containing one or more of the hashtags specified
+    @param hashtags_or_mentions: set of hashtag strings
+    @param start: start date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+    @param end: end date from which tweets are crawled in the format yyyy-mm-ddT23:59:59.000Z
+    @param slices: optional time slices chosen by the crawl planner, equally long slices otherwise
+    @return: tuple of the ids of the conversations to crawl and the status of the search. With [recrawl] Incremental =
+    true known conversations are included, only their new replies are crawled. They are left out otherwise
     """
+    ctx = context()
     logger.info(f"Retrieving all tweets with the hashtags {hashtags_or_mentions}")
     params = {
         "hashtags_or_mentions": hashtags_or_mentions,
@@ -376,50 +673,352 @@ def hashtag_or_mention(hashtags_or_mentions, start, end):
         "except_fields": None,
         "next_token": None
     }
-    hashtag_cache.clear()
-    crawl(crawl_function=api.get_tweets_by_hashtag_or_mention, params=params)
-    for tweet_id in list(hashtag_cache):
-        if len(list(db.read({"id": tweet_id}, TWEET_COLLECTION))) > 0:
-            hashtag_cache.remove(tweet_id)
-    logger.info(f"Hashtag Cache length = {len(list(hashtag_cache))}")
-    while len(hashtag_cache) > 0:
-        curr_conversation_id = hashtag_cache.pop()
-        try:
-            get_seed(curr_conversation_id)
-            pipeline(curr_conversation_id)
-        except Exception:
-            logger.exception(f"Could not retrieve conversation tree of tweet with id {curr_conversation_id} --> Skip")
+    search_key = conversations.search_id(ctx.event_id, hashtags_or_mentions, start, end)
+    newest = conversations.newest_searched(search_key)
+    if newest is not None:
+        # the window was searched completely before --> only the tweets that are newer
+        logger.info(f"Hashtag search of event {ctx.event_id} was completed before --> search since tweet {newest}")
+        params["since_id"] = str(newest)
+    ctx.hashtag_cache.clear()
+    ctx.hashtag_newest = 0
+    f_name = api.get_tweets_by_hashtag_or_mention.__name__
+    status = sharded_crawl(crawl_function=api.get_tweets_by_hashtag_or_mention, params=params, slices=slices)
+    if status is None and conversations.INCREMENTAL:
+        conversations.mark_searched(search_key, max(ctx.hashtag_newest, newest or 0))
+        # the next crawl of the event searches since the newest tweet instead of skipping the completed slices
+        checkpoints.clear(f_name, ctx.event_id)
+    if not conversations.INCREMENTAL:
+        # drop conversations that are already known with one query per batch
+        for id_batch in batch(list(ctx.hashtag_cache), 1000):
+            for known in find_existing([{"id": key} for key in id_batch], TWEET_COLLECTION, {"id": 1}):
+                ctx.hashtag_cache.discard(known)
+    logger.info(f"Hashtag Cache length = {len(list(ctx.hashtag_cache))}")
+    conversation_ids = list(ctx.hashtag_cache)
+    ctx.hashtag_cache.clear()
+    return conversation_ids, status
+
+
+def sharded_crawl(crawl_function, params, slices=None, num_slices=SEARCH_SLICES, num_workers=SHARD_WORKERS):
+    """
+    Crawls a full-archive search concurrently in time slices instead of paging through one cursor. All slices share the
+    rate limit of the api. A slice that pages deeper than MAX_SLICE_PAGES is split again at the oldest tweet crawled so
+    far. Slices are disjoint, thus results are merged without duplicates
+    @param crawl_function: full-archive search function with start_date and end_date parameters
+    @param params: parameters for the api request, start_date and end_date default to those of the crawl function
+    @param slices: optional list of tuples (start, end) e.g. from the crawl planner
+    @param num_slices: number of equally long slices if no slices are given
+    @param num_workers: number of slices crawled at the same time
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    defaults = inspect.signature(crawl_function).parameters
+    start = params.get("start_date") or defaults["start_date"].default
+    end = params.get("end_date") or defaults["end_date"].default
+    if slices is None:
+        slices = time_slices(start, end, num_slices)
+    if len(slices) == 1 and num_workers <= 1:
+        return crawl(crawl_function, {**params, "start_date": start, "end_date": end, "next_token": None})
+
+    def crawl_slice(slice_params):
+        # every slice runs in its own copy of the submitting context, thus the state is seen by its pages only
+        slice_state = {"oldest": None}
+        current_slice.set(slice_state)
+        status = crawl(crawl_function, slice_params, max_pages=MAX_SLICE_PAGES)
+        return status, slice_state["oldest"]
+
+    usage_cap = False
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        running = {}
+        for slice_start, slice_end in slices:
+            slice_params = {**params, "start_date": slice_start, "end_date": slice_end, "next_token": None}
+            running[submit(executor, crawl_slice, slice_params)] = slice_params
+        while len(running) > 0:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                slice_params = running.pop(future)
+                try:
+                    status, oldest = future.result()
+                except Exception:
+                    logger.exception(f"Crawl of slice {slice_params['start_date']} - {slice_params['end_date']} failed")
+                    continue
+                if status == "USAGE_CAP":
+                    usage_cap = True
+                if status == TOO_DEEP and not usage_cap:
+                    rest = None if oldest is None else remaining_window(slice_params["start_date"], oldest)
+                    if rest is None or rest[1] >= slice_params["end_date"] or len(time_slices(*rest, 2)) < 2:
+                        # slice cannot be narrowed down --> continue the cursor of this slice
+                        new_slices = [(slice_params["start_date"], slice_params["end_date"],
+                                       slice_params["next_token"])]
+                    else:
+                        new_slices = [(s, e, None) for s, e in time_slices(*rest, 2)]
+                    logger.info(f"Dense slice {slice_params['start_date']} - {slice_params['end_date']} "
+                                f"--> split into {len(new_slices)}")
+                    for slice_start, slice_end, next_token in new_slices:
+                        new_params = {**params, "start_date": slice_start, "end_date": slice_end,
+                                      "next_token": next_token}
+                        running[submit(executor, crawl_slice, new_params)] = new_params
+    return "USAGE_CAP" if usage_cap else None
+
+
+def crawl_event(event, slices=None, conversation_ids=None):
+    """
+    Crawls the conversation of the seed tweet and the hashtags and mentions of an event
+    @param event: EventSearch object
+    @param slices: optional time slices of the hashtag search chosen by the crawl planner
+    @param conversation_ids: optional conversations a compiled search found for the event, they are crawled instead of
+    searching the hashtags and mentions of the event
+    """
+    ctx = context()
+    logger.info(f"Start crawl of {event}")
+    ctx.event_id = event.uid
+    ctx.started = time.time()
+    try:
+        if event.tweet_id is not None:
+            ctx.stage = "seed conversation"
+            get_seed(event.tweet_id)
+            pipeline(event.tweet_id)
+        if conversation_ids is not None:
+            crawl_conversations(conversation_ids)
+        elif event.tag_and_mention is not None:
+            ctx.stage = "hashtag search"
+            start, end = event.window()
+            hashtag_or_mention(event.tag_and_mention, start=start, end=end, slices=slices)
+    except Exception:
+        logger.exception(f"Unrecoverable error for event {event.uid}")
+        ctx.stage = "failed"
+    else:
+        ctx.stage = "finished"
+    # the stages after the crawl of the event read its documents from the db
+    ingestion.drain()
+    ctx.finished = time.time()
+    # reset author cache
+    ctx.reset()
+
+
+def crawl_events(events, weights=None, slices=None, num_workers=EVENT_WORKERS, total_budget=EVENTS_BUDGET,
+                 found_conversations=None):
+    """
+    Crawls several events at the same time, each one in its own CrawlContext. The events share the rate limits and
+    take turns by weight whenever they wait for the same endpoint family, thus a large hashtag event does not hold
+    back the small ones and quota a finished event leaves is used by the remaining ones
+    @param events: list of EventSearch objects
+    @param weights: optional dict event uid --> weight, 1 otherwise
+    @param slices: optional dict event uid --> time slices of the hashtag search chosen by the crawl planner
+    @param num_workers: number of events crawled at the same time
+    @param total_budget: requests shared by the events in proportion to their weights, 0 for no limit
+    @param found_conversations: optional dict event uid --> conversation ids found by compiled searches
+    @return: dict event uid --> CrawlContext with the progress of the event
+    """
+    weights = weights or {}
+    slices = slices or {}
+    found_conversations = found_conversations or {}
+    num_workers = max(min(num_workers, len(events)), 1)
+    # the events share the memory of one author cache
+    contexts = {event.uid: new_context(event.uid, weights.get(event.uid, 1.0), MAX_CACHED_TWEETS // num_workers)
+                for event in events}
+    if total_budget > 0:
+        total_weight = sum(ctx.weight for ctx in contexts.values())
+        for uid, ctx in contexts.items():
+            budget.set_limit(uid, max(int(total_budget * ctx.weight / total_weight), 1))
+    logger.info(f"Crawling {len(events)} events with {num_workers} workers")
+    done = threading.Event()
+    thread(report_progress, args=(contexts, done), daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for event in events:
+                executor.submit(run_event, event, contexts[event.uid], slices.get(event.uid),
+                                found_conversations.get(event.uid))
+    finally:
+        done.set()
+    log_progress(contexts)
+    return contexts
+
+
+def run_event(event, ctx, event_slices, conversation_ids=None):
+    """
+    @param event: EventSearch object
+    @param ctx: CrawlContext of the event
+    @param event_slices: optional time slices of the hashtag search
+    @param conversation_ids: optional conversations found by compiled searches
+    """
+    with activate(ctx):
+        crawl_event(event, slices=event_slices, conversation_ids=conversation_ids)
+    fair_share.forget(event.uid)
+
+
+def report_progress(contexts, done):
+    """
+    Logs the progress of the events every ProgressSeconds until the crawl is done
+    @param contexts: dict event uid --> CrawlContext
+    @param done: threading.Event that is set once all events are crawled
+    """
+    while not done.wait(PROGRESS_SECONDS):
+        log_progress(contexts)
+
+
+def log_progress(contexts):
+    lines = [ctx.status_line() for ctx in contexts.values()]
+    logger.info("Progress of the events:\n" + "\n".join(lines))
+
+
+def crawl_compiled(events, weights=None, num_workers=EVENT_WORKERS, total_budget=EVENTS_BUDGET):
+    """
+    Crawls events whose hashtags, mentions and windows overlap without fetching a tweet twice. The hashtag and mention
+    searches of all events are compiled into a minimal set of searches, every found conversation is crawled once in
+    the context of the first event that matched it and the other matching events are added to its tweets afterwards
+    @param events: list of EventSearch objects, the list order decides which event a shared conversation is crawled for
+    @param weights: optional dict event uid --> weight, 1 otherwise
+    @param num_workers: number of events crawled at the same time
+    @param total_budget: requests shared by the events in proportion to their weights, 0 for no limit
+    @return: dict event uid --> CrawlContext with the progress of the event
+    """
+    plans = crawl_planner.plan_searches(plan_compiler.compile_events(events))
+    found = {}
+    for plan in plans:
+        found_by_search = search_compiled(plan.job, plan.slices)
+        if found_by_search is None:
+            send_warn_mail()
+            return {}
+        for key, uids in found_by_search.items():
+            found.setdefault(key, set()).update(uids)
+    known = set()
+    if not conversations.INCREMENTAL:
+        # known conversations are only tagged, with Incremental = true their new replies are crawled
+        for id_batch in batch(list(found), 1000):
+            known.update(find_existing([{"id": key} for key in id_batch], TWEET_COLLECTION, {"id": 1}))
+    found_conversations, further = plan_compiler.assign(
+        {key: uids for key, uids in found.items() if key not in known}, events)
+    further.update({key: sorted(found[key]) for key in known})
+    logger.info(f"Compiled searches found {len(found)} conversations, {len(known)} known already, "
+                f"{len(further)} shared by several events")
+    contexts = crawl_events(events, weights, num_workers=num_workers, total_budget=total_budget,
+                            found_conversations=found_conversations)
+    tag_conversations(further)
+    return contexts
+
+
+def search_compiled(search, slices=None):
+    """
+    @param search: CompiledSearch
+    @param slices: optional time slices chosen by the crawl planner
+    @return: dict conversation id --> uids of the events that matched it, none if the usage cap was reached
+    """
+    with activate(new_context(search.name())) as ctx:
+        ctx.search = search
+        ctx.stage = "compiled search"
+        logger.info(f"Retrieving all tweets of {search}")
+        params = {"hashtags_or_mentions": set(search.terms), "start_date": search.start, "end_date": search.end,
+                  "except_fields": None, "next_token": None}
+        status = sharded_crawl(crawl_function=api.get_tweets_by_hashtag_or_mention, params=params, slices=slices)
+        found = dict(ctx.search_events)
+        ctx.reset()
+    return None if status == "USAGE_CAP" else found
+
+
+def tag_conversations(further):
+    """
+    Adds the events that matched a conversation but did not crawl it to the tweets of the conversation and to their
+    authors
+    @param further: dict conversation id --> uids of the events
+    """
+    by_events = {}
+    for key, uids in further.items():
+        by_events.setdefault(tuple(uids), []).append(key)
+    key_field = "conversation_id" if COMPLETE_TREE else "id"
+    for uids, keys in by_events.items():
+        tag = {"$addToSet": {"event_id": {"$each": list(uids)}}}
+        for key_batch in batch(keys, 1000):
+            db.db[TWEET_COLLECTION].update_many({key_field: {"$in": key_batch}}, tag)
+            author_ids = db.db[TWEET_COLLECTION].distinct("author_id", {key_field: {"$in": key_batch}})
+            for id_batch in batch(author_ids, 1000):
+                db.db[USER_COLLECTION].update_many({"id": {"$in": id_batch}}, tag)
+
+
+@timeit
+def hydrate_seeds(tweet_ids):
+    """
+    Wrapper function to retrieve up to 100 seed tweets with one request
+    @param tweet_ids: list of seed tweet ids
+    @return: list of tuples (tweet id, reply count) of the seeds that could be retrieved
+    """
+    ctx = context()
+    logger.info(f"Retrieving {len(tweet_ids)} seed tweets")
+    ctx.seed_cache.clear()
+    crawl(crawl_function=api.get_tweets_by_id, params={"ids": tweet_ids})
+    seeds = list(ctx.seed_cache.items())
+    ctx.seed_cache.clear()
+    if len(seeds) < len(tweet_ids):
+        logger.info(f"{len(tweet_ids) - len(seeds)} seed tweets not available --> Skip")
+    return seeds
 
 
 @timeit
 def user():
     """
-    Wrapper function to retrieve all users (in batches) specified in the local author cache
+    Wrapper function to retrieve all users (in batches) specified in the local author cache that have not been returned
+    inline with their tweets yet
     TODO Change user crawl to not rely on cache but rather using db fields such as likes,follows,timeline
     """
+    ctx = context()
     logger.info("Retrieving user information")
-    author_ids = [author.id for author in author_cache.values() if not author.user_retrieved]
+    with cache_lock:
+        # authors requested by a concurrent pipeline worker are skipped
+        author_ids = [author.id for author in ctx.author_cache.values()
+                      if not author.user_retrieved and author.id not in ctx.requested_users]
+        ctx.requested_users.update(author_ids)
     for author_id_batch in batch(author_ids, 100):
-        crawl(crawl_function=api.get_users_by_id, params={"ids": author_id_batch})
+        author_id_batch = load_stored_users(author_id_batch)
+        if len(author_id_batch) > 0:
+            crawl(crawl_function=api.get_users_by_id, params={"ids": author_id_batch})
+
+
+def load_stored_users(author_ids):
+    """
+    Takes the profiles of authors that are stored in the user collection already from the db instead of the api
+    @param author_ids: ids of cached authors
+    @return: ids of the authors that still have to be requested
+    """
+    stored = find_existing([{"id": author_id} for author_id in author_ids], USER_COLLECTION,
+                           {"id": 1, "username": 1, "public_metrics": 1, "event_id": 1})
+    stored = {user_id: doc for user_id, doc in stored.items() if doc.get("username") is not None}
+    add_event_ids(USER_COLLECTION, stored.values())
+    with cache_lock:
+        for doc in stored.values():
+            author = context().author_cache.get(doc["id"])
+            if author is not None:
+                author.set_username(doc["username"])
+                author.followers_count = doc.get("public_metrics", {}).get("followers_count", 0)
+                author.user_retrieved = True
+    return [author_id for author_id in author_ids if author_id not in stored]
 
 
 @timeit
 def quotes():
     """
-    Wrapper function to retrieve all users (in batches) specified in the local author cache
+    Wrapper function to retrieve the quotes of all tweets in the local author cache with packed queries
     """
+    ctx = context()
     logger.info("Retrieve all quotes")
-    for author in list(author_cache.values()):
-        for tweet in author.tweets:
-            if tweet.quote_count > 0 and not tweet.quotes_retrieved:
-                quote_params = {
-                    "username": author.username,
-                    "tweet_id": tweet.id,
-                    "except_fields": None,
-                    "next_token": None
-                }
-                crawl(crawl_function=api.get_quotes, params=quote_params)
-            tweet.quotes_retrieved = True
+    items = []
+    with cache_lock:
+        while True:
+            # tweets are marked before their quotes are crawled, thus concurrent pipeline workers don't crawl them twice
+            for author in list(ctx.author_cache.values()):
+                for tweet in author.tweets:
+                    if tweet.quotes_retrieved:
+                        continue
+                    if tweet.quote_count > 0:
+                        if author.user_retrieved:
+                            items.append(quote_item(author.username, tweet.id, tweet.quote_count,
+                                                    tweet_score(tweet, ctx.author_cache)))
+                        else:
+                            logger.warning(f"Username of author {author.id} unknown --> skip quotes of tweet "
+                                           f"{tweet.id}")
+                    tweet.quotes_retrieved = True
+            # spilled tweets are loaded once the marked tweets are evicted
+            if ctx.author_cache.restore() == 0:
+                break
+    if len(items) > 0:
+        return packed_crawl(api.get_packed_quotes, items, suffix="is:quote -is:retweet")
 
 
 @timeit
@@ -429,26 +1028,68 @@ def pipeline(tweet_id):
     @param tweet_id: seed tweet id
     @return: writes results to file and db
     """
+    pipeline_batch([(tweet_id, None)])
+
+
+def pipeline_batch(seeds):
+    """
+    Recursive pipeline which retrieves reply trees, involved users and quotes of several seeds. Quote tweets are
+    expanded by their engagement score, up to BATCH_SIZE tweets together with packed queries, until the request
+    budget of the event is exhausted. Sibling quote conversations are independent, thus up to PIPELINE_WORKERS batches
+    are expanded at the same time under the shared rate limit
+    @param seeds: list of tuples (seed tweet id, reply count or none if unknown)
+    @return: writes results to file and db, returns USAGE_CAP if the usage cap was reached
+    """
+    ctx = context()
     try:
-        stack = [tweet_id]
-        while len(stack) > 0:
-            curr_tweet_id = stack.pop(0)
-            time.sleep(0.8)
-            reply_tree(curr_tweet_id)
-            # crawl users gathered from reply tree
-            user()
-            quotes()
-            # crawl users gathered from quote crawl
-            user()
-            while len(tweet_cache) > 0:
-                twt_obj = tweet_cache.pop(0)
-                if twt_obj.sum_metric_count() > 0:
-                    stack.append(twt_obj.id)
+        expansion = ExpansionQueue()
+        for tweet_id, reply_count in seeds:
+            expansion.push(tweet_id, reply_count)
+        expanded = set()
+        with ThreadPoolExecutor(max_workers=PIPELINE_WORKERS) as executor:
+            running = set()
+            while True:
+                while len(expansion) > 0 and len(running) < PIPELINE_WORKERS and not budget.exhausted(ctx.event_id):
+                    level = [tweet for tweet in expansion.pop_many(BATCH_SIZE) if tweet[0] not in expanded]
+                    expanded.update(tweet[0] for tweet in level)
+                    if len(level) > 0:
+                        running.add(submit(executor, expand, level))
+                if len(running) == 0:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        if future.result() == "USAGE_CAP":
+                            return "USAGE_CAP"
+                    except Exception:
+                        logger.exception("Error in pipeline worker")
+                # quotes found by the finished workers are the next tweets to expand
+                with cache_lock:
+                    while len(ctx.tweet_cache) > 0:
+                        twt_obj = ctx.tweet_cache.pop()
+                        if twt_obj.sum_metric_count() > 0:
+                            expansion.push(twt_obj.id, twt_obj.reply_count, tweet_score(twt_obj, ctx.author_cache))
     except Exception as e:
         logger.error("Error in pipeline")
         logger.exception(e)
 
 
+def expand(level):
+    """
+    Retrieves the reply trees of a batch of tweets, the users involved and the quotes of the replies
+    @param level: list of tuples (tweet id, reply count, score)
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    if reply_trees(level) == "USAGE_CAP":
+        return "USAGE_CAP"
+    # crawl users gathered from reply tree
+    user()
+    if quotes() == "USAGE_CAP":
+        return "USAGE_CAP"
+    # crawl users gathered from quote crawl
+    user()
+
+
 @timeit
 def threaded_crawl(crawl_function, search_results, target_field_name, num_threads):
     """
@@ -456,36 +1097,131 @@ def threaded_crawl(crawl_function, search_results, target_field_name, num_thread
     @param crawl_function: function which should be run in threads
     @param search_results: results of db search for elements which need to be crawled
     @param target_field_name: name of field which should be changed after successful crawl
-    @param num_threads: number of threads to use
+    @param num_threads: maximum number of threads, the number in use is adapted at runtime by a StageController
     """
+    ctx = context()
+    if USE_FRONTIER:
+        # one job per document, the jobs are crawled by frontier_worker of any crawler process
+        job_type = STAGE_JOBS[crawl_function.__name__]
+        jobs = []
+        for elem in search_results:
+            if isinstance(elem, str):
+                jobs.append((job_type, elem, {"document": elem}, ctx.event_id))
+            else:
+                document = {k: v for k, v in elem.items() if k in {"id", "planned_slices", "max_pages"}}
+                jobs.append((job_type, elem["id"], {"document": document}, ctx.event_id, elem.get("score", 0)))
+        frontier.enqueue(jobs)
+        return
+    if CRAWL_ENGINE == "async":
+        # imported lazily, the async engine and its dependencies are only needed if it is selected
+        import async_crawl
+        asyncio.run(async_crawl.threaded_crawl(crawl_function.__name__, search_results, target_field_name))
+        return
     job_queue = queue.Queue()
     for elem in search_results:
         job_queue.put(elem)
-    # TODO DEBUG ONLY FOR TIMELINE FOR THE REST MORE THREADS CAN BE USED
-    num_threads = 1
+    f_name = crawl_function.__name__
+    controller = concurrency.StageController(f_name, STAGE_FAMILIES.get(f_name, f_name), num_threads).start()
+    logger.info(f"Main: create and start {num_threads} threads for {f_name}, {controller.limit} of them active")
     for i in range(num_threads):
-        logger.info(f"Main: create and start thread {i} for {crawl_function.__name__}")
-        Thread(target=worker, args=(job_queue, crawl_function, target_field_name, i), daemon=True).start()
+        thread(worker, args=(job_queue, crawl_function, target_field_name, i, controller), daemon=True).start()
     job_queue.join()
+    controller.stop()
 
 
-def worker(job_queue, crawl_function, field_name, thread_number):
+def worker(job_queue, crawl_function, field_name, thread_number, controller):
     """
     Thread worker which executes jobs
     @param job_queue: queue of jobs the worker has to execute
     @param crawl_function: function which should be executed
     @param field_name: name of field which should be altered after successful crawl
     @param thread_number: number of thread that works on task
+    @param controller: StageController limiting the number of workers that crawl at the same time
     """
     while True:
         new_job = job_queue.get()
-        status = execute_and_modify(crawl_function, new_job, field_name)
+        try:
+            with controller.slot():
+                status = execute_and_modify(crawl_function, new_job, field_name)
+        except Exception:
+            logger.exception(f"Error in threaded crawl of {crawl_function.__name__} for {new_job} --> Skip")
+            continue
+        finally:
+            # threaded_crawl waits for every job to be done, a failed job must not block it
+            job_queue.task_done()
         if status == "USAGE_CAP":
             if thread_number == 0:
                 # Sends warn mail only for the first thread encountering the usage cap
                 send_warn_mail()
             return
-        job_queue.task_done()
+
+
+def reaction_jobs(target_field_name, metric, skip=(), limit=0):
+    """
+    Marks tweets without reactions of the given kind as crawled
+    @param target_field_name: likes_crawled or retweets_crawled
+    @param metric: like_count or retweet_count
+    @param skip: ids of tweets that are queued already
+    @param limit: maximum number of tweets, 0 for all
+    @return: cursor of the tweets whose reacting users are still to be crawled, most engaging first
+    """
+    query = {target_field_name: False, f"public_metrics.{metric}": {"$gt": 0}}
+    if len(skip) > 0:
+        query["id"] = {"$nin": list(skip)}
+    result = rank_tweets(query, limit)
+    remaining = db.read({target_field_name: False, f"public_metrics.{metric}": {"$eq": 0}}, TWEET_COLLECTION)
+    for remain in remaining:
+        db.modify({"id": remain["id"]}, {"$set": {target_field_name: True}}, TWEET_COLLECTION)
+    return result
+
+
+def retweet_jobs(skip=(), limit=0):
+    return reaction_jobs("retweets_crawled", "retweet_count", skip, limit)
+
+
+def like_jobs(skip=(), limit=0):
+    return reaction_jobs("likes_crawled", "like_count", skip, limit)
+
+
+def timeline_jobs(skip=()):
+    """
+    Plans the timeline searches of the users whose timelines are still to be crawled
+    @param skip: ids of users that are queued already
+    @return: user documents with their planned slices, none for a dry run
+    """
+    target_field_name = "timeline_crawled"
+    result = [doc for doc in db.read({target_field_name: False}, USER_COLLECTION) if doc["id"] not in skip]
+    if crawl_planner.PLAN_TIMELINES and len(result) > 0:
+        plans = crawl_planner.plan_timelines(result)
+        crawl_planner.report(plans)
+        if crawl_planner.DRY_RUN:
+            return None
+        result = []
+        for plan in plans:
+            if plan.total == 0:
+                # nothing published within the window --> no search request needed
+                db.modify({"id": plan.job["id"]}, {"$set": {target_field_name: True}}, USER_COLLECTION)
+                continue
+            plan.job["planned_slices"] = plan.slices
+            result.append(plan.job)
+    return result
+
+
+def follow_jobs(target_field_name, skip=(), planner=None):
+    """
+    @param target_field_name: followers_crawled or following_crawled
+    @param skip: ids of users that are queued already
+    @param planner: FollowerPlanner of the run whose request budget the users are charged to, a new one otherwise
+    @return: users whose followers or followed accounts are still to be crawled, the most valuable first if
+    PlanFollowers = true, none for a dry run
+    """
+    if not follower_planner.PLAN_FOLLOWERS:
+        return [doc for doc in db.read({target_field_name: False}, USER_COLLECTION) if doc["id"] not in skip]
+    planner = follower_planner.FollowerPlanner() if planner is None else planner
+    result = planner.plan([doc for doc in db.read({target_field_name: False}, USER_COLLECTION,
+                                                  {"id": 1, "event_id": 1, "public_metrics": 1})
+                           if doc["id"] not in skip], target_field_name)
+    return None if crawl_planner.DRY_RUN else result
 
 
 @timeit
@@ -493,12 +1229,8 @@ def crawl_retweets():
     """
     Wrapper function that starts the threaded crawl for retweets and modifies db accordingly
     """
-    target_field_name = "retweets_crawled"
-    result = db.read({target_field_name: False, "public_metrics.retweet_count": {"$gt": 0}}, TWEET_COLLECTION)
-    remaining = db.read({target_field_name: False, f"public_metrics.retweet_count": {"$eq": 0}}, TWEET_COLLECTION)
-    for remain in remaining:
-        db.modify({"id": remain["id"]}, {"$set": {target_field_name: True}}, TWEET_COLLECTION)
-    threaded_crawl(api.get_retweeting_users, result, target_field_name, num_threads=75)
+    # most engaging tweets first
+    threaded_crawl(api.get_retweeting_users, retweet_jobs(), "retweets_crawled", num_threads=75)
 
 
 @timeit
@@ -506,12 +1238,8 @@ def crawl_likes():
     """
     Wrapper function that starts the threaded crawl for likes and modifies db accordingly
     """
-    target_field_name = "likes_crawled"
-    result = db.read({target_field_name: False, "public_metrics.like_count": {"$gt": 0}}, TWEET_COLLECTION)
-    remaining = db.read({target_field_name: False, f"public_metrics.like_count": {"$eq": 0}}, TWEET_COLLECTION)
-    for remain in remaining:
-        db.modify({"id": remain["id"]}, {"$set": {target_field_name: True}}, TWEET_COLLECTION)
-    threaded_crawl(api.get_liking_users, result, target_field_name, num_threads=75)
+    # most engaging tweets first
+    threaded_crawl(api.get_liking_users, like_jobs(), "likes_crawled", num_threads=75)
 
 
 @timeit
@@ -519,11 +1247,13 @@ def crawl_timelines():
     """
     Wrapper function that starts the threaded crawl for the timeline tweets and modifies db accordingly
     """
-    target_field_name = "timeline_crawled"
-    result = db.read({target_field_name: False}, USER_COLLECTION)
-    # Beware of ulimit for opening files in os (ubuntu standard is 1024) to open SSL certificates and make https request
-    # Thus num_threads needs to be smaller than 1024 to be safe
-    threaded_crawl(api.get_timeline_archive_search, result, target_field_name, num_threads=1)
+    result = timeline_jobs()
+    if result is None:
+        return
+    # Requests share the keep-alive connections of api.sessions, thus open files are bounded by MaxConnectionsPerHost
+    # in config.ini rather than by num_threads
+    threaded_crawl(api.get_timeline_archive_search, result, "timeline_crawled",
+                   num_threads=concurrency.MAX_SEARCH_THREADS)
 
 
 @timeit
@@ -533,9 +1263,10 @@ def crawl_keyword():
     """
     target_field_name = "keyword"
     result = "uranium"
-    # Beware of ulimit for opening files in os (ubuntu standard is 1024) to open SSL certificates and make https request
-    # Thus num_threads needs to be smaller than 1024 to be safe
-    threaded_crawl(api.get_keyword_archive_search, result, target_field_name, num_threads=1)
+    # Requests share the keep-alive connections of api.sessions, thus open files are bounded by MaxConnectionsPerHost
+    # in config.ini rather than by num_threads
+    threaded_crawl(api.get_keyword_archive_search, result, target_field_name,
+                   num_threads=concurrency.MAX_SEARCH_THREADS)
 
 
 @timeit
@@ -543,9 +1274,10 @@ def crawl_follows():
     """
     Wrapper function that starts the threaded crawl for followers and modifies db accordingly
     """
-    target_field_name = "followers_crawled"
-    result = db.read({target_field_name: False}, USER_COLLECTION)
-    threaded_crawl(api.get_followers, result, target_field_name, num_threads=15)
+    result = follow_jobs("followers_crawled")
+    if result is None:
+        return
+    threaded_crawl(api.get_followers, result, "followers_crawled", num_threads=15)
 
 
 @timeit
@@ -553,42 +1285,322 @@ def crawl_following():
     """
     Wrapper function that starts the threaded crawl for following users and modifies db accordingly
     """
-    target_field_name = "following_crawled"
-    result = db.read({target_field_name: False}, USER_COLLECTION)
-    threaded_crawl(api.get_following, result, target_field_name, num_threads=15)
+    result = follow_jobs("following_crawled")
+    if result is None:
+        return
+    threaded_crawl(api.get_following, result, "following_crawled", num_threads=15)
 
 
-def execute_and_modify(crawl_function, db_response, field_name):
+def job_params(db_response, field_name):
     """
-    Actually executes crawl function and modifies db to write back status on crawling
-    @param crawl_function: to be executed - namely retweet, like or timeline crawl
-    @param db_response: which returned ids to be crawled with @crawl_function
+    Builds the request parameters for a threaded crawl job
+    @param db_response: which returned ids to be crawled
     @param field_name: of document in db which has to be set to true after successful crawl
+    @return: tuple of request parameters and the collection that holds the crawled document (none for keyword jobs)
     """
     params = {"except_fields": None}
     if field_name in {"retweets_crawled", "likes_crawled"}:
         params["tweet_id"] = db_response["id"]
-        collection = TWEET_COLLECTION
+        return params, TWEET_COLLECTION
     elif field_name in {"timeline_crawled", "followers_crawled", "following_crawled"}:
         params["user_id"] = db_response["id"]
         params["next_token"] = None
-        collection = USER_COLLECTION
+        return params, USER_COLLECTION
     elif field_name in {"keyword"}:
         params["keyword"] = db_response
-        status = crawl(crawl_function, params)
-        if status == "USAGE_CAP":
-            return "USAGE_CAP"
-        return
+        return params, None
     else:
         logger.error("Field name for db modification unknown")
         raise Exception
-    status = crawl(crawl_function, params)
+
+
+def execute_and_modify(crawl_function, db_response, field_name):
+    """
+    Actually executes crawl function and modifies db to write back status on crawling
+    @param crawl_function: to be executed - namely retweet, like or timeline crawl
+    @param db_response: which returned ids to be crawled with @crawl_function
+    @param field_name: of document in db which has to be set to true after successful crawl
+    """
+    params, collection = job_params(db_response, field_name)
+    if crawl_function.__name__ == "get_keyword_archive_search":
+        status = sharded_crawl(crawl_function, params)
+    elif crawl_function.__name__ == "get_timeline_archive_search":
+        status = sharded_crawl(crawl_function, params, slices=db_response.get("planned_slices"),
+                               num_slices=TIMELINE_SLICES)
+    elif collection is not None:
+        # the flag is set together with the final page
+        status = crawl(crawl_function, params, max_pages=db_response.get("max_pages"),
+                       completion=(collection, db_response["id"], field_name))
+        if status != TOO_DEEP:
+            return status
+        # the follower planner capped the crawl of the user
+        logger.info(f"{field_name} of {db_response['id']} capped after {db_response['max_pages']} pages")
+    else:
+        status = crawl(crawl_function, params)
     if status == "USAGE_CAP":
         return "USAGE_CAP"
-    else:
+    elif collection is not None:
         db.modify({"id": db_response["id"]}, {"$set": {field_name: True}}, collection)
 
 
+def submit_event(event, slices=None, recrawl=False):
+    """
+    Adds the crawl of an event to the frontier
+    @param event: EventSearch object
+    @param slices: optional time slices of the hashtag search chosen by the crawl planner
+    @param recrawl: if true, an event that was crawled before is crawled again. Its seeds, reply trees and quotes are
+    crawled again as well, with [recrawl] Incremental = true only the new replies and quotes are requested
+    """
+    tag_and_mention = None if event.tag_and_mention is None else sorted(event.tag_and_mention)
+    requeue_before = datetime.utcnow() if recrawl else None
+    frontier.enqueue([("event", event.uid, with_recrawl({
+        "uid": event.uid,
+        "tweet_id": event.tweet_id,
+        "start_date": event.start_date,
+        "tag_and_mention": tag_and_mention,
+        "username": event.username,
+        "comment": event.comment,
+        "days": event.days,
+        "slices": slices
+    }, requeue_before), event.uid)], requeue_before)
+
+
+def with_recrawl(params, requeue_before):
+    """
+    @param params: params of a frontier job
+    @param requeue_before: time the recrawl of the event was requested, none if it is no recrawl
+    @return: params that pass the recrawl on to the jobs the job adds to the frontier
+    """
+    return params if requeue_before is None else {**params, "recrawl_at": requeue_before}
+
+
+def recrawl_at(jobs):
+    """
+    @param jobs: list of leased job documents
+    @return: time the recrawl of their event was requested, none if they are no recrawl
+    """
+    return max((job["params"]["recrawl_at"] for job in jobs if job["params"].get("recrawl_at") is not None),
+               default=None)
+
+
+def enqueue_followups(job_event_id, requeue_before=None):
+    """
+    Turns the local caches filled by a frontier job into new jobs: quotes of the cached tweets, reply trees of the
+    cached quotes and users that have not been returned inline. Clears the caches afterwards
+    @param job_event_id: event the new jobs belong to
+    @param requeue_before: time the recrawl of the event was requested, jobs completed before are crawled again
+    """
+    ctx = context()
+    # the new jobs may be leased by another process right away, it reads the pages of this job from the db
+    ingestion.drain()
+    jobs = []
+    for author in ctx.author_cache.values():
+        if not author.user_retrieved:
+            jobs.append(("hydrate_users", author.id, with_recrawl({"user_id": author.id}, requeue_before),
+                         job_event_id))
+    while True:
+        for author in ctx.author_cache.values():
+            for tweet in author.tweets:
+                if tweet.quote_count > 0 and not tweet.quotes_retrieved:
+                    jobs.append(("quotes", tweet.id, with_recrawl({"tweet_id": tweet.id, "author_id": author.id,
+                                                                   "quote_count": tweet.quote_count}, requeue_before),
+                                 job_event_id, tweet_score(tweet, ctx.author_cache)))
+                    tweet.quotes_retrieved = True
+        # spilled tweets are loaded once the tweets turned into jobs are evicted
+        if ctx.author_cache.restore() == 0:
+            break
+    for tweet in ctx.tweet_cache:
+        if tweet.reply_count > 0:
+            jobs.append(("reply_tree", tweet.id, with_recrawl({"tweet_id": tweet.id, "reply_count": tweet.reply_count},
+                                                              requeue_before),
+                         job_event_id, tweet_score(tweet, ctx.author_cache)))
+    frontier.enqueue(jobs, requeue_before)
+    ctx.author_cache.clear()
+    ctx.requested_users.clear()
+    ctx.tweet_cache.clear()
+
+
+def run_event_job(jobs):
+    """
+    Searches the hashtags and mentions of an event and adds the found conversations and the seed tweet to the frontier
+    @param jobs: list with the event job
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    params = dict(jobs[0]["params"])
+    slices = params.pop("slices", None)
+    requeue_before = params.pop("recrawl_at", None)
+    event = EventSearch(**params)
+    tweet_ids = [] if event.tweet_id is None else [event.tweet_id]
+    if event.tag_and_mention is not None:
+        start, end = event.window()
+        slices = None if slices is None else [tuple(s) for s in slices]
+        conversation_ids, status = hashtag_conversations(set(event.tag_and_mention), start, end, slices)
+        if status == "USAGE_CAP":
+            return status
+        tweet_ids.extend(conversation_ids)
+    frontier.enqueue([("seed", tweet_id, with_recrawl({"tweet_id": tweet_id}, requeue_before), event.uid)
+                      for tweet_id in tweet_ids], requeue_before)
+
+
+def run_seed_jobs(jobs):
+    """
+    Retrieves seed tweets and adds their reply trees and quotes to the frontier
+    @param jobs: list of seed jobs
+    """
+    seeds = hydrate_seeds([job["params"]["tweet_id"] for job in jobs])
+    requeue_before = recrawl_at(jobs)
+    # conversations of seeds are expanded before the ones of quotes
+    frontier.enqueue([("reply_tree", tweet_id, with_recrawl({"tweet_id": tweet_id, "reply_count": reply_count},
+                                                            requeue_before), context().event_id, float("inf"))
+                      for tweet_id, reply_count in seeds if reply_count is None or reply_count > 0], requeue_before)
+    enqueue_followups(context().event_id, requeue_before)
+
+
+def run_reply_tree_jobs(jobs):
+    """
+    Retrieves the reply trees of several tweets with packed queries and adds the quotes of the replies to the frontier
+    @param jobs: list of reply tree jobs
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    status = reply_trees([(job["params"]["tweet_id"], job["params"]["reply_count"], job.get("score", 0))
+                          for job in jobs])
+    if status == "USAGE_CAP":
+        return status
+    enqueue_followups(context().event_id, recrawl_at(jobs))
+
+
+def run_quotes_jobs(jobs):
+    """
+    Retrieves the quotes of several tweets with packed queries and adds the reply trees and quotes of the quotes to the
+    frontier. The usernames of the quoted authors are read from the user collection or retrieved first
+    @param jobs: list of quote jobs
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    author_ids = list({job["params"]["author_id"] for job in jobs})
+    usernames = {}
+    for known in db.read({"id": {"$in": author_ids}}, USER_COLLECTION, {"id": 1, "username": 1}):
+        usernames[known["id"]] = known.get("username")
+    missing = [author_id for author_id in author_ids if usernames.get(author_id) is None]
+    for id_batch in batch(missing, 100):
+        crawl(crawl_function=api.get_users_by_id, params={"ids": id_batch})
+    # the retrieved users may still be queued for the write-behind writers
+    ingestion.drain()
+    for known in db.read({"id": {"$in": missing}}, USER_COLLECTION, {"id": 1, "username": 1}):
+        usernames[known["id"]] = known.get("username")
+    items = []
+    for job in jobs:
+        username = usernames.get(job["params"]["author_id"])
+        if username is None:
+            logger.warning(f"Username of author {job['params']['author_id']} unknown --> skip quotes of tweet "
+                           f"{job['params']['tweet_id']}")
+            continue
+        items.append(quote_item(username, job["params"]["tweet_id"], job["params"]["quote_count"],
+                                job.get("score", 0)))
+    status = packed_crawl(api.get_packed_quotes, items, suffix="is:quote -is:retweet")
+    if status == "USAGE_CAP":
+        return status
+    enqueue_followups(context().event_id, recrawl_at(jobs))
+
+
+def run_hydrate_users_jobs(jobs):
+    """
+    Retrieves the profiles of up to 100 users with one request
+    @param jobs: list of hydrate users jobs
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    return crawl(crawl_function=api.get_users_by_id, params={"ids": [job["params"]["user_id"] for job in jobs]})
+
+
+def run_stage_job(jobs):
+    """
+    Crawls the likes, retweets, timeline, followers or following users of a document or a keyword
+    @param jobs: list with the stage job
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    f_name, field_name = STAGES[jobs[0]["type"]]
+    return execute_and_modify(getattr(api, f_name), jobs[0]["params"]["document"], field_name)
+
+
+def frontier_worker(types=None, idle_exit=True):
+    """
+    Leases jobs from the frontier and crawls them until no job is left. Any number of processes on any number of
+    machines can run a worker, jobs of a killed worker are leased again once their lease expired
+    @param types: optional set of job types this worker crawls, all types otherwise
+    @param idle_exit: if false, the worker keeps polling for new jobs when the frontier is drained
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    owner = worker_name()
+    logger.info(f"Frontier worker {owner} started")
+    # jobs of any event are crawled one after the other in the context of the worker
+    with activate(new_context("")) as ctx:
+        return lease_jobs(ctx, owner, types, idle_exit)
+
+
+def lease_jobs(ctx, owner, types, idle_exit):
+    """
+    @param ctx: CrawlContext of the frontier worker
+    @param owner: name of the frontier worker
+    @param types: optional set of job types this worker crawls, all types otherwise
+    @param idle_exit: if false, the worker keeps polling for new jobs when the frontier is drained
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    while True:
+        jobs = frontier.lease(owner, types)
+        if len(jobs) == 0:
+            if idle_exit and frontier.outstanding(types) == 0:
+                logger.info(f"Frontier drained --> worker {owner} stops")
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        ctx.event_id = jobs[0]["event_id"] or ""
+        logger.info(f"Leased {len(jobs)} {jobs[0]['type']} job(s) of event {ctx.event_id}")
+        if budget.exhausted(ctx.event_id):
+            # the remaining jobs of the event have the lowest priority, they are completed without a request
+            frontier.complete(jobs)
+            continue
+        with frontier.heartbeat(jobs):
+            try:
+                status = FRONTIER_HANDLERS[jobs[0]["type"]](jobs)
+            except Exception:
+                logger.exception(f"Job {jobs[0]['id']} failed --> return to frontier")
+                ctx.reset()
+                frontier.fail(jobs)
+                continue
+        # a job is completed once its pages are written, the next job may read them from the db
+        ingestion.drain()
+        if status == "USAGE_CAP":
+            frontier.release(jobs)
+            send_warn_mail()
+            return status
+        frontier.complete(jobs)
+
+
+@timeit
+def replay_lake(endpoints=None, event=None):
+    """
+    Rebuilds the collections from the raw pages stored in the response lake without making any request
+    @param endpoints: optional set of crawl function names whose pages should be replayed
+    @param event: optional event id whose pages should be replayed
+    """
+    ctx = context()
+    logger.info(f"Replaying stored pages from {lake.directory}")
+    counter = 0
+    for record in lake.read(endpoints=endpoints, event_id=event):
+        ctx.event_id = record["event_id"]
+        try:
+            process_result(record["page"], record["endpoint"], params=record["params"])
+        except Exception:
+            logger.exception(f"Could not replay page {record['key']} of {record['endpoint']} --> Skip")
+        if record["endpoint"] in packed_func:
+            # replayed queries are not split again, their routed results are dropped like those of a finished query
+            ctx.query_routes.pop(record["params"]["query"], None)
+            ctx.query_oldest.pop(record["params"]["query"], None)
+        counter += 1
+        if counter % 1000 == 0:
+            logger.info(f"Replayed {counter} pages")
+    logger.info(f"Replayed {counter} pages")
+
+
 def crawl_worker(job_queue):
     """
     Thread worker which executes jobs
@@ -600,6 +1612,11 @@ def crawl_worker(job_queue):
         job_queue.task_done()
 
 
+FRONTIER_HANDLERS = {"event": run_event_job, "seed": run_seed_jobs, "reply_tree": run_reply_tree_jobs,
+                     "quotes": run_quotes_jobs, "hydrate_users": run_hydrate_users_jobs,
+                     **{job_type: run_stage_job for job_type in STAGES}}
+
+
 class EventSearch:
     def __init__(self, uid, tweet_id, start_date, tag_and_mention, username, comment, days=14):
         """
@@ -620,5 +1637,12 @@ class EventSearch:
         self.username = username
         self.comment = comment
 
+    def window(self):
+        """
+        @return: tuple (start, end) in api format of the time window in which the hashtags or mentions are followed
+        """
+        start = parse_time(self.start_date)
+        return format_time(start), format_time(start + timedelta(days=self.days))
+
     def __repr__(self):
         return f"{self.tweet_id} + {self.username} + {self.uid} + event comment: {self.comment}"
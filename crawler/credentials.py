@@ -0,0 +1,139 @@
+import asyncio
+import configparser
+import os
+import threading
+import time
+
+from rate_limit import RateLimitScheduler
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+
+
+def load_tokens():
+    """
+    Loads the bearer tokens of all configured credentials. The environment variable TWITTER_BEARER_TOKENS (comma
+    separated) has precedence over TWITTER_BEARER_TOKEN, followed by BearerTokens and BearerToken in config.ini
+    @return: list of bearer tokens
+    """
+    if "TWITTER_BEARER_TOKENS" in os.environ:
+        tokens = os.environ.get("TWITTER_BEARER_TOKENS")
+    elif "TWITTER_BEARER_TOKEN" in os.environ:
+        tokens = os.environ.get("TWITTER_BEARER_TOKEN")
+    elif config["twitter"].get("BearerTokens", "").strip():
+        tokens = config["twitter"]["BearerTokens"]
+    else:
+        tokens = config["twitter"]["BearerToken"]
+    return [token.strip() for token in tokens.split(",") if token.strip()]
+
+
+class Credential:
+    def __init__(self, name, bearer_token):
+        """
+        Single app credential with its own rate limit and usage cap state
+        @param name: name of the credential used for logging (never the token itself)
+        @param bearer_token: bearer token of the app
+        """
+        self.name = name
+        self.header = {"Authorization": "Bearer {}".format(bearer_token)}
+        self.scheduler = RateLimitScheduler()
+        self.retired = False
+        self.retired_at = None
+
+    def __repr__(self):
+        return f"Credential {self.name} ({'retired' if self.retired else 'active'})"
+
+
+class CredentialPool:
+    def __init__(self, tokens):
+        """
+        Pool of credentials which routes every request to the active credential with the most headroom on the
+        requested endpoint family
+        @param tokens: list of bearer tokens
+        """
+        if len(tokens) == 0:
+            raise ValueError("No bearer token configured --> set TWITTER_BEARER_TOKENS or BearerTokens in the "
+                             "[twitter] section of config.ini")
+        self.credentials = [Credential(f"credential-{i}", token) for i, token in enumerate(tokens)]
+        self.cap_response = None
+        self.lock = threading.Lock()
+
+    def active(self):
+        return [credential for credential in self.credentials if not credential.retired]
+
+    def reserve(self, family):
+        """
+        Tries to take a permit for the family from the active credential with the most headroom
+        @param family: endpoint family
+        @return: tuple of the credential (none if no permit is available) and the time in seconds to wait otherwise
+        """
+        with self.lock:
+            candidates = sorted(self.active(), key=lambda c: c.scheduler.headroom(family), reverse=True)
+            min_wait = None
+            for credential in candidates:
+                wait = credential.scheduler.reserve(family)
+                if wait == 0:
+                    return credential, 0
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+            return None, min_wait
+
+    def acquire(self, family):
+        """
+        Blocks the calling thread until one of the active credentials has a permit for the family
+        @param family: endpoint family
+        @return: credential that issues the request or none if all credentials are retired
+        """
+        credential, wait = self.reserve(family)
+        while credential is None and wait is not None:
+            if wait > 5:
+                logger.info(f"Rate limit of {family} reached for all credentials --> wait {int(wait)} s")
+            time.sleep(wait)
+            credential, wait = self.reserve(family)
+        return credential
+
+    async def acquire_async(self, family):
+        """
+        Suspends the calling coroutine until one of the active credentials has a permit for the family
+        @param family: endpoint family
+        @return: credential that issues the request or none if all credentials are retired
+        """
+        credential, wait = self.reserve(family)
+        while credential is None and wait is not None:
+            await asyncio.sleep(wait)
+            credential, wait = self.reserve(family)
+        return credential
+
+    def retire(self, credential, response):
+        """
+        Retires a credential that exceeded its monthly usage cap, the crawl continues with the remaining ones
+        @param credential: credential to be retired
+        @param response: usage cap response, returned for all further requests once every credential is retired
+        """
+        with self.lock:
+            self.cap_response = response
+            if credential.retired:
+                return
+            credential.retired = True
+            credential.retired_at = time.time()
+            logger.warning(f"{credential.name} exceeded the monthly usage cap --> retired, "
+                           f"{len(self.active())} credential(s) left")
+
+    def headroom(self, family):
+        """
+        @param family: endpoint family
+        @return: share of the family's permits that is still available, summed over all active credentials
+        """
+        return sum(credential.scheduler.headroom(family) for credential in self.active())
+
+
+def usage_cap_exceeded(response):
+    """
+    Checks if the api answered a request with the monthly usage cap error
+    @param response: response object
+    @return: true if the usage cap of the credential used is exceeded
+    """
+    return response.status_code == 429 and "UsageCapExceeded" in response.text
+
+
+pool = CredentialPool(load_tokens())
@@ -0,0 +1,145 @@
+import configparser
+import math
+from collections import Counter
+from distutils.util import strtobool
+
+import mongo_db as db
+from credentials import pool
+from rate_limit import FAMILY_LIMITS
+from utils import logger, batch
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+follower_config = config["followers"]
+
+PLAN_FOLLOWERS = bool(strtobool(follower_config["PlanFollowers"]))
+CENTRALITY_WEIGHT = float(follower_config["CentralityWeight"])
+FOLLOWER_WEIGHT = float(follower_config["FollowerWeight"])
+EVENT_WEIGHT = float(follower_config["EventWeight"])
+MAX_PER_USER = int(follower_config["MaxPerUser"])
+MAX_REQUESTS_PER_EVENT = int(follower_config["MaxRequestsPerEvent"])
+ALL_FOLLOWERS = bool(strtobool(config["twitter"]["AllFollowers"]))
+TWEET_COLLECTION = config["mongoDB"]["TweetCollection"]
+
+# followers and following return up to 1000 users per page
+FOLLOW_PAGE_SIZE = 1000
+# flag of the crawl --> endpoint family and the public metric that counts the users the crawl returns
+FOLLOW_STAGES = {"followers_crawled": ("followers", "followers_count"),
+                 "following_crawled": ("following", "following_count")}
+
+
+def pages(count):
+    """
+    @param count: number of followers or followed accounts of a user
+    @return: number of requests the crawl of the user takes
+    """
+    if not ALL_FOLLOWERS:
+        return 1
+    if MAX_PER_USER > 0:
+        count = min(count, MAX_PER_USER)
+    return max(math.ceil(count / FOLLOW_PAGE_SIZE), 1)
+
+
+class FollowerPlanner:
+    def __init__(self):
+        """
+        Plans the follower and following crawls of one run. The requests planned per event are counted across the
+        plans of the run, e.g. the polls of a StageRunner, thus MaxRequestsPerEvent holds for the whole run and a new
+        run starts with the full budget
+        """
+        # event uid --> user id --> number of replies and quotes the user wrote or received within the event
+        self.degrees = {}
+        # (family, event uid) --> requests planned in this run
+        self.planned = Counter()
+
+    def event_degrees(self, event_id):
+        """
+        Degree of every user in the reply and quote graph of an event. Computed once per event and run
+        @param event_id: uid of the event
+        @return: Counter user id --> degree
+        """
+        if event_id in self.degrees:
+            return self.degrees[event_id]
+        degree = Counter()
+        quoted = []
+        for tweet in db.read({"event_id": event_id}, TWEET_COLLECTION,
+                             {"author_id": 1, "in_reply_to_user_id": 1, "referenced_tweets": 1}):
+            author_id = tweet.get("author_id")
+            reply_to = tweet.get("in_reply_to_user_id")
+            if reply_to is not None and reply_to != author_id:
+                degree[author_id] += 1
+                degree[reply_to] += 1
+            for reference in tweet.get("referenced_tweets", []):
+                if reference["type"] == "quoted":
+                    quoted.append((author_id, reference["id"]))
+        quoted_authors = {}
+        for id_batch in batch(list({tweet_id for _, tweet_id in quoted}), 1000):
+            for tweet in db.read({"id": {"$in": id_batch}}, TWEET_COLLECTION, {"id": 1, "author_id": 1}):
+                quoted_authors[tweet["id"]] = tweet.get("author_id")
+        for author_id, tweet_id in quoted:
+            quoted_author = quoted_authors.get(tweet_id)
+            if quoted_author is not None and quoted_author != author_id:
+                degree[author_id] += 1
+                degree[quoted_author] += 1
+        self.degrees[event_id] = degree
+        return degree
+
+    def value(self, user, metric):
+        """
+        @param user: user document with id, event_id and public_metrics
+        @param metric: followers_count or following_count
+        @return: value of the followers or followed accounts of the user for the analysis
+        """
+        event_ids = user.get("event_id", [])
+        degree = sum(self.event_degrees(event_id)[user["id"]] for event_id in event_ids)
+        return CENTRALITY_WEIGHT * math.log2(1 + degree) + \
+            FOLLOWER_WEIGHT * math.log10(1 + user.get("public_metrics", {}).get(metric, 0)) + \
+            EVENT_WEIGHT * max(len(event_ids) - 1, 0)
+
+    def plan(self, users, field_name):
+        """
+        Ranks the users whose followers or followed accounts are still to be crawled by their value: their degree in
+        the reply and quote graphs of their events, their number of followers and the number of events they took part
+        in. Users are selected in that order while the requests planned for their event stay within
+        MaxRequestsPerEvent, a user of several events is charged to the one with the most requests left. The crawl of
+        a user stops after MaxPerUser accounts
+        @param users: user documents with id, event_id and public_metrics, they are not modified
+        @param field_name: followers_crawled or following_crawled
+        @return: copies of the selected user documents, most valuable first, with their score and the maximum number
+        of pages
+        """
+        family, metric = FOLLOW_STAGES[field_name]
+        users = [{**user, "score": self.value(user, metric),
+                  "pages": pages(user.get("public_metrics", {}).get(metric, 0))} for user in users]
+        users.sort(key=lambda user: user["score"], reverse=True)
+        selected = []
+        capped = Counter()
+        for user in users:
+            event_id = min(user.get("event_id") or [""], key=lambda uid: self.planned[(family, uid)])
+            if MAX_REQUESTS_PER_EVENT > 0 and \
+                    self.planned[(family, event_id)] + user["pages"] > MAX_REQUESTS_PER_EVENT:
+                capped[event_id] += 1
+                continue
+            self.planned[(family, event_id)] += user["pages"]
+            if ALL_FOLLOWERS and MAX_PER_USER > 0:
+                user["max_pages"] = user["pages"]
+            selected.append(user)
+        report(selected, capped, family)
+        return selected
+
+
+def report(selected, capped, family):
+    """
+    Logs the planned requests and the wall-clock time they take at the rate limit of the family
+    @param selected: selected user documents with their pages
+    @param capped: Counter event uid --> users left out because the event reached MaxRequestsPerEvent
+    @param family: followers or following
+    """
+    requests = sum(user["pages"] for user in selected)
+    limit, window, _ = FAMILY_LIMITS[family]
+    credentials = max(len(pool.active()), 1)
+    seconds = math.ceil(requests / (limit * credentials)) * window
+    logger.info(f"Follower plan {family}: {len(selected)} users, {requests} requests, ~{seconds / 3600:.1f} h with "
+                f"{credentials} credential(s) at {limit} requests per {window} s")
+    for event_id, count in capped.items():
+        logger.warning(f"{count} users of event {event_id or '-'} left out, MaxRequestsPerEvent of {family} reached")
@@ -0,0 +1,240 @@
+import configparser
+import os
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from distutils.util import strtobool
+
+import pymongo
+from pymongo import ReturnDocument, UpdateOne
+
+import mongo_db
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+frontier_config = config["frontier"]
+
+USE_FRONTIER = bool(strtobool(frontier_config["UseFrontier"]))
+LEASE_SECONDS = int(frontier_config["LeaseSeconds"])
+HEARTBEAT_SECONDS = int(frontier_config["HeartbeatSeconds"])
+MAX_ATTEMPTS = int(frontier_config["MaxAttempts"])
+POLL_SECONDS = int(frontier_config["PollSeconds"])
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+# jobs of the same type are leased in batches of this size if they can be crawled together, e.g. with packed queries
+BATCH_SIZE = {"seed": 100, "reply_tree": 100, "quotes": 100, "hydrate_users": 100}
+# default priorities, jobs with a higher priority are leased first. Conversations are finished before the reactions to
+# their tweets are crawled
+PRIORITY = {"event": 100, "seed": 90, "reply_tree": 80, "quotes": 70, "hydrate_users": 60, "likes": 30,
+            "retweets": 30, "timeline": 20, "keyword": 20, "follows": 10, "following": 10}
+ORDER = [("priority", pymongo.DESCENDING), ("score", pymongo.DESCENDING), ("created_at", pymongo.ASCENDING)]
+
+
+def worker_name():
+    """
+    @return: name of this crawler process that is unique across machines
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Frontier:
+    def __init__(self, collection_name):
+        """
+        Durable queue of typed crawl jobs in a mongo collection shared by all crawler processes. A job is leased by one
+        worker for LEASE_SECONDS and the lease is renewed by a heartbeat while it is worked on. Jobs of a killed worker
+        are leased again once their lease expired. Every job has a unique id derived from what it crawls and the event
+        it is crawled for, thus enqueueing a job twice or completing it twice has no effect while two events that find
+        the same conversation or user both crawl it and tag its documents
+        @param collection_name: name of the frontier collection
+        """
+        self.collection_name = collection_name
+        mongo_db.create_collection(collection_name)
+        self.collection = mongo_db.db[collection_name]
+        self.collection.create_index([("state", pymongo.ASCENDING)] + ORDER)
+        self.collection.create_index("lease_token")
+
+    @staticmethod
+    def job_id(job_type, key, event_id=None):
+        """
+        @return: id of the job, jobs of the stages that are not crawled for a specific event have no event in their id
+        """
+        return f"{job_type}:{event_id}:{key}" if event_id else f"{job_type}:{key}"
+
+    def enqueue(self, jobs, requeue_before=None):
+        """
+        Adds jobs to the frontier. Jobs that are already known, including completed ones, are left untouched
+        @param jobs: list of tuples (job type, key, params, event id) and optionally the engagement score as fifth
+        element. Jobs are leased by the priority of their type first and by their score second
+        @param requeue_before: optional time, known jobs that were completed or failed before are crawled again with the
+        new params e.g. to refresh an event
+        """
+        now = datetime.utcnow()
+        requests = []
+        for job in jobs:
+            job_type, key, params, event_id = job[:4]
+            job_score = job[4] if len(job) > 4 else 0
+            job_id = self.job_id(job_type, key, event_id)
+            if requeue_before is not None:
+                requests.append(UpdateOne({"id": job_id, "$or": [
+                    {"state": DONE, "completed_at": {"$lt": requeue_before}},
+                    {"state": FAILED, "failed_at": {"$lt": requeue_before}}
+                ]}, {"$set": {"params": params, "score": job_score, "state": PENDING, "attempts": 0}}))
+            requests.append(UpdateOne({"id": job_id}, {"$setOnInsert": {
+                "type": job_type,
+                "params": params,
+                "event_id": event_id,
+                "priority": PRIORITY.get(job_type, 0),
+                "score": job_score,
+                "state": PENDING,
+                "attempts": 0,
+                "created_at": now
+            }}, upsert=True))
+        for i in range(0, len(requests), 1000):
+            self.collection.bulk_write(requests[i:i + 1000], ordered=False)
+
+    @staticmethod
+    def leasable(now, types=None):
+        """
+        @param now: current time
+        @param types: optional set of job types
+        @return: query of the jobs that can be leased, pending ones and ones whose lease expired
+        """
+        query = {
+            "$or": [{"state": PENDING}, {"state": LEASED, "lease_expires": {"$lt": now}}],
+            "attempts": {"$lt": MAX_ATTEMPTS}
+        }
+        if types is not None:
+            query["type"] = {"$in": list(types)}
+        return query
+
+    def lease(self, owner, types=None):
+        """
+        Leases the job with the highest priority together with further jobs of the same type and event that can be
+        crawled in one batch
+        @param owner: name of the worker
+        @param types: optional set of job types the worker handles
+        @return: list of leased job documents, empty if there is no job
+        """
+        now = datetime.utcnow()
+        token = uuid.uuid4().hex
+        update = {
+            "$set": {"state": LEASED, "lease_owner": owner, "lease_token": token, "leased_at": now,
+                     "lease_expires": now + timedelta(seconds=LEASE_SECONDS)},
+            "$inc": {"attempts": 1}
+        }
+        first = self.collection.find_one_and_update(self.leasable(now, types), update, sort=ORDER,
+                                                    return_document=ReturnDocument.AFTER)
+        if first is None:
+            self.sweep(now)
+            return []
+        jobs = [first]
+        batch_size = BATCH_SIZE.get(first["type"], 1)
+        if batch_size > 1:
+            query = {**self.leasable(now, {first["type"]}), "event_id": first["event_id"]}
+            ids = [job["id"] for job in self.collection.find(query, {"id": 1}).sort(ORDER).limit(batch_size - 1)]
+            if len(ids) > 0:
+                # jobs leased by another worker in the meantime no longer match the query
+                self.collection.update_many({**query, "id": {"$in": ids}}, update)
+                jobs.extend(self.collection.find({"lease_token": token, "id": {"$ne": first["id"]}}))
+        return jobs
+
+    def sweep(self, now):
+        """
+        Marks jobs as failed whose workers were killed MAX_ATTEMPTS times, they are neither leasable nor running
+        @param now: current time
+        """
+        result = self.collection.update_many(
+            {"state": LEASED, "lease_expires": {"$lt": now}, "attempts": {"$gte": MAX_ATTEMPTS}},
+            {"$set": {"state": FAILED, "failed_at": now}})
+        if result.modified_count > 0:
+            logger.warning(f"{result.modified_count} jobs whose lease expired {MAX_ATTEMPTS} times --> failed")
+
+    def renew(self, token):
+        """
+        Extends the lease of a batch of jobs
+        @param token: lease token of the batch
+        @return: number of jobs that are still leased with this token
+        """
+        expires = datetime.utcnow() + timedelta(seconds=LEASE_SECONDS)
+        result = self.collection.update_many({"lease_token": token, "state": LEASED},
+                                             {"$set": {"lease_expires": expires}})
+        return result.matched_count
+
+    @contextmanager
+    def heartbeat(self, jobs):
+        """
+        Renews the lease of the jobs every HEARTBEAT_SECONDS while they are worked on
+        @param jobs: list of leased job documents
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(HEARTBEAT_SECONDS):
+                try:
+                    if self.renew(jobs[0]["lease_token"]) == 0:
+                        logger.warning(f"Lease of {jobs[0]['id']} was lost --> jobs may be crawled twice")
+                except Exception:
+                    logger.exception("Could not renew lease")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    @staticmethod
+    def own_leases(jobs):
+        """
+        @param jobs: list of job documents leased together
+        @return: query of those jobs that have not been leased by another worker in the meantime
+        """
+        return {"id": {"$in": [job["id"] for job in jobs]}, "lease_token": jobs[0]["lease_token"], "state": LEASED}
+
+    def complete(self, jobs):
+        """
+        Marks jobs as done. Jobs that are done already stay untouched, thus a job whose lease expired while it was
+        finished by two workers is completed once
+        @param jobs: list of job documents
+        """
+        self.collection.update_many({"id": {"$in": [job["id"] for job in jobs]}, "state": {"$ne": DONE}},
+                                    {"$set": {"state": DONE, "completed_at": datetime.utcnow()}})
+
+    def fail(self, jobs):
+        """
+        Returns jobs to the frontier after an error. Jobs that failed MAX_ATTEMPTS times are not leased again
+        @param jobs: list of job documents
+        """
+        query = self.own_leases(jobs)
+        self.collection.update_many({**query, "attempts": {"$gte": MAX_ATTEMPTS}},
+                                    {"$set": {"state": FAILED, "failed_at": datetime.utcnow()}})
+        self.collection.update_many(query, {"$set": {"state": PENDING}})
+
+    def release(self, jobs):
+        """
+        Returns jobs to the frontier without counting the attempt e.g. if the usage cap was reached
+        @param jobs: list of job documents
+        """
+        self.collection.update_many(self.own_leases(jobs), {"$set": {"state": PENDING}, "$inc": {"attempts": -1}})
+
+    def outstanding(self, types=None):
+        """
+        @param types: optional set of job types
+        @return: number of jobs that are leased by a running worker or can be leased
+        """
+        now = datetime.utcnow()
+        running = {"state": LEASED, "lease_expires": {"$gte": now}}
+        if types is not None:
+            running["type"] = {"$in": list(types)}
+        return self.collection.count_documents({"$or": [running, self.leasable(now, types)]})
+
+
+# the FrontierCollection is only created if the frontier is used
+frontier = Frontier(config["mongoDB"]["FrontierCollection"]) if USE_FRONTIER else None
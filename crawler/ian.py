@@ -1,6 +1,7 @@
 import queue
 from threading import Thread
 import crawl_routines as bot
+import frontier
 from api_endpoints import ApiEndpoints
 from utils import *
 
@@ -13,3 +14,5 @@ if __name__ == "__main__":
         logger.info(f"Main: create and start thread for crawl queue {j}")
     Thread(target=bot.crawl_worker, args=(crawl_queue,), daemon=True).start()
     crawl_queue.join()
+    if frontier.USE_FRONTIER:
+        bot.frontier_worker(types={"keyword"})
@@ -0,0 +1,373 @@
+import atexit
+import configparser
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from distutils.util import strtobool
+
+from bson import json_util
+
+import mongo_db as db
+import seen_filter
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+ingestion_config = config["ingestion"]
+
+WRITE_BEHIND = bool(strtobool(ingestion_config["WriteBehind"])) and bool(strtobool(config["mongoDB"]["UseMongo"]))
+QUEUE_SIZE = int(ingestion_config["QueueSize"])
+WRITERS = int(ingestion_config["Writers"])
+BATCH_PAGES = int(ingestion_config["BatchPages"])
+JOURNAL = ingestion_config["Journal"]
+STATUS_SECONDS = float(ingestion_config["StatusSeconds"])
+RETRIES = int(ingestion_config["Retries"])
+RETRY_SECONDS = float(ingestion_config["RetrySeconds"])
+
+
+def write(records, collection, sets):
+    """
+    Upserts the records of pages with one bulk write and adds them to the seen filter of the collection if all of them
+    were written
+    @param records: tweet or user objects
+    @param collection: db collection to write to
+    @param sets: dictionary field --> value to add to the array of the field e.g. the current event id, or a list of
+    such dictionaries with one per record
+    @return: number of failed writes
+    """
+    sets = sets if isinstance(sets, list) else [sets] * len(records)
+    reports = db.bulk_writer(collection).write_all([db.upsert(res, res_sets) for res, res_sets in zip(records, sets)])
+    errors = sum(report["errors"] for report in reports)
+    if errors == 0:
+        # records of a failed write might not be stored, the filter must not claim they are
+        seen_filter.add([res["id"] for res in records], collection)
+    return errors
+
+
+class Journal:
+    def __init__(self, path):
+        """
+        Pages handed to the writers are appended to the journal before the crawler continues, the sequence number of
+        the last page all pages up to which are written is kept next to it. Pages of a crashed process that were not
+        written are replayed on the next start. The upserts are idempotent, thus replaying a written page does no harm.
+        Pages that could not be written after all retries are moved to the failed journal next to it, they are replayed
+        on the next start as well
+        @param path: path of the journal file
+        """
+        self.path = path
+        self.committed_path = path + ".committed"
+        self.failed_path = path + ".failed"
+        self.lock = threading.Lock()
+        self.file = None
+        self.committed = 0
+        if os.path.exists(self.committed_path):
+            with open(self.committed_path) as committed_file:
+                self.committed = int(committed_file.read().strip() or 0)
+        self.seq = self.committed
+        # sequence numbers above the committed one that are written already
+        self.done = set()
+
+    @staticmethod
+    def entries(path):
+        """
+        @param path: path of a journal file
+        @return: generator of the pages (sequence number, collection, records, sets) of the file
+        """
+        if not os.path.exists(path):
+            return
+        with open(path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json_util.loads(line)
+                except ValueError:
+                    # the process crashed while appending this page, it was not handed to a writer
+                    logger.warning(f"Skipping truncated journal entry of {path}")
+                    continue
+                yield entry["seq"], entry["collection"], entry["records"], entry["sets"]
+
+    @staticmethod
+    def dumps(page):
+        seq, collection, records, sets = page
+        return json_util.dumps({"seq": seq, "collection": collection, "records": records, "sets": sets}) + "\n"
+
+    def recover(self):
+        """
+        Reads the pages that were not written. New pages are numbered after the highest journaled sequence number, thus
+        they are never mistaken for written ones
+        @return: list of pages (sequence number, collection, records, sets), the failed ones first
+        """
+        pages = list(self.entries(self.failed_path))
+        for page in self.entries(self.path):
+            self.seq = max(self.seq, page[0])
+            if page[0] > self.committed:
+                pages.append(page)
+        return pages
+
+    def reset(self, failed_pages):
+        """
+        Empties the journal after the replay of the recovered pages
+        @param failed_pages: recovered pages that could not be written, they are kept in the failed journal
+        """
+        with self.lock:
+            self.replace(self.failed_path, "".join(self.dumps(page) for page in failed_pages))
+            self.committed = self.seq
+            self.replace(self.committed_path, str(self.committed))
+            self.done.clear()
+            open(self.path, "w").close()
+
+    @staticmethod
+    def replace(path, content):
+        with open(path + ".tmp", "w") as tmp_file:
+            tmp_file.write(content)
+        os.replace(path + ".tmp", path)
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.path, "a")
+
+    def append(self, collection, records, sets):
+        """
+        @return: sequence number of the page
+        """
+        with self.lock:
+            self.seq += 1
+            self.file.write(self.dumps((self.seq, collection, records, sets)))
+            self.file.flush()
+            return self.seq
+
+    def fail(self, pages):
+        """
+        Moves pages that could not be written to the failed journal, the caller commits them afterwards
+        @param pages: list of pages (sequence number, collection, records, sets)
+        """
+        with self.lock:
+            with open(self.failed_path, "a") as failed_file:
+                failed_file.write("".join(self.dumps(page) for page in pages))
+
+    def commit(self, seqs):
+        """
+        Marks pages as written. Once all appended pages are written the journal is emptied
+        @param seqs: sequence numbers of the written pages
+        """
+        with self.lock:
+            self.done.update(seqs)
+            committed = self.committed
+            while committed + 1 in self.done:
+                committed += 1
+                self.done.remove(committed)
+            if committed == self.committed:
+                return
+            self.committed = committed
+            self.replace(self.committed_path, str(committed))
+            if self.committed == self.seq and self.file is not None:
+                self.file.seek(0)
+                self.file.truncate()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class Ingestion:
+    def __init__(self, num_writers=WRITERS, queue_size=QUEUE_SIZE, batch_pages=BATCH_PAGES, journal=JOURNAL):
+        """
+        Write-behind stage between the crawler threads and the db. Crawler threads hand the documents of a page to a
+        bounded queue and continue with the next request, writer threads persist them in bulk writes. A full queue
+        blocks the crawler threads until the writers caught up
+        @param num_writers: number of writer threads
+        @param queue_size: maximum number of pages waiting to be written
+        @param batch_pages: maximum number of queued pages a writer combines into one bulk write per collection
+        @param journal: path of the journal file, every crawler process needs its own
+        """
+        self.num_writers = max(num_writers, 1)
+        self.batch_pages = max(batch_pages, 1)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.journal = Journal(journal)
+        self.writers = []
+        self.running = False
+        self.lock = threading.Lock()
+        # collection --> number of queued pages holding each id, the records are not written yet
+        self.queued = {}
+        self.stats = Counter()
+        self.started = self.last_status = time.time()
+
+    def start(self):
+        """
+        Replays the pages a crashed process did not write and starts the writers
+        @return: self
+        """
+        pending = self.journal.recover()
+        if len(pending) > 0:
+            logger.info(f"Replaying {len(pending)} journaled pages that were not written")
+            failed = [page for page in pending if write(page[2], page[1], page[3]) > 0]
+            if len(failed) > 0:
+                logger.warning(f"{len(failed)} journaled pages could not be written --> kept in "
+                               f"{self.journal.failed_path}")
+            self.journal.reset(failed)
+        self.journal.open()
+        self.running = True
+        for _ in range(self.num_writers):
+            writer = threading.Thread(target=self.writer, daemon=True)
+            writer.start()
+            self.writers.append(writer)
+        atexit.register(self.close)
+        logger.info(f"Write-behind ingestion started with {self.num_writers} writers")
+        return self
+
+    def submit(self, records, collection, sets):
+        """
+        Hands the documents of a page to the writers, they are written immediately if the ingestion is not running. The
+        ids of a queued page are added to the seen filter right away, the journal makes sure the page is written
+        @param records: tweet or user objects
+        @param collection: db collection to write to
+        @param sets: dictionary field --> value to add to the array of the field
+        """
+        if len(records) == 0:
+            return
+        if not self.running:
+            write(records, collection, sets)
+            return
+        seq = self.journal.append(collection, records, sets)
+        ids = [res["id"] for res in records]
+        seen_filter.add(ids, collection)
+        with self.lock:
+            self.queued.setdefault(collection, Counter()).update(ids)
+        started = time.time()
+        self.queue.put((seq, collection, records, sets))
+        with self.lock:
+            self.stats["pages_in"] += 1
+            self.stats["documents_in"] += len(records)
+            self.stats["blocked_seconds"] += time.time() - started
+
+    def is_queued(self, ids, collection):
+        """
+        @param ids: ids of documents
+        @param collection: db collection
+        @return: true if a record of one of the ids is queued and not written yet
+        """
+        with self.lock:
+            queued = self.queued.get(collection)
+            return queued is not None and any(queued[key] > 0 for key in ids)
+
+    def drain(self):
+        """
+        Blocks until the queued pages are written
+        """
+        if self.running:
+            self.queue.join()
+
+    def writer(self):
+        while True:
+            try:
+                page = self.queue.get(timeout=1)
+            except queue.Empty:
+                self.report()
+                continue
+            if page is None:
+                self.queue.task_done()
+                return
+            pages = [page]
+            while len(pages) < self.batch_pages:
+                try:
+                    page = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if page is None:
+                    # shutdown marker of another writer, it is put back after the batch is written
+                    self.queue.task_done()
+                    self.queue.put(None)
+                    break
+                pages.append(page)
+            try:
+                self.write_pages(pages)
+            finally:
+                for _ in pages:
+                    self.queue.task_done()
+            self.report()
+
+    def write_pages(self, pages):
+        """
+        Writes queued pages with one bulk write per collection. A failed write is retried Retries times with growing
+        pauses, meanwhile the queue fills up and slows the crawler threads down. Pages that still could not be written
+        are moved to the failed journal and replayed on the next start, thus the journal of the running process keeps
+        shrinking
+        @param pages: list of tuples (sequence number, collection, records, sets)
+        """
+        started = time.time()
+        by_collection = {}
+        for page in pages:
+            by_collection.setdefault(page[1], []).append(page)
+        written = []
+        failed = []
+        documents = 0
+        for collection, collection_pages in by_collection.items():
+            records = [res for _, _, page_records, _ in collection_pages for res in page_records]
+            sets = [page_sets for _, _, page_records, page_sets in collection_pages for _ in page_records]
+            for attempt in range(RETRIES + 1):
+                if attempt > 0:
+                    logger.warning(f"Writing {len(collection_pages)} pages to {collection} failed --> retry {attempt} "
+                                   f"of {RETRIES}")
+                    time.sleep(RETRY_SECONDS * 2 ** (attempt - 1))
+                if write(records, collection, sets) == 0:
+                    written.extend(page[0] for page in collection_pages)
+                    documents += len(records)
+                    break
+            else:
+                logger.error(f"Could not write {len(collection_pages)} pages to {collection} --> kept in "
+                             f"{self.journal.failed_path}")
+                failed.extend(collection_pages)
+        if len(failed) > 0:
+            self.journal.fail(failed)
+        self.journal.commit(written + [page[0] for page in failed])
+        with self.lock:
+            for _, collection, records, _ in pages:
+                self.queued[collection] = self.queued[collection] - Counter(res["id"] for res in records)
+            self.stats["pages_out"] += len(written)
+            self.stats["pages_failed"] += len(failed)
+            self.stats["documents_out"] += documents
+            self.stats["write_seconds"] += time.time() - started
+
+    def report(self):
+        """
+        Logs the crawl and the write throughput every StatusSeconds
+        """
+        with self.lock:
+            if time.time() - self.last_status < STATUS_SECONDS:
+                return
+            self.last_status = time.time()
+        logger.info(f"Ingestion: {self.status_line()}")
+
+    def status_line(self):
+        with self.lock:
+            stats = dict(self.stats)
+        elapsed = max(time.time() - self.started, 1e-9)
+        return f"crawled {stats.get('documents_in', 0) / elapsed:.1f} docs/s ({stats.get('pages_in', 0)} pages), " \
+               f"written {stats.get('documents_out', 0) / elapsed:.1f} docs/s ({stats.get('pages_out', 0)} pages, " \
+               f"{stats.get('write_seconds', 0):.1f} s in bulk writes, {stats.get('pages_failed', 0)} pages failed), " \
+               f"{self.queue.qsize()} pages queued, " \
+               f"crawlers blocked {stats.get('blocked_seconds', 0):.1f} s"
+
+    def close(self):
+        """
+        Stops accepting pages, writes the queued pages in the order they were queued and empties the journal
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.queue.join()
+        for _ in self.writers:
+            self.queue.put(None)
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+        self.journal.close()
+        logger.info(f"Ingestion closed: {self.status_line()}")
+
+
+ingestion = Ingestion()
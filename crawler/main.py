@@ -1,7 +1,10 @@
-import datetime
 import queue
+import sys
 from threading import Thread
+import crawl_planner
 import crawl_routines as bot
+import frontier
+import stage_runner
 from crawl_routines import EventSearch
 from api_endpoints import ApiEndpoints
 from utils import *
@@ -99,33 +102,45 @@ event_list = [
 ]
 api = ApiEndpoints()
 if __name__ == "__main__":
-    # TODO Remove following line if you want to iterate through the whole event list
-    # event_list = []
-    # for event in event_list:
-    #     logger.info(f"Start crawl of {event}")
-    #     bot.event_id = event.uid
-    #     try:
-    #         if event.tweet_id is not None:
-    #             bot.get_seed(event.tweet_id)
-    #             bot.pipeline(event.tweet_id)
-    #         if event.tag_and_mention is not None:
-    #             start = datetime.datetime.strptime(event.start_date, '%Y-%m-%dT%H:%M:%S.%fZ')
-    #             end_date = start + datetime.timedelta(days=event.days)
-    #             bot.hashtag_or_mention(event.tag_and_mention, start=event.start_date, end=end_date.isoformat("T") + "Z")
-    #     except Exception:
-    #         logger.exception(f"Unrecoverable error for event {event.uid}")
-    #     # reset author cache
-    #     bot.author_cache = {}
-    # logger.info("Successfully crawled conversation trees")
-    crawl_queue = queue.Queue()
-    # crawl_queue.put(bot.crawl_likes)
-    # crawl_queue.put(bot.crawl_retweets)
-    crawl_queue.put(bot.crawl_timelines)
-    # crawl_queue.put(bot.crawl_following)
-    # crawl_queue.put(bot.crawl_follows)
-    #
-    for j in range(crawl_queue.qsize()):
-        logger.info(f"Main: create and start thread for crawl queue {j}")
-    Thread(target=bot.crawl_worker, args=(crawl_queue,), daemon=True).start()
-    crawl_queue.join()
-    bot.user_temp()
+    if crawl_planner.DRY_RUN:
+        # estimate the searches of all events without fetching a single tweet
+        crawl_planner.report(crawl_planner.plan_events(event_list))
+        sys.exit(0)
+    try:
+        if bot.CRAWL_EVENTS:
+            # TODO Remove following line if you want to iterate through the whole event list
+            # event_list = []
+            if frontier.USE_FRONTIER:
+                for plan in crawl_planner.plan_events(event_list):
+                    bot.submit_event(plan.job, slices=plan.slices)
+                # the conversations are crawled before the stages below pick up their users and tweets
+                bot.frontier_worker()
+            elif bot.COMPILE_EVENTS:
+                # search overlapping hashtags and windows of the events once, the compiled searches are planned instead
+                bot.crawl_compiled(event_list)
+            else:
+                plans = crawl_planner.plan_events(event_list)
+                bot.crawl_events([plan.job for plan in plans], slices={plan.job.uid: plan.slices for plan in plans})
+            logger.info("Successfully crawled conversation trees")
+        if stage_runner.RUN_STAGES and not frontier.USE_FRONTIER:
+            # all stages of the [stages] section at once, each rate limit family with its own workers
+            stage_runner.run()
+        else:
+            crawl_queue = queue.Queue()
+            # crawl_queue.put(bot.crawl_likes)
+            # crawl_queue.put(bot.crawl_retweets)
+            crawl_queue.put(bot.crawl_timelines)
+            # crawl_queue.put(bot.crawl_following)
+            # crawl_queue.put(bot.crawl_follows)
+            #
+            for j in range(crawl_queue.qsize()):
+                logger.info(f"Main: create and start thread for crawl queue {j}")
+            Thread(target=bot.crawl_worker, args=(crawl_queue,), daemon=True).start()
+            crawl_queue.join()
+            if frontier.USE_FRONTIER:
+                # the stages above only added their jobs to the frontier, they are crawled with all other processes
+                bot.frontier_worker()
+        bot.user_temp()
+    finally:
+        # writes the pages still queued for the db, see [ingestion]
+        bot.ingestion.close()
@@ -1,5 +1,8 @@
 import pymongo.errors
-from pymongo import MongoClient
+import threading
+import time
+from collections import Counter
+from pymongo import MongoClient, UpdateOne
 from utils import logger
 from bson.objectid import ObjectId
 import configparser
@@ -76,12 +79,31 @@ def push_to_array(unique_id, field, value, collection_name):
         logger.error("Error writing results to DB: %s", e)
 
 
+def push_to_arrays(unique_ids, field, value, collection_name):
+    """
+    Pushes value to array for a certain attribute of all documents matching the given unique ids with one request
+    @param unique_ids: list of either unique user or tweet ids
+    @param field: name that contains the array to be updated
+    @param value: that should be pushed onto the array
+    @param collection_name: name of the collection
+    """
+    if len(unique_ids) == 0:
+        return
+    try:
+        collection = db[collection_name]
+        collection.update_many({'id': {'$in': unique_ids}}, {'$push': {f'{field}': value}})
+    except Exception as e:
+        logger.error("Error writing results to DB: %s", e)
+
+
 def insert(json_data, collection_name):
     """
     Inserts data into collection
     @param json_data: to be inserted
     @param collection_name: name of collection
     """
+    if len(json_data) == 0:
+        return
     collection = db[collection_name]
     try:
         # ordered=False will skip entries when id already in collection
@@ -93,6 +115,100 @@ def insert(json_data, collection_name):
         logger.error(f"Error writing results to DB: {e}")
 
 
+def upsert(document, sets):
+    """
+    Builds an upsert of a document: the document is inserted if its id is not stored yet, the values of sets are added
+    to the arrays of the stored or inserted document if they are not present yet
+    @param document: tweet or user object with an id
+    @param sets: dictionary field --> value to add to the array of the field
+    @return: UpdateOne operation for bulk_write
+    """
+    update = {}
+    # the id is copied from the filter on insert
+    on_insert = {key: value for key, value in document.items() if key != "id" and key not in sets}
+    # empty operators are rejected by the server
+    if len(on_insert) > 0:
+        update["$setOnInsert"] = on_insert
+    if len(sets) > 0:
+        update["$addToSet"] = sets
+    if len(update) == 0:
+        # a document of nothing but its id is inserted if it is not stored yet
+        update["$setOnInsert"] = {"id": document["id"]}
+    return UpdateOne({"id": document["id"]}, update, upsert=True)
+
+
+class BulkWriter:
+    def __init__(self, collection_name, max_operations):
+        """
+        Sends the write operations of a collection with unordered bulk_writes and keeps the totals of their reports
+        @param collection_name: name of the collection
+        @param max_operations: maximum number of operations of one bulk_write
+        """
+        self.collection_name = collection_name
+        self.max_operations = max_operations
+        self.lock = threading.Lock()
+        self.totals = Counter()
+
+    def write_all(self, operations):
+        """
+        @param operations: list of pymongo write operations e.g. from upsert()
+        @return: list of batch reports of at most max_operations operations each, see write()
+        """
+        return [self.write(operations[i:i + self.max_operations])
+                for i in range(0, len(operations), self.max_operations)]
+
+    def write(self, operations, retry=True):
+        """
+        @param operations: list of write operations
+        @param retry: if true, upserts that failed with a duplicate key error are repeated once. Two writers that
+        upsert the same new id at the same time insert it once, the upsert of the other one fails
+        @return: dictionary with the number of operations, inserted, matched and modified documents, errors and seconds
+        """
+        started = time.time()
+        errors = []
+        try:
+            details = db[self.collection_name].bulk_write(operations, ordered=False).bulk_api_result
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details
+            errors = details.get("writeErrors", [])
+        except Exception as e:
+            logger.error(f"Error writing results to DB: {e}")
+            details = {}
+            errors = [{"index": i} for i in range(len(operations))]
+        report = {"operations": len(operations),
+                  "inserted": details.get("nUpserted", 0) + details.get("nInserted", 0),
+                  "matched": details.get("nMatched", 0), "modified": details.get("nModified", 0),
+                  "errors": len(errors), "seconds": time.time() - started}
+        duplicates = [operations[error["index"]] for error in errors if error.get("code") == 11000]
+        if retry and len(duplicates) > 0:
+            retried = self.write(duplicates, retry=False)
+            report["matched"] += retried["matched"]
+            report["modified"] += retried["modified"]
+            report["errors"] -= len(duplicates) - retried["errors"]
+        with self.lock:
+            self.totals.update(report)
+        logger.info(f"Bulk write of {report['operations']} operations to {self.collection_name} in "
+                    f"{report['seconds'] * 1000:.0f} ms: {report['inserted']} inserted, {report['matched']} matched, "
+                    f"{report['modified']} modified, {report['errors']} errors")
+        return report
+
+
+# collection name --> BulkWriter
+writers = {}
+writers_lock = threading.Lock()
+
+
+def bulk_writer(collection_name):
+    """
+    @param collection_name: name of the collection
+    @return: BulkWriter of the collection shared by all threads
+    """
+    with writers_lock:
+        if collection_name not in writers:
+            writers[collection_name] = BulkWriter(collection_name, BULK_WRITE_SIZE)
+        return writers[collection_name]
+
+
 def read(query_attr, collection_name, return_attr=None):
     """
     Reads data according to query attributes from db and returns results
@@ -152,6 +268,7 @@ def delete_duplicates_arr(collection_name, attribute):
 config = configparser.ConfigParser()
 config.read("../config.ini")
 mongo_config = config["mongoDB"]
+BULK_WRITE_SIZE = int(mongo_config["BulkWriteSize"])
 
 client = MongoClient(f'mongodb://{mongo_config["IP"]}:{mongo_config["Port"]}/')
 db = client[mongo_config["DatabaseName"]]
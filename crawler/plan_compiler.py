@@ -0,0 +1,153 @@
+from api_endpoints import ApiEndpoints
+from query_packer import MAX_QUERY_LENGTH
+from search_shards import parse_time
+from utils import logger
+
+
+def normalize(term):
+    """
+    @param term: hashtag or mention e.g. #BoycottGoya, the api matches them case-insensitively
+    @return: lower case term
+    """
+    return term.strip().lower()
+
+
+def tweet_terms(tweet):
+    """
+    @param tweet: tweet object with entities
+    @return: set of the normalized hashtags and mentions of the tweet
+    """
+    entities = tweet.get("entities", {})
+    terms = {f"#{hashtag['tag']}".lower() for hashtag in entities.get("hashtags", [])}
+    terms.update(f"@{mention['username']}".lower() for mention in entities.get("mentions", []))
+    return terms
+
+
+class CompiledSearch:
+    def __init__(self, terms, start, end, events):
+        """
+        One hashtag and mention search that serves several events
+        @param terms: list of hashtags and mentions of the query
+        @param start: start of the time window in api format
+        @param end: end of the time window in api format
+        @param events: EventSearch objects with a term of the query whose window overlaps the search window
+        """
+        self.terms = terms
+        self.start = start
+        self.end = end
+        self.events = events
+        # EventSearch uid --> tuple (normalized terms, start, end)
+        self.scopes = {event.uid: ({normalize(term) for term in event.tag_and_mention}, *event.window())
+                       for event in events}
+
+    def __repr__(self):
+        return f"CompiledSearch {self.start} - {self.end} of {len(self.terms)} terms for {self.name()}"
+
+    def name(self):
+        return "+".join(event.uid for event in self.events)
+
+    def query(self):
+        return ApiEndpoints.hashtag_query(self.terms)
+
+    def match(self, tweet):
+        """
+        @param tweet: tweet object returned by the search
+        @return: uids of the events whose terms and window match the tweet. Tweets that matched the query through text
+        that is no entity are assigned to all events of the search whose window contains them
+        """
+        created_at = tweet.get("created_at")
+        terms = tweet_terms(tweet)
+        in_window = [uid for uid, (_, start, end) in self.scopes.items()
+                     if created_at is None or start <= created_at <= end]
+        matched = [uid for uid in in_window if len(self.scopes[uid][0] & terms) > 0]
+        return matched if len(matched) > 0 else in_window
+
+
+def segments(events):
+    """
+    Splits the timeline at every start and end of an event window. Within a segment the same events are active, adjacent
+    segments with the same terms are merged
+    @param events: EventSearch objects with hashtags or mentions
+    @return: list of tuples (start, end, dict normalized term --> term, list of active events) oldest first
+    """
+    windows = {event.uid: event.window() for event in events}
+    boundaries = sorted({boundary for window in windows.values() for boundary in window})
+    merged = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        active = [event for event in events if windows[event.uid][0] <= start and end <= windows[event.uid][1]]
+        terms = {}
+        for event in active:
+            for term in sorted(event.tag_and_mention):
+                terms.setdefault(normalize(term), term)
+        if len(terms) == 0:
+            continue
+        if len(merged) > 0 and merged[-1][1] == start and merged[-1][2].keys() == terms.keys():
+            first, _, _, previous = merged[-1]
+            merged[-1] = (first, end, terms, previous + [event for event in active if event not in previous])
+        else:
+            merged.append((start, end, terms, active))
+    return merged
+
+
+def compile_events(events, max_length=MAX_QUERY_LENGTH):
+    """
+    Merges the hashtag and mention searches of events into a minimal set of searches. Every term is searched once per
+    point in time no matter how many events follow it, and the terms of events with overlapping windows share queries
+    up to the query length limit, thus tweets that several events match are fetched once
+    @param events: list of EventSearch objects, events without hashtags or mentions are left out
+    @param max_length: maximum length of a query
+    @return: list of CompiledSearches
+    """
+    events = [event for event in events if event.tag_and_mention]
+    searches = []
+    for start, end, terms, active in segments(events):
+        groups = [[]]
+        for term in sorted(terms.values(), key=normalize):
+            if len(groups[-1]) > 0 and len(ApiEndpoints.hashtag_query(groups[-1] + [term])) > max_length:
+                groups.append([])
+            groups[-1].append(term)
+        for group in groups:
+            keys = {normalize(term) for term in group}
+            served = [event for event in active if any(normalize(term) in keys for term in event.tag_and_mention)]
+            searches.append(CompiledSearch(group, start, end, served))
+    report(events, searches)
+    return searches
+
+
+def term_days(terms, start, end):
+    return len(terms) * (parse_time(end) - parse_time(start)).total_seconds() / 86400
+
+
+def report(events, searches):
+    """
+    Logs how many searched term days the compiled searches save compared to one search per event
+    @param events: EventSearch objects with hashtags or mentions
+    @param searches: CompiledSearches of the events
+    """
+    separate = sum(term_days(event.tag_and_mention, *event.window()) for event in events)
+    compiled = sum(term_days(search.terms, search.start, search.end) for search in searches)
+    saved = 0 if separate == 0 else (1 - compiled / separate) * 100
+    logger.info(f"Compiled {len(events)} event searches into {len(searches)} searches: {compiled:.0f} instead of "
+                f"{separate:.0f} term days ({saved:.1f}% overlap)")
+
+
+def assign(found, events):
+    """
+    Assigns every found conversation to the first event that matched it, in the order of the event list. It is crawled
+    in the context of that event, the other matching events are added to its tweets afterwards
+    @param found: dict conversation id --> set of uids of the events that matched it
+    @param events: list of EventSearch objects in crawl order
+    @return: tuple of the dict event uid --> conversation ids to crawl and the dict conversation id --> uids of the
+    further events
+    """
+    rank = {event.uid: i for i, event in enumerate(events)}
+    primary = {event.uid: [] for event in events}
+    further = {}
+    for key, uids in found.items():
+        ordered = sorted(uids, key=lambda uid: rank.get(uid, len(rank)))
+        if len(ordered) == 0:
+            continue
+        primary[ordered[0]].append(key)
+        if len(ordered) > 1:
+            further[key] = ordered[1:]
+    return primary, further
@@ -0,0 +1,149 @@
+import configparser
+import heapq
+import itertools
+import math
+import threading
+from collections import Counter
+
+import mongo_db as db
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+priority_config = config["priority"]
+
+REPLY_WEIGHT = float(priority_config["ReplyWeight"])
+QUOTE_WEIGHT = float(priority_config["QuoteWeight"])
+LIKE_WEIGHT = float(priority_config["LikeWeight"])
+RETWEET_WEIGHT = float(priority_config["RetweetWeight"])
+FOLLOWER_WEIGHT = float(priority_config["FollowerWeight"])
+EVENT_BUDGET = int(priority_config["EventBudget"])
+BATCH_SIZE = int(priority_config["BatchSize"])
+
+USER_COLLECTION = config["mongoDB"]["UserCollection"]
+TWEET_COLLECTION = config["mongoDB"]["TweetCollection"]
+# public metric --> weight in the engagement score
+METRIC_WEIGHTS = {"reply_count": REPLY_WEIGHT, "quote_count": QUOTE_WEIGHT, "like_count": LIKE_WEIGHT,
+                  "retweet_count": RETWEET_WEIGHT}
+
+
+def score(public_metrics, followers=0):
+    """
+    Engagement score of a tweet, tweets with a higher score are crawled first
+    @param public_metrics: public metrics of the tweet
+    @param followers: number of followers of the author
+    @return: weighted sum of the metrics and the order of magnitude of the followers
+    """
+    return sum(weight * public_metrics.get(metric, 0) for metric, weight in METRIC_WEIGHTS.items()) + \
+        FOLLOWER_WEIGHT * math.log10(1 + (followers or 0))
+
+
+def tweet_score(tweet, author_cache):
+    """
+    @param tweet: cached Tweet
+    @param author_cache: dictionary of author id --> User holding the follower counts
+    @return: engagement score of the tweet
+    """
+    author = author_cache.get(tweet.author_id)
+    return score({"reply_count": tweet.reply_count, "quote_count": tweet.quote_count, "like_count": tweet.like_count,
+                  "retweet_count": tweet.retweet_count}, 0 if author is None else author.followers_count)
+
+
+def rank_tweets(query, limit=0):
+    """
+    Ranks the tweets matching a query by their engagement score. The score is computed, sorted and limited by the db,
+    the follower counts of the authors are joined from the user collection
+    @param query: query of the tweet collection
+    @param limit: maximum number of tweets, 0 for all
+    @return: cursor of documents with id, public_metrics, author_id and score, highest score first
+    """
+    followers = {"$ifNull": [{"$arrayElemAt": ["$author.public_metrics.followers_count", 0]}, 0]}
+    engagement = [{"$multiply": [weight, {"$ifNull": [f"$public_metrics.{metric}", 0]}]}
+                  for metric, weight in METRIC_WEIGHTS.items()]
+    pipeline = [
+        {"$match": query},
+        {"$project": {"_id": 0, "id": 1, "public_metrics": 1, "author_id": 1}},
+        {"$lookup": {"from": USER_COLLECTION, "localField": "author_id", "foreignField": "id", "as": "author"}},
+        {"$addFields": {"score": {"$add": engagement + [
+            {"$multiply": [FOLLOWER_WEIGHT, {"$log10": {"$add": [1, followers]}}]}]}}},
+        {"$project": {"author": 0}},
+        {"$sort": {"score": -1}}
+    ]
+    if limit > 0:
+        pipeline.append({"$limit": limit})
+    return db.db[TWEET_COLLECTION].aggregate(pipeline, allowDiskUse=True)
+
+
+class ExpansionQueue:
+    def __init__(self):
+        """
+        Max-heap of tweets whose reply trees and quotes still have to be crawled
+        """
+        self.heap = []
+        # tie breaker, tweets with the same score are expanded in the order they were found
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, tweet_id, reply_count, tweet_score=math.inf):
+        """
+        @param tweet_id: id of the tweet
+        @param reply_count: expected number of replies, none if unknown
+        @param tweet_score: engagement score, seeds without metrics are expanded first
+        """
+        heapq.heappush(self.heap, (-tweet_score, next(self.counter), tweet_id, reply_count))
+
+    def pop_many(self, n):
+        """
+        @param n: maximum number of tweets
+        @return: list of tuples (tweet id, reply count, score) of the n tweets with the highest score
+        """
+        popped = [heapq.heappop(self.heap) for _ in range(min(n, len(self.heap)))]
+        return [(tweet_id, reply_count, -negative_score) for negative_score, _, tweet_id, reply_count in popped]
+
+
+class EventBudget:
+    def __init__(self, limit):
+        """
+        Number of requests spent per event by this crawler process
+        @param limit: maximum number of requests per event, 0 for no limit
+        """
+        self.limit = limit
+        # event id --> limit of an event that is crawled concurrently with others
+        self.limits = {}
+        self.spent = Counter()
+        # events whose exhausted budget has been logged
+        self.reported = set()
+        self.lock = threading.Lock()
+
+    def set_limit(self, event_id, limit):
+        """
+        @param event_id: uid of the event
+        @param limit: maximum number of requests of the event, 0 for no limit
+        """
+        self.limits[event_id] = limit
+
+    def charge(self, event_id, requests=1):
+        with self.lock:
+            self.spent[event_id] += requests
+
+    def exhausted(self, event_id):
+        """
+        @param event_id: event to check
+        @return: true if the event spent its budget and its remaining low priority work is skipped
+        """
+        limit = self.limits.get(event_id, self.limit)
+        if limit <= 0 or not event_id:
+            return False
+        if self.spent[event_id] < limit:
+            return False
+        with self.lock:
+            if event_id not in self.reported:
+                self.reported.add(event_id)
+                logger.warning(f"Request budget of event {event_id} exhausted ({self.spent[event_id]} requests) --> "
+                               f"skip its remaining work")
+        return True
+
+
+budget = EventBudget(EVENT_BUDGET)
@@ -0,0 +1,154 @@
+import configparser
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+search_config = config["search"]
+
+MAX_QUERY_LENGTH = int(search_config["MaxQueryLength"])
+MAX_PACKED_PAGES = int(search_config["MaxPackedPages"])
+
+
+class PackItem:
+    def __init__(self, key, clause, weight=None, score=0):
+        """
+        Single search that can be OR'ed together with others into one full-archive query
+        @param key: id the results of this clause are routed back to (conversation id or quoted tweet id)
+        @param clause: search clause e.g. conversation_id:123
+        @param weight: expected number of results, none if unknown
+        @param score: engagement score of the searched tweet, queries holding high scores are crawled first
+        """
+        self.key = key
+        self.clause = clause
+        self.weight = weight
+        self.score = score
+        # reply or quote count the search is based on, the weight only counts the new results of a re-crawl
+        self.metric = weight
+        # newest result of the last crawl, none if the clause has not been crawled before
+        self.since_id = None
+        # oldest result of a query that paged too deep before the clause was split off, the newer results are crawled
+        self.until_id = None
+
+    def __repr__(self):
+        return f"{self.clause} (~{self.weight} results)"
+
+
+def conversation_item(tweet_id, reply_count=None, score=0):
+    return PackItem(tweet_id, f"conversation_id:{tweet_id}", reply_count, score)
+
+
+def quote_item(username, tweet_id, quote_count=None, score=0):
+    return PackItem(tweet_id, f'url:"https://twitter.com/{username}/status/{tweet_id}"', quote_count, score)
+
+
+def build_query(group, suffix=""):
+    """
+    Builds the OR'ed query of a group
+    @param group: list of PackItems
+    @param suffix: operators that apply to all clauses e.g. is:quote
+    @return: query string
+    """
+    if len(group) == 1:
+        query = group[0].clause
+    else:
+        query = "(" + " OR ".join(item.clause for item in group) + ")"
+    return f"{query} {suffix}".strip()
+
+
+def pack(items, suffix="", max_weight=None, max_length=MAX_QUERY_LENGTH):
+    """
+    Greedily packs search clauses into as few queries as possible. A query stays below the query length limit of the
+    api and the expected number of results of its clauses below max_weight. Clauses with an unknown or too high weight
+    get their own query
+    @param items: list of PackItems
+    @param suffix: operators that apply to all clauses e.g. is:quote
+    @param max_weight: maximum expected number of results of one query, none for no restriction
+    @param max_length: maximum query length
+    @return: list of groups (lists of PackItems)
+    """
+    groups = []
+    current = []
+    current_weight = 0
+    for item in sorted(items, key=lambda i: -1 if i.weight is None else i.weight):
+        if item.weight is None or (max_weight is not None and item.weight >= max_weight):
+            groups.append([item])
+            continue
+        too_long = len(build_query(current + [item], suffix)) > max_length
+        too_heavy = max_weight is not None and current_weight + item.weight > max_weight
+        if len(current) > 0 and (too_long or too_heavy):
+            groups.append(current)
+            current = []
+            current_weight = 0
+        current.append(item)
+        current_weight += item.weight
+    if len(current) > 0:
+        groups.append(current)
+    return groups
+
+
+def since_id(group):
+    """
+    @param group: list of PackItems
+    @return: oldest since_id of the group, none if a clause has not been crawled before
+    """
+    since_ids = [item.since_id for item in group]
+    if None in since_ids:
+        return None
+    return min(since_ids, key=int)
+
+
+def until_id(group):
+    """
+    @param group: list of PackItems
+    @return: newest until_id of the group, none if a clause has no until_id
+    """
+    until_ids = [item.until_id for item in group]
+    if None in until_ids:
+        return None
+    return max(until_ids, key=int)
+
+
+def by_score(groups):
+    """
+    @param groups: list of groups (lists of PackItems)
+    @return: groups ordered by the highest score of their items, highest first
+    """
+    return sorted(groups, key=lambda group: max(item.score for item in group), reverse=True)
+
+
+def split(group, hits, page_size):
+    """
+    Splits a group whose query paged too deep. Clauses that already returned at least a page of results get their own
+    query, the remaining ones are divided in halves
+    @param group: list of PackItems
+    @param hits: dictionary of key --> number of results routed to that clause so far
+    @param page_size: number of results per page
+    @return: list of new groups
+    """
+    dense = [item for item in group if hits.get(item.key, 0) >= page_size]
+    sparse = [item for item in group if hits.get(item.key, 0) < page_size]
+    groups = [[item] for item in dense]
+    if len(dense) == 0 and len(sparse) > 1:
+        middle = len(sparse) // 2
+        groups.extend([sparse[:middle], sparse[middle:]])
+    elif len(sparse) > 0:
+        groups.append(sparse)
+    return groups
+
+
+def conversation_key(tweet):
+    """
+    @param tweet: tweet object of a packed reply search
+    @return: conversation the tweet belongs to
+    """
+    return tweet.get("conversation_id")
+
+
+def quoted_key(tweet):
+    """
+    @param tweet: tweet object of a packed quote search
+    @return: id of the quoted tweet
+    """
+    for referenced in tweet.get("referenced_tweets", []):
+        if referenced["type"] == "quoted":
+            return referenced["id"]
+    return None
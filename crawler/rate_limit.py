@@ -0,0 +1,189 @@
+import asyncio
+import re
+import threading
+import time
+
+from utils import logger
+
+# Default limits per endpoint family (requests, window in seconds, minimum seconds between two requests). They only
+# seed the buckets, every response corrects them according to its x-rate-limit-* headers
+FAMILY_LIMITS = {
+    "search_all": (300, 900, 1),
+    "counts_all": (300, 900, 0),
+    "tweets": (300, 900, 0),
+    "users": (300, 900, 0),
+    "timeline": (1500, 900, 0),
+    "followers": (15, 900, 0),
+    "following": (15, 900, 0),
+    "liking_users": (75, 900, 0),
+    "liked_tweets": (75, 900, 0),
+    "retweeted_by": (75, 900, 0),
+}
+DEFAULT_LIMIT = (15, 900, 0)
+
+FAMILY_PATTERNS = [
+    (re.compile(r"^tweets/search/all"), "search_all"),
+    (re.compile(r"^tweets/counts/all"), "counts_all"),
+    (re.compile(r"^tweets/[^/]+/liking_users"), "liking_users"),
+    (re.compile(r"^tweets/[^/]+/retweeted_by"), "retweeted_by"),
+    (re.compile(r"^tweets/?$"), "tweets"),
+    (re.compile(r"^users/[^/]+/followers"), "followers"),
+    (re.compile(r"^users/[^/]+/following"), "following"),
+    (re.compile(r"^users/[^/]+/liked_tweets"), "liked_tweets"),
+    (re.compile(r"^users/[^/]+/tweets"), "timeline"),
+    (re.compile(r"^users/?$"), "users"),
+]
+
+
+def endpoint_family(endpoint):
+    """
+    Maps an api endpoint to the family that shares one rate limit
+    @param endpoint: path of the endpoint relative to the api base url e.g. tweets/123/liking_users
+    @return: name of the endpoint family
+    """
+    for pattern, family in FAMILY_PATTERNS:
+        if pattern.match(endpoint):
+            return family
+    return endpoint
+
+
+class TokenBucket:
+    def __init__(self, limit, window, min_interval=0):
+        """
+        Permits for one endpoint family within the current rate limit window
+        @param limit: maximum number of requests per window
+        @param window: length of the rate limit window in seconds
+        @param min_interval: minimum time in seconds between two requests
+        """
+        self.limit = limit
+        self.window = window
+        self.min_interval = min_interval
+        self.remaining = limit
+        self.reset = 0
+        self.next_slot = 0
+        self.in_flight = 0
+
+    def reserve(self, now):
+        """
+        Takes a permit if one is available
+        @param now: current timestamp
+        @return: 0 if a permit was taken, otherwise the time in seconds to wait before trying again
+        """
+        if now >= self.reset:
+            # window passed --> estimate new window until the next response corrects it
+            self.remaining = self.limit
+            self.reset = now + self.window
+        if self.remaining - self.in_flight <= 0:
+            return self.reset - now + 1
+        if now < self.next_slot:
+            return self.next_slot - now
+        self.in_flight += 1
+        self.next_slot = now + self.min_interval
+        return 0
+
+    def update(self, limit, remaining, reset):
+        """
+        Corrects the bucket according to the rate limit headers of a response that used one permit
+        @param limit: x-rate-limit-limit header
+        @param remaining: x-rate-limit-remaining header
+        @param reset: x-rate-limit-reset header
+        """
+        self.in_flight = max(self.in_flight - 1, 0)
+        self.limit = limit
+        if reset != self.reset:
+            self.reset = reset
+            self.remaining = remaining
+        else:
+            self.remaining = min(self.remaining - 1, remaining)
+
+    def release(self):
+        """
+        Returns a permit of a request that failed before reaching the api
+        """
+        self.in_flight = max(self.in_flight - 1, 0)
+
+    def headroom(self):
+        """
+        @return: share of the current window's permits that is still available
+        """
+        return max(self.remaining - self.in_flight, 0) / self.limit if self.limit else 0
+
+
+class RateLimitScheduler:
+    def __init__(self, limits=None):
+        """
+        Scheduler with one token bucket per endpoint family for a single credential. Callers acquire a permit before
+        sending a request, thus requests that would certainly be answered with 429 are never sent and waiting on one
+        family does not block requests of another family
+        @param limits: optional dictionary of family --> (limit, window, min_interval) to seed the buckets
+        """
+        self.limits = FAMILY_LIMITS if limits is None else limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, family):
+        if family not in self.buckets:
+            self.buckets[family] = TokenBucket(*self.limits.get(family, DEFAULT_LIMIT))
+        return self.buckets[family]
+
+    def reserve(self, family):
+        """
+        Tries to take a permit for the family without blocking
+        @param family: endpoint family
+        @return: 0 if a permit was taken, otherwise the time in seconds to wait before trying again
+        """
+        with self.lock:
+            return self.bucket(family).reserve(time.time())
+
+    def acquire(self, family):
+        """
+        Blocks the calling thread until a permit for the family is available
+        @param family: endpoint family
+        """
+        wait = self.reserve(family)
+        while wait > 0:
+            if wait > 5:
+                logger.info(f"Rate limit of {family} reached --> wait {int(wait)} s")
+            time.sleep(wait)
+            wait = self.reserve(family)
+
+    async def acquire_async(self, family):
+        """
+        Suspends the calling coroutine until a permit for the family is available
+        @param family: endpoint family
+        """
+        wait = self.reserve(family)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.reserve(family)
+
+    def update(self, family, headers):
+        """
+        Corrects the bucket of the family according to the rate limit headers of a response
+        @param family: endpoint family
+        @param headers: response headers
+        """
+        with self.lock:
+            bucket = self.bucket(family)
+            try:
+                bucket.update(int(headers["x-rate-limit-limit"]), int(headers["x-rate-limit-remaining"]),
+                              int(headers["x-rate-limit-reset"]))
+            except (KeyError, ValueError):
+                bucket.release()
+
+    def release(self, family):
+        """
+        Returns the permit of a request that failed before a response was received
+        @param family: endpoint family
+        """
+        with self.lock:
+            self.bucket(family).release()
+
+    def headroom(self, family):
+        """
+        @param family: endpoint family
+        @return: share of the family's permits in the current window that is still available
+        """
+        with self.lock:
+            return self.bucket(family).headroom()
+
@@ -0,0 +1,142 @@
+import atexit
+import configparser
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from distutils.util import strtobool
+
+from utils import logger, decode_json, encode_json
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+lake_config = config["lake"]
+
+
+def canonical(params):
+    """
+    Serializes request parameters in a stable way, sets (e.g. hashtags) are sorted
+    @param params: parameter dictionary of a request
+    @return: json string
+    """
+    return json.dumps(params, sort_keys=True, default=sorted)
+
+
+def page_key(endpoint, params, next_token):
+    """
+    Key of a raw page
+    @param endpoint: name of the crawl function that requested the page
+    @param params: parameters of the request without next_token
+    @param next_token: pagination token of the page, none for the first page
+    @return: hex digest identifying the page
+    """
+    return hashlib.sha1(f"{endpoint}|{canonical(params)}|{next_token}".encode("utf-8")).hexdigest()
+
+
+class ResponseLake:
+    def __init__(self, directory, segment_size):
+        """
+        Append-only store of raw api pages. Pages are written as json lines into gzip compressed segments, a new segment
+        is started once segment_size bytes have been written. Every process writes its own segments
+        @param directory: directory holding the segments
+        @param segment_size: uncompressed size in bytes after which a new segment is started
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segment = None
+        self.written = 0
+        self.counter = 0
+
+    def _rotate(self):
+        if self.segment is not None:
+            self.segment.close()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"segment-{int(time.time())}-{os.getpid()}-{self.counter:06d}.jsonl.gz"
+        self.segment = gzip.open(os.path.join(self.directory, name), "ab")
+        self.counter += 1
+        self.written = 0
+
+    def append(self, endpoint, params, page, event_id):
+        """
+        Stores a raw page before it is processed. Every page is flushed, thus a crash loses at most the page being
+        written
+        @param endpoint: name of the crawl function that requested the page
+        @param params: parameters of the request including the next_token the page was requested with
+        @param page: decoded json page as returned by the api
+        @param event_id: event the page was crawled for
+        """
+        next_token = params.get("next_token")
+        params = {k: v for k, v in params.items() if k != "next_token"}
+        record = {
+            "key": page_key(endpoint, params, next_token),
+            "endpoint": endpoint,
+            "params": params,
+            "next_token": next_token,
+            "event_id": event_id,
+            "crawled_at": time.time(),
+            "page": page
+        }
+        line = encode_json(record) + b"\n"
+        with self.lock:
+            if self.segment is None or self.written >= self.segment_size:
+                self._rotate()
+            self.segment.write(line)
+            self.segment.flush(zlib.Z_SYNC_FLUSH)
+            self.written += len(line)
+
+    def segments(self):
+        """
+        @return: paths of all segments in the order they were written
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        names = [name for name in os.listdir(self.directory) if name.endswith(".jsonl.gz")]
+        # segment-<timestamp>-<pid>-<counter>.jsonl.gz
+        names.sort(key=lambda name: [int(part) for part in name[:-len(".jsonl.gz")].split("-")[1:]])
+        return [os.path.join(self.directory, name) for name in names]
+
+    def read(self, endpoints=None, event_id=None, unique=True):
+        """
+        Reads stored pages from all segments
+        @param endpoints: optional set of crawl function names to be read
+        @param event_id: optional event whose pages should be read
+        @param unique: if true, pages that were crawled several times are only returned once
+        @return: generator of stored records
+        """
+        seen = set()
+        for path in self.segments():
+            with gzip.open(path, "rb") as segment:
+                try:
+                    for line in segment:
+                        try:
+                            record = decode_json(line)
+                        except ValueError:
+                            logger.warning(f"Skip truncated record in {path}")
+                            continue
+                        if endpoints is not None and record["endpoint"] not in endpoints:
+                            continue
+                        if event_id is not None and record["event_id"] != event_id:
+                            continue
+                        if unique:
+                            if record["key"] in seen:
+                                continue
+                            seen.add(record["key"])
+                        yield record
+                except EOFError:
+                    # segment of a process that did not shut down cleanly
+                    logger.warning(f"Segment {path} is not closed --> read up to last complete record")
+
+    def close(self):
+        with self.lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+
+STORE_RESPONSES = bool(strtobool(lake_config["StoreResponses"]))
+lake = ResponseLake(lake_config["Directory"], int(float(lake_config["SegmentSizeMB"]) * 1024 * 1024))
+atexit.register(lake.close)
@@ -0,0 +1,64 @@
+import configparser
+from datetime import datetime, timedelta
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+sharding_config = config["sharding"]
+
+SEARCH_SLICES = int(sharding_config["SearchSlices"])
+TIMELINE_SLICES = int(sharding_config["TimelineSlices"])
+SHARD_WORKERS = int(sharding_config["Workers"])
+MAX_SLICE_PAGES = int(sharding_config["MaxSlicePages"])
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+
+def parse_time(timestamp):
+    """
+    @param timestamp: date in the format yyyy-mm-ddTHH:MM:SS.000Z or yyyy-mm-ddTHH:MM:SSZ
+    @return: datetime object
+    """
+    if "." not in timestamp:
+        timestamp = timestamp.replace("Z", ".000Z")
+    return datetime.strptime(timestamp, TIME_FORMAT)
+
+
+def format_time(date):
+    """
+    @param date: datetime object
+    @return: date in the format yyyy-mm-ddTHH:MM:SS.000Z expected by the api
+    """
+    return date.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def time_slices(start, end, num_slices):
+    """
+    Splits a time window into consecutive slices of equal length. Slices do not overlap since the api includes the
+    start_time and excludes the end_time
+    @param start: start of the window in api format
+    @param end: end of the window in api format
+    @param num_slices: number of slices
+    @return: list of tuples (start, end) in api format, most recent slice first
+    """
+    start_date = parse_time(start)
+    end_date = parse_time(end)
+    # full-archive search works on seconds
+    step = max((end_date - start_date) / max(num_slices, 1), timedelta(seconds=1))
+    slices = []
+    slice_start = start_date
+    while slice_start < end_date:
+        slice_end = min(slice_start + step, end_date)
+        slices.append((format_time(slice_start), format_time(slice_end)))
+        slice_start = slice_end
+    return slices[::-1]
+
+
+def remaining_window(start, oldest_created_at):
+    """
+    Window of a slice that has not been crawled yet. Results are returned newest first, thus everything older than the
+    oldest tweet seen so far is left. The second of the oldest tweet is included again, duplicates are dropped on insert
+    @param start: start of the slice in api format
+    @param oldest_created_at: creation date of the oldest tweet crawled so far
+    @return: tuple (start, end) in api format
+    """
+    return start, format_time(parse_time(oldest_created_at) + timedelta(seconds=1))
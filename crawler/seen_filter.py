@@ -0,0 +1,126 @@
+import configparser
+import hashlib
+import math
+import threading
+import time
+from distutils.util import strtobool
+
+import mongo_db as db
+from utils import logger
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+filter_config = config["seenfilter"]
+
+USE_SEEN_FILTER = bool(strtobool(filter_config["UseSeenFilter"])) and bool(strtobool(config["mongoDB"]["UseMongo"]))
+CAPACITY = int(filter_config["Capacity"])
+ERROR_RATE = float(filter_config["ErrorRate"])
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        """
+        Fixed size Bloom filter of string ids
+        @param capacity: number of ids the filter holds at the given error rate
+        @param error_rate: probability that an id that was never added is reported as contained
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(round(self.num_bits / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class SeenFilter:
+    def __init__(self, collection_name, capacity=CAPACITY, error_rate=ERROR_RATE):
+        """
+        Ids stored in a collection. A full Bloom filter is followed by one of twice the capacity and half the error
+        rate, thus the filter grows with the collection while the overall error rate stays below the given one.
+        An id that is not contained has certainly not been stored by this process and was not stored when the filter
+        was warmed. Contained ids have to be checked against the db
+        @param collection_name: name of the collection
+        @param capacity: capacity of the first Bloom filter
+        @param error_rate: error rate of the first Bloom filter
+        """
+        self.collection_name = collection_name
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            if self.filters[-1].count >= self.filters[-1].capacity:
+                last = self.filters[-1]
+                self.filters.append(BloomFilter(last.capacity * 2, last.error_rate / 2))
+            self.filters[-1].add(key)
+
+    def __contains__(self, key):
+        return any(key in bloom for bloom in self.filters)
+
+    def warm(self):
+        """
+        Adds the ids of all documents of the collection, only the id index is read
+        """
+        start = time.time()
+        count = 0
+        for doc in db.db[self.collection_name].find({}, {"id": 1, "_id": 0}).hint([("id", 1)]).batch_size(10000):
+            self.add(doc["id"])
+            count += 1
+        logger.info(f"Seen filter of {self.collection_name} warmed with {count} ids in {time.time() - start:.1f} s")
+
+
+# collection name --> warmed SeenFilter
+filters = {}
+filters_lock = threading.Lock()
+
+
+def seen(collection_name):
+    """
+    @param collection_name: name of the collection
+    @return: SeenFilter of the collection, warmed from the collection on first use
+    """
+    if collection_name not in filters:
+        with filters_lock:
+            if collection_name not in filters:
+                seen_filter = SeenFilter(collection_name)
+                seen_filter.warm()
+                filters[collection_name] = seen_filter
+    return filters[collection_name]
+
+
+def maybe_stored(ids, collection_name):
+    """
+    @param ids: list of ids
+    @param collection_name: name of the collection
+    @return: ids that may be stored in the collection and have to be looked up, all if the filter is disabled
+    """
+    if not USE_SEEN_FILTER:
+        return ids
+    seen_filter = seen(collection_name)
+    return [key for key in ids if key in seen_filter]
+
+
+def add(ids, collection_name):
+    """
+    @param ids: ids that have been stored in the collection
+    @param collection_name: name of the collection
+    """
+    if not USE_SEEN_FILTER:
+        return
+    seen_filter = seen(collection_name)
+    for key in ids:
+        seen_filter.add(key)
@@ -0,0 +1,174 @@
+import configparser
+import itertools
+import queue
+import threading
+from distutils.util import strtobool
+
+import concurrency
+import crawl_routines as bot
+import follower_planner
+from crawl_context import thread
+from utils import logger, send_warn_mail
+
+config = configparser.ConfigParser()
+config.read("../config.ini")
+stage_config = config["stages"]
+
+RUN_STAGES = bool(strtobool(stage_config["RunStages"]))
+STAGE_NAMES = [name.strip() for name in stage_config["Stages"].split(",") if name.strip()]
+POLL_SECONDS = float(stage_config["PollSeconds"])
+IDLE_POLLS = int(stage_config["IdlePolls"])
+POLL_LIMIT = int(stage_config["PollLimit"])
+
+# stage --> function (stage, ids to skip) returning the documents still to be crawled and the maximum number of
+# threads, the same maxima as the wrappers crawl_likes, crawl_retweets, ... use
+STAGE_JOBS = {"likes": (lambda stage, skip: bot.like_jobs(skip, POLL_LIMIT), 75),
+              "retweets": (lambda stage, skip: bot.retweet_jobs(skip, POLL_LIMIT), 75),
+              "timeline": (lambda stage, skip: bot.timeline_jobs(skip), concurrency.MAX_SEARCH_THREADS),
+              "follows": (lambda stage, skip: bot.follow_jobs("followers_crawled", skip, stage.planner), 15),
+              "following": (lambda stage, skip: bot.follow_jobs("following_crawled", skip, stage.planner), 15)}
+
+
+class Stage:
+    def __init__(self, name):
+        """
+        A crawl stage whose documents are read from the db
+        @param name: job type of the stage e.g. likes, see crawl_routines.STAGES
+        """
+        self.name = name
+        f_name, self.field_name = bot.STAGES[name]
+        self.crawl_function = getattr(bot.api, f_name)
+        self.family = bot.STAGE_FAMILIES[f_name]
+        self.jobs, self.max_threads = STAGE_JOBS[name]
+        # ids of the documents that are queued or crawled right now
+        self.pending = set()
+        # ids of the documents whose crawl raised an error, they are not queued again by this runner
+        self.failed = set()
+        self.crawled = 0
+        # the follower stages charge the users of all polls to the request budget of the run
+        self.planner = follower_planner.FollowerPlanner()
+
+    def __repr__(self):
+        return f"Stage {self.name}: {len(self.pending)} pending, {self.crawled} crawled, {len(self.failed)} failed"
+
+
+class StageRunner:
+    def __init__(self, stage_names=None, poll_seconds=POLL_SECONDS, idle_polls=IDLE_POLLS):
+        """
+        Crawls the threaded stages at the same time. Every rate limit family has its own work queue and worker pool,
+        thus while one family waits for its rate limit window the others keep crawling. New documents that upstream
+        stages store in the db, e.g. users that liked a tweet, are picked up by polling the db
+        @param stage_names: names of the stages to run, the Stages of the config otherwise
+        @param poll_seconds: interval in which the db is polled for new documents
+        @param idle_polls: the runner stops after this many polls without new documents while no document was pending,
+        0 to run until stopped
+        """
+        self.stages = [Stage(name) for name in (STAGE_NAMES if stage_names is None else stage_names)]
+        self.poll_seconds = poll_seconds
+        self.idle_polls = idle_polls
+        # family --> queue of tuples (-score, order, stage, document)
+        self.queues = {}
+        self.controllers = {}
+        for stage in self.stages:
+            self.queues.setdefault(stage.family, queue.PriorityQueue())
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.status = None
+
+    def poll(self):
+        """
+        Queues the documents of every stage that are not pending yet
+        @return: number of documents queued
+        """
+        queued = 0
+        for stage in self.stages:
+            with self.lock:
+                skip = stage.pending | stage.failed
+            documents = stage.jobs(stage, skip)
+            if documents is None:
+                continue
+            for document in documents:
+                with self.lock:
+                    stage.pending.add(document["id"])
+                    self.queues[stage.family].put((-document.get("score", 0), next(self.order), stage, document))
+                queued += 1
+        return queued
+
+    def busy(self):
+        with self.lock:
+            return any(len(stage.pending) > 0 for stage in self.stages)
+
+    def worker(self, family, thread_number):
+        """
+        Crawls the documents of a family's queue until the runner is stopped
+        @param family: endpoint family
+        @param thread_number: number of the worker within the family
+        """
+        job_queue = self.queues[family]
+        controller = self.controllers[family]
+        while not self.stopped.is_set():
+            try:
+                _, _, stage, document = job_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                with controller.slot():
+                    status = bot.execute_and_modify(stage.crawl_function, document, stage.field_name)
+            except Exception:
+                logger.exception(f"Could not crawl {stage.name} of {document['id']} --> Skip")
+                status = "FAILED"
+            with self.lock:
+                stage.pending.discard(document["id"])
+                if status == "FAILED":
+                    stage.failed.add(document["id"])
+                elif status != "USAGE_CAP":
+                    stage.crawled += 1
+            if status == "USAGE_CAP":
+                self.stop("USAGE_CAP")
+
+    def stop(self, status=None):
+        with self.lock:
+            if self.stopped.is_set():
+                return
+            self.status = status
+            self.stopped.set()
+        if status == "USAGE_CAP":
+            send_warn_mail()
+
+    def run(self):
+        """
+        Starts the worker pools and polls the db until no stage has work left
+        @return: USAGE_CAP if the usage cap was reached, none otherwise
+        """
+        for family in self.queues:
+            max_threads = sum(stage.max_threads for stage in self.stages if stage.family == family)
+            self.controllers[family] = concurrency.StageController(family, family, max_threads).start()
+            for i in range(max_threads):
+                thread(self.worker, args=(family, i), daemon=True).start()
+        logger.info(f"Running the stages {', '.join(stage.name for stage in self.stages)} in "
+                    f"{len(self.queues)} rate limit families")
+        idle = 0
+        while not self.stopped.is_set():
+            queued = self.poll()
+            if queued > 0 or self.busy():
+                idle = 0
+            else:
+                idle += 1
+                if 0 < self.idle_polls <= idle:
+                    logger.info("No stage has documents left --> stop")
+                    self.stop()
+                    break
+            logger.info(" | ".join(repr(stage) for stage in self.stages))
+            self.stopped.wait(self.poll_seconds)
+        for controller in self.controllers.values():
+            controller.stop()
+        return self.status
+
+
+def run(stage_names=None):
+    """
+    Crawls the given stages, the Stages of the config otherwise, at the same time
+    @return: USAGE_CAP if the usage cap was reached, none otherwise
+    """
+    return StageRunner(stage_names).run()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the crawler modules read ../config.ini and log to ../output relative to the working directory, like main.py does
+CRAWLER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(CRAWLER_DIR)
+sys.path.insert(0, CRAWLER_DIR)
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("requests")
+
+from crawl_planner import slice_boundaries, SEARCH_PAGE_SIZE
+
+
+def days(*counts):
+    return [(f"2021-01-{i + 1:02d}T00:00:00.000Z", f"2021-01-{i + 2:02d}T00:00:00.000Z", count)
+            for i, count in enumerate(counts)]
+
+
+def test_slices_have_roughly_equal_volume():
+    slices = slice_boundaries(days(1000, 1000, 1000, 1000), num_slices=2, max_pages=100)
+    assert slices == [("2021-01-03T00:00:00.000Z", "2021-01-05T00:00:00.000Z"),
+                      ("2021-01-01T00:00:00.000Z", "2021-01-03T00:00:00.000Z")]
+
+
+def test_empty_days_at_the_edges_are_left_out():
+    slices = slice_boundaries(days(0, 0, 100, 100, 0), num_slices=1, max_pages=100)
+    assert slices == [("2021-01-03T00:00:00.000Z", "2021-01-05T00:00:00.000Z")]
+
+
+def test_slices_stay_within_max_pages():
+    slices = slice_boundaries(days(*[SEARCH_PAGE_SIZE] * 6), num_slices=1, max_pages=2)
+    assert len(slices) == 3
+
+
+def test_dense_day_becomes_its_own_slice():
+    slices = slice_boundaries(days(10, 100 * SEARCH_PAGE_SIZE, 10), num_slices=1, max_pages=2)
+    assert ("2021-01-02T00:00:00.000Z", "2021-01-03T00:00:00.000Z") in slices
+
+
+def test_no_tweets_no_slices():
+    assert slice_boundaries(days(0, 0), num_slices=4, max_pages=10) == []
@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("bson")
+pytest.importorskip("pymongo")
+
+from ingestion import Journal
+
+
+def page(journal, n):
+    return journal.append("tweets", [{"id": str(n)}], {})
+
+
+def test_uncommitted_pages_are_replayed(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.open()
+    first, second, third = page(journal, 1), page(journal, 2), page(journal, 3)
+    journal.commit([first])
+    journal.close()
+    recovered = Journal(path).recover()
+    assert [seq for seq, _, _, _ in recovered] == [second, third]
+    assert recovered[0][1:] == ("tweets", [{"id": "2"}], {})
+
+
+def test_commit_waits_for_gaps(tmp_path):
+    journal = Journal(str(tmp_path / "journal"))
+    journal.open()
+    first, second = page(journal, 1), page(journal, 2)
+    journal.commit([second])
+    assert journal.committed == 0
+    journal.commit([first])
+    assert journal.committed == second
+    journal.close()
+    assert Journal(journal.path).recover() == []
+
+
+def test_failed_pages_are_replayed_first(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.open()
+    failed = (page(journal, 1), "tweets", [{"id": "1"}], {})
+    journal.fail([failed])
+    journal.commit([failed[0]])
+    pending = page(journal, 2)
+    journal.close()
+    recovered = Journal(path).recover()
+    assert [seq for seq, _, _, _ in recovered] == [failed[0], pending]
+
+
+def test_truncated_entry_is_skipped(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.open()
+    page(journal, 1)
+    journal.close()
+    with open(path, "a") as journal_file:
+        journal_file.write('{"seq": 2, "coll')
+    recovered = Journal(path)
+    assert len(recovered.recover()) == 1
+    assert recovered.seq == 1
+
+
+def test_reset_numbers_new_pages_after_replayed_ones(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = Journal(path)
+    journal.open()
+    page(journal, 1)
+    page(journal, 2)
+    journal.close()
+    restarted = Journal(path)
+    restarted.recover()
+    restarted.reset([])
+    restarted.open()
+    assert page(restarted, 3) == 3
+    restarted.close()
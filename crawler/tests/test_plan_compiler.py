@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("requests")
+
+from plan_compiler import compile_events, assign
+
+
+class Event:
+    def __init__(self, uid, terms, start, end):
+        """
+        Stand-in for crawl_routines.EventSearch, which needs the db to be imported
+        """
+        self.uid = uid
+        self.tag_and_mention = terms
+        self.start = start
+        self.end = end
+
+    def window(self):
+        return self.start, self.end
+
+
+JAN_1 = "2021-01-01T00:00:00.000Z"
+JAN_2 = "2021-01-02T00:00:00.000Z"
+JAN_3 = "2021-01-03T00:00:00.000Z"
+JAN_4 = "2021-01-04T00:00:00.000Z"
+
+
+def test_shared_term_is_searched_once_per_point_in_time():
+    events = [Event("a", {"#Goya"}, JAN_1, JAN_3), Event("b", {"#goya", "@goya"}, JAN_2, JAN_4)]
+    searches = compile_events(events)
+    # terms match case-insensitively, adjacent segments with the same terms are one search
+    assert [(s.start, s.end, sorted(term.lower() for term in s.terms), s.name()) for s in searches] == [
+        (JAN_1, JAN_2, ["#goya"], "a"),
+        (JAN_2, JAN_4, ["#goya", "@goya"], "a+b")]
+
+
+def test_events_without_terms_are_left_out():
+    assert compile_events([Event("a", set(), JAN_1, JAN_2)]) == []
+
+
+def test_queries_respect_max_length():
+    terms = {f"#tag{i}" for i in range(10)}
+    searches = compile_events([Event("a", terms, JAN_1, JAN_2)], max_length=60)
+    assert len(searches) > 1
+    assert all(len(search.query()) <= 60 for search in searches)
+    assert set().union(*(search.terms for search in searches)) == terms
+
+
+def test_match_assigns_tweets_by_entities_and_window():
+    events = [Event("a", {"#Goya"}, JAN_1, JAN_3), Event("b", {"@goya"}, JAN_1, JAN_3)]
+    search = compile_events(events)[0]
+    tweet = {"created_at": "2021-01-02T10:00:00.000Z", "entities": {"mentions": [{"username": "Goya"}]}}
+    assert search.match(tweet) == ["b"]
+    # matched through text only --> all events whose window contains the tweet
+    assert search.match({"created_at": "2021-01-02T10:00:00.000Z"}) == ["a", "b"]
+
+
+def test_assign_crawls_conversation_in_first_event():
+    events = [Event("a", {"#x"}, JAN_1, JAN_2), Event("b", {"#x"}, JAN_1, JAN_2)]
+    primary, further = assign({"1": {"b", "a"}, "2": {"b"}, "3": set()}, events)
+    assert primary == {"a": ["1"], "b": ["2"]}
+    assert further == {"1": ["b"]}
@@ -0,0 +1,46 @@
+from query_packer import PackItem, build_query, conversation_item, pack, split
+
+
+def items(*weights):
+    return [conversation_item(str(i), weight) for i, weight in enumerate(weights)]
+
+
+def test_pack_combines_clauses_into_one_query():
+    groups = pack(items(1, 2, 3))
+    assert len(groups) == 1
+    assert build_query(groups[0]) == "(conversation_id:0 OR conversation_id:1 OR conversation_id:2)"
+
+
+def test_pack_respects_max_weight():
+    groups = pack(items(40, 40, 40, 10), max_weight=100)
+    assert [sum(item.weight for item in group) for group in groups] == [90, 40]
+
+
+def test_pack_gives_unknown_and_heavy_clauses_their_own_query():
+    groups = pack(items(None, 500, 1, 1), max_weight=100)
+    assert [[item.key for item in group] for group in groups] == [["0"], ["1"], ["2", "3"]]
+
+
+def test_pack_respects_max_length():
+    group_items = items(*[1] * 10)
+    max_length = len(build_query(group_items[:3], "is:reply"))
+    groups = pack(group_items, suffix="is:reply", max_length=max_length)
+    assert [len(group) for group in groups] == [3, 3, 3, 1]
+    assert all(len(build_query(group, "is:reply")) <= max_length for group in groups)
+
+
+def test_split_separates_dense_clauses():
+    group = items(1, 1, 1)
+    groups = split(group, {"0": 500, "1": 3}, 500)
+    assert [[item.key for item in g] for g in groups] == [["0"], ["1", "2"]]
+
+
+def test_split_halves_group_without_dense_clauses():
+    group = items(1, 1, 1, 1)
+    groups = split(group, {}, 500)
+    assert [[item.key for item in g] for g in groups] == [["0", "1"], ["2", "3"]]
+
+
+def test_split_keeps_single_sparse_clause():
+    group = [PackItem("a", "conversation_id:a", 1)]
+    assert [[item.key for item in g] for g in split(group, {}, 500)] == [["a"]]
@@ -0,0 +1,46 @@
+from rate_limit import TokenBucket, endpoint_family
+
+
+def test_permits_run_out_until_reset():
+    bucket = TokenBucket(2, 900)
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(100) == 901
+    bucket.update(2, 1, 1000)
+    bucket.update(2, 0, 1000)
+    assert bucket.reserve(999) == 2
+    # a new window refills the bucket
+    assert bucket.reserve(1000) == 0
+
+
+def test_min_interval_spaces_requests():
+    bucket = TokenBucket(10, 900, min_interval=1)
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(100.25) == 0.75
+    assert bucket.reserve(101) == 0
+
+
+def test_update_follows_headers():
+    bucket = TokenBucket(10, 900)
+    bucket.reserve(100)
+    bucket.update(10, 3, 500)
+    assert (bucket.remaining, bucket.reset, bucket.in_flight) == (3, 500, 0)
+    # an older response of the same window does not give permits back
+    bucket.update(10, 5, 500)
+    assert bucket.remaining == 2
+
+
+def test_release_returns_permit():
+    bucket = TokenBucket(1, 900)
+    assert bucket.reserve(100) == 0
+    assert bucket.reserve(100) > 0
+    bucket.release()
+    assert bucket.reserve(100) == 0
+    assert bucket.headroom() == 0
+
+
+def test_endpoint_family():
+    assert endpoint_family("tweets/search/all") == "search_all"
+    assert endpoint_family("tweets/123/liking_users") == "liking_users"
+    assert endpoint_family("users/123/followers") == "followers"
+    assert endpoint_family("users") == "users"
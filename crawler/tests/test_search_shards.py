@@ -0,0 +1,28 @@
+from search_shards import parse_time, remaining_window, time_slices
+
+
+def test_time_slices_are_consecutive_and_most_recent_first():
+    slices = time_slices("2021-01-01T00:00:00.000Z", "2021-01-05T00:00:00.000Z", 4)
+    assert slices == [("2021-01-04T00:00:00.000Z", "2021-01-05T00:00:00.000Z"),
+                      ("2021-01-03T00:00:00.000Z", "2021-01-04T00:00:00.000Z"),
+                      ("2021-01-02T00:00:00.000Z", "2021-01-03T00:00:00.000Z"),
+                      ("2021-01-01T00:00:00.000Z", "2021-01-02T00:00:00.000Z")]
+
+
+def test_time_slices_cover_the_window():
+    slices = time_slices("2021-01-01T00:00:00Z", "2021-01-01T00:00:10Z", 3)
+    assert slices[-1][0] == "2021-01-01T00:00:00.000Z"
+    assert slices[0][1] == "2021-01-01T00:00:10.000Z"
+    for (_, end), (start, _) in zip(slices[1:], slices):
+        assert end == start
+
+
+def test_time_slices_are_at_least_one_second():
+    slices = time_slices("2021-01-01T00:00:00.000Z", "2021-01-01T00:00:02.000Z", 10)
+    assert len(slices) == 2
+
+
+def test_remaining_window_includes_second_of_oldest_tweet():
+    start, end = remaining_window("2021-01-01T00:00:00.000Z", "2021-01-02T12:00:00.000Z")
+    assert start == "2021-01-01T00:00:00.000Z"
+    assert parse_time(end) == parse_time("2021-01-02T12:00:01.000Z")
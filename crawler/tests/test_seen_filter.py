@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("pymongo")
+
+from seen_filter import BloomFilter
+
+
+def test_added_ids_are_contained():
+    bloom = BloomFilter(1000, 0.01)
+    ids = [str(i) for i in range(1000)]
+    for key in ids:
+        bloom.add(key)
+    assert all(key in bloom for key in ids)
+    assert bloom.count == 1000
+
+
+def test_false_positive_rate_stays_near_error_rate():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add(str(i))
+    false_positives = sum(str(i) in bloom for i in range(10000, 30000))
+    assert false_positives / 20000 < 0.02
+
+
+def test_empty_filter_contains_nothing():
+    bloom = BloomFilter(100, 0.01)
+    assert "1" not in bloom
@@ -1,4 +1,5 @@
 import configparser
+import json
 import logging
 import os
 import smtplib
@@ -6,6 +7,12 @@ import ssl
 import time
 from functools import wraps
 
+try:
+    import orjson
+except ImportError:
+    # fall back to the (slower) standard library decoder
+    orjson = None
+
 
 class CustomLogFormatter(logging.Formatter):
     """Logging Formatter to add colors and count warning / errors"""
@@ -77,6 +84,28 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, it_length)]
 
 
+def decode_json(content):
+    """
+    Decodes a json document, uses orjson if it is installed
+    @param content: raw bytes or string of the json document
+    @return: decoded json object
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def encode_json(obj):
+    """
+    Encodes an object as json bytes, uses orjson if it is installed. Sets are encoded as sorted lists
+    @param obj: object to be encoded
+    @return: utf-8 encoded json document
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=sorted)
+    return json.dumps(obj, default=sorted).encode("utf-8")
+
+
 config = configparser.ConfigParser()
 config.read("../config.ini")
 